@@ -14,10 +14,14 @@ from database import (add_checkin_record, delete_analysis_result, delete_plantin
                      save_analysis_result, get_history, get_health_trend, 
                      save_planting_schedule, update_electronic_crop, update_planting_schedule, update_user_resources)
 from silican_api import SilicanAPI
-from rag_qa_system_simple import SimpleRAGQASystem as RAGQASystem
+from http_transport import get_transport
+from async_silican_api import HAS_AIOHTTP, detect_crop_health_many
+from rag_qa_system_simple import get_rag_service, reset_rag_services
+from conversation_memory import ConversationMemory
 from io import BytesIO
 import time
 import base64
+import uuid
 
 # 初始化数据库
 init_db()
@@ -630,6 +634,8 @@ class WeatherAPI:
         self.api_key = api_key or "f8d0f287ee4b4e44b9775a6e85150270"  #作者寄语：省着点用
         self.base_url = "https://p36hewymda.re.qweatherapi.com/v7"
         self.geo_url = "https://p36hewymda.re.qweatherapi.com/geo/v2"
+        # 与大模型调用共用带连接池的会话
+        self.transport = get_transport()
     
     def get_city_location_id(self, city_name):
         """通过城市名称获取和风天气的位置ID"""
@@ -640,7 +646,7 @@ class WeatherAPI:
                 "key": self.api_key,
                 "number": 1
             }
-            response = requests.get(url, params=params, timeout=10)
+            response = self.transport.get(url, name="weather.city_lookup", params=params, timeout=10)
             response.raise_for_status()
             data = response.json()
             
@@ -667,7 +673,7 @@ class WeatherAPI:
                 "lang": "zh",
                 "unit": "m"
             }
-            response = requests.get(url, params=params, timeout=10)
+            response = self.transport.get(url, name="weather.now", params=params, timeout=10)
             response.raise_for_status()
             data = response.json()
             
@@ -712,7 +718,7 @@ class WeatherAPI:
                 "lang": "zh",
                 "unit": "m"
             }
-            response = requests.get(url, params=params, timeout=10)
+            response = self.transport.get(url, name="weather.forecast", params=params, timeout=10)
             response.raise_for_status()
             data = response.json()
             
@@ -741,7 +747,7 @@ class WeatherAPI:
                 "key": self.api_key,
                 "lang": "zh"
             }
-            response = requests.get(url, params=params, timeout=10)
+            response = self.transport.get(url, name="weather.warning", params=params, timeout=10)
             response.raise_for_status()
             data = response.json()
             
@@ -1043,7 +1049,11 @@ if page == "图片分析":
                     result = api.detect_crop_health(image_path)
                     
                     # 检查是否有API错误
-                    if "API调用超时" in str(result) or "网络连接失败" in str(result) or "调用失败" in str(result):
+                    if "API服务暂时不可用" in str(result):
+                        st.error("⚠️ 模型服务暂时不可用，请稍后重试")
+                        st.stop()
+                    if result.get("error") or "API调用超时" in str(result) or "网络连接失败" in str(result) \
+                            or "调用失败" in str(result):
                         st.error("⚠️ API调用出现问题，请检查网络连接后重试")
                         st.info("如果问题持续存在，请尝试：\n1. 检查网络连接\n2. 稍后重试\n3. 联系技术支持")
                         st.stop()
@@ -1315,6 +1325,7 @@ elif page == "视频分析":
                     
                     frames_analyzed = 0
                     frame_count = 0
+                    frame_paths = []
                     
                     while cap.isOpened() and frames_analyzed < max_frames:
                         ret, frame = cap.read()
@@ -1326,25 +1337,49 @@ elif page == "视频分析":
                             # 临时保存帧图像
                             frame_path = f"temp_frame_{frames_analyzed}.jpg"
                             cv2.imwrite(frame_path, frame)
-                            
-                            # 分析当前帧
-                            status_text.text(f"分析第 {frames_analyzed + 1}/{expected_frames} 帧...")
-                            result = api.detect_crop_health(frame_path)
-                            all_results.append(result)
-                            
-                            # 更新进度
+                            frame_paths.append(frame_path)
                             frames_analyzed += 1
-                            progress_value = min(frames_analyzed / expected_frames, 1.0)
-                            progress_bar.progress(progress_value)
-                            
-                            # 删除临时帧文件
-                            try:
-                                os.unlink(frame_path)
-                            except PermissionError:
-                                pass
                             
                         frame_count += 1
                     
+                    def update_progress(done_count):
+                        status_text.text(f"已分析 {done_count}/{len(frame_paths)} 帧...")
+                        progress_bar.progress(min(done_count / max(len(frame_paths), 1), 1.0))
+                    
+                    if HAS_AIOHTTP and frame_paths:
+                        # 各帧并发分析，受共享的并发上限和速率限制约束
+                        status_text.text(f"并发分析 {len(frame_paths)} 帧...")
+                        completed = []
+                        
+                        def on_frame_result(index, result):
+                            completed.append(index)
+                            update_progress(len(completed))
+                        
+                        all_results = detect_crop_health_many(st.session_state.api_key, frame_paths,
+                                                              on_result=on_frame_result)
+                    else:
+                        for frame_path in frame_paths:
+                            status_text.text(f"分析第 {len(all_results) + 1}/{len(frame_paths)} 帧...")
+                            all_results.append(api.detect_crop_health(frame_path))
+                            update_progress(len(all_results))
+                    
+                    # 删除临时帧文件
+                    for frame_path in frame_paths:
+                        try:
+                            os.unlink(frame_path)
+                        except (PermissionError, FileNotFoundError):
+                            pass
+                    
+                    # 接口出错的帧（超时、限流、熔断）只有默认数据，不参与汇总
+                    frame_results = [(index, r) for index, r in enumerate(all_results, 1) if not r.get('error')]
+                    failed_results = [r for r in all_results if r.get('error')]
+                    if failed_results and not frame_results:
+                        st.error(f"⚠️ 全部 {len(failed_results)} 帧分析失败：{failed_results[0]['error']}")
+                        st.info("如果问题持续存在，请尝试：\n1. 检查网络连接\n2. 稍后重试\n3. 联系技术支持")
+                    elif failed_results:
+                        st.warning(f"⚠️ {len(failed_results)} 帧分析失败，已从汇总中排除：{failed_results[0]['error']}")
+                    all_results = [r for _, r in frame_results]
+                    
                     # 汇总分析结果
                     if all_results:
                         avg_confidence = sum(r['confidence'] for r in all_results) / len(all_results)
@@ -1373,8 +1408,8 @@ elif page == "视频分析":
                         
                         # 显示详细结果
                         st.markdown('<div class="sub-header">各帧分析详情</div>', unsafe_allow_html=True)
-                        for i, result in enumerate(all_results):
-                            with st.expander(f"第{i+1}帧 - {result['crop_type']} - {result['health_status']}"):
+                        for frame_number, result in frame_results:
+                            with st.expander(f"第{frame_number}帧 - {result['crop_type']} - {result['health_status']}"):
                                 col1, col2 = st.columns(2)
                                 with col1:
                                     st.write(f"**作物类型:** {result['crop_type']}")
@@ -1521,20 +1556,10 @@ elif page == "健康趋势":
 elif page == "农业问答助手":
     st.markdown('<div class="main-header">🌾 农业知识问答助手</div>', unsafe_allow_html=True)
     
-    # 初始化RAG系统
+    # 获取进程内共享的RAG系统（所有会话共用索引和缓存，API密钥在问答时传入）
     if st.session_state.api_key:
-        # 获取相似度算法选择
         similarity_method = st.session_state.get('similarity_method', 'cosine')
-        
-        # 检查是否需要重新初始化RAG系统
-        if ('rag_system' not in st.session_state or 
-            not hasattr(st.session_state.rag_system, 'get_cache_stats')):
-            st.session_state.rag_system = RAGQASystem(st.session_state.api_key, similarity_method)
-        elif st.session_state.rag_system.knowledge_base.similarity_method != similarity_method:
-            # 如果相似度方法改变，重新初始化
-            st.session_state.rag_system = RAGQASystem(st.session_state.api_key, similarity_method)
-        
-        rag_system = st.session_state.rag_system
+        rag_system = get_rag_service(similarity_method)
     else:
         rag_system = None
     
@@ -1584,9 +1609,10 @@ elif page == "农业问答助手":
     tab1, tab2 = st.tabs(["💬 智能问答", "📚 知识库管理"])
     
     with tab1:
-        # 初始化会话状态
-        if 'qa_history' not in st.session_state:
-            st.session_state.qa_history = []
+        # 初始化会话状态（对话记忆：最近几轮加滚动摘要作为追问背景，较早记录转存数据库）
+        if 'conversation' not in st.session_state:
+            st.session_state.conversation = ConversationMemory(uuid.uuid4().hex)
+        conversation = st.session_state.conversation
         if 'current_question' not in st.session_state:
             st.session_state.current_question = ""
         
@@ -1610,6 +1636,20 @@ elif page == "农业问答助手":
             help="支持各种农业相关问题，包括种植技术、病虫害防治、施肥管理等"
         )
         
+        # 自动补全：根据输入末尾的词语推荐知识库中的作物、病害、虫害词汇
+        if question and rag_system:
+            suggestions = rag_system.suggest_completions(question, limit=5)
+            if suggestions:
+                suggestion_cols = st.columns(len(suggestions))
+                for i, suggestion in enumerate(suggestions):
+                    with suggestion_cols[i]:
+                        if st.button(suggestion['term'], key=f"completion_{i}", use_container_width=True):
+                            st.session_state.current_question = suggestion['completion']
+                            st.rerun()
+        
+        # 流式回答显示区域（放在设置栏之外，占满整行宽度）
+        answer_placeholder = st.empty()
+        
         # 设置和提交按钮区域 - 紧凑版
         col_settings, col_submit = st.columns([2, 1])
         
@@ -1633,9 +1673,6 @@ elif page == "农业问答助手":
                 # 更新session state
                 if similarity_method != st.session_state.get('similarity_method', 'cosine'):
                     st.session_state.similarity_method = similarity_method
-                    # 重新初始化RAG系统
-                    if 'rag_system' in st.session_state:
-                        del st.session_state.rag_system
         
         with col_submit:
             # 提交按钮
@@ -1643,27 +1680,27 @@ elif page == "农业问答助手":
                 if not st.session_state.api_key:
                     st.markdown('<div class="warning-box">请先在侧边栏输入硅基流动API密钥</div>', unsafe_allow_html=True)
                 else:
-                    with st.spinner("🤔 正在思考中..."):
-                        try:
-                            # 使用RAG系统回答问题
-                            result = rag_system.answer_question(question, use_rag=use_rag)
-                            
-                            # 保存到历史记录
-                            st.session_state.qa_history.append({
-                                "question": question,
-                                "answer": result['answer'],
-                                "source": result['source'],
-                                "confidence": result['confidence'],
-                                "relevant_docs": result['relevant_docs'],
-                                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M")
-                            })
-                            
-                            # 清空当前问题
-                            st.session_state.current_question = ""
-                            st.rerun()
-                            
-                        except Exception as e:
-                            st.error(f"回答问题失败: {str(e)}")
+                    try:
+                        # 使用RAG系统回答问题（检索完成后逐段显示回答）
+                        with st.spinner("🤔 正在检索知识库..."):
+                            result, answer_stream = rag_system.answer_question_stream(
+                                question, use_rag=use_rag, api_key=st.session_state.api_key,
+                                conversation=conversation)
+                        
+                        streamed_answer = ""
+                        for delta in answer_stream:
+                            streamed_answer += delta
+                            answer_placeholder.markdown(streamed_answer + "▌")
+                        answer_placeholder.markdown(streamed_answer)
+                        
+                        # 回答结束后已由RAG系统记入对话历史
+                        
+                        # 清空当前问题
+                        st.session_state.current_question = ""
+                        st.rerun()
+                        
+                    except Exception as e:
+                        st.error(f"回答问题失败: {str(e)}")
         
         # 快速提问区域 - 超紧凑版
         st.markdown('''
@@ -1718,7 +1755,7 @@ elif page == "农业问答助手":
                 st.rerun()
         
         # 问答历史区域 - 紧凑版
-        if st.session_state.qa_history:
+        if conversation.turns:
             st.markdown('''
             <div style="background: white; padding: 12px 16px; border-radius: 8px; box-shadow: 0 1px 5px rgba(0,0,0,0.05); margin-bottom: 12px; border: 1px solid #e0e0e0;">
                 <div style="display: flex; align-items: center; justify-content: space-between;">
@@ -1726,7 +1763,7 @@ elif page == "农业问答助手":
                         📚 问答历史
                     </h3>
                     <span style="background: #e3f2fd; color: #1976d2; padding: 3px 8px; border-radius: 12px; font-size: 0.75rem;">
-                        {len(st.session_state.qa_history)} 条记录
+                        {conversation.total_turns} 条记录
                     </span>
                 </div>
             </div>
@@ -1736,7 +1773,7 @@ elif page == "农业问答助手":
             col_clear, col_export, col_filter = st.columns([1, 1, 2])
             with col_clear:
                 if st.button("🗑️ 清空历史", key="clear_history", use_container_width=True):
-                    st.session_state.qa_history = []
+                    conversation.clear()
                     st.rerun()
             
             with col_export:
@@ -1744,7 +1781,7 @@ elif page == "农业问答助手":
                     # 简单的导出功能
                     import re
                     history_text = ""
-                    for qa in st.session_state.qa_history:
+                    for qa in conversation.load_all():
                         # 清理HTML标签
                         clean_answer = re.sub(r'<[^>]+>', '', qa['answer'])
                         history_text += f"问题: {qa['question']}\n"
@@ -1762,12 +1799,12 @@ elif page == "农业问答助手":
             with col_filter:
                 filter_option = st.selectbox("筛选来源", ["全部", "知识库", "通用AI"], key="history_filter")
             
-            # 显示历史记录
-            filtered_history = st.session_state.qa_history
+            # 显示历史记录（内存中的最近记录）
+            filtered_history = conversation.turns
             if filter_option == "知识库":
-                filtered_history = [qa for qa in st.session_state.qa_history if qa.get('source') == 'knowledge_base']
+                filtered_history = [qa for qa in conversation.turns if qa.get('source') == 'knowledge_base']
             elif filter_option == "通用AI":
-                filtered_history = [qa for qa in st.session_state.qa_history if qa.get('source') != 'knowledge_base']
+                filtered_history = [qa for qa in conversation.turns if qa.get('source') != 'knowledge_base']
             
             for i, qa in enumerate(reversed(filtered_history)):
                 # 根据来源设置不同的样式
@@ -2000,12 +2037,62 @@ elif page == "农业问答助手":
                     st.rerun()
             
             with col3:
-                if st.button("🔄 重新初始化", use_container_width=True):
-                    # 强制重新初始化RAG系统
-                    if 'rag_system' in st.session_state:
-                        del st.session_state.rag_system
-                    st.success("系统已重新初始化")
-                    st.rerun()
+                if st.button("🔄 重新初始化（所有会话）", use_container_width=True,
+                             help="问答服务由所有会话共享，重新初始化会影响所有正在使用的用户"):
+                    if st.session_state.get('confirm_reset_rag', False):
+                        # 强制重新初始化共享的RAG系统
+                        reset_rag_services()
+                        st.session_state.confirm_reset_rag = False
+                        st.success("系统已重新初始化")
+                        st.rerun()
+                    else:
+                        st.session_state.confirm_reset_rag = True
+                        st.warning("⚠️ 将重新初始化所有会话共享的问答服务，再次点击确认")
+            
+            # 问答各阶段耗时分布（最近1000次问答的滚动统计）
+            latency_stats = cache_stats.get('latency', {})
+            with st.expander("⏱️ 问答耗时分布", expanded=False):
+                if latency_stats:
+                    stage_names = {
+                        'total': '总耗时', 'kb_stats': '知识库状态查询', 'retrieval': '知识库检索',
+                        'keyword_extraction': '关键词提取', 'prompt_build': '提示词构建',
+                        'semantic_cache': '语义缓存查找', 'llm': '大模型调用', 'faq': '常见问题匹配'
+                    }
+                    latency_df = pd.DataFrame([
+                        {
+                            '阶段': stage_names.get(stage, stage),
+                            '次数': stats['count'],
+                            'p50 (ms)': round(stats['p50'], 1),
+                            'p95 (ms)': round(stats['p95'], 1),
+                            'p99 (ms)': round(stats['p99'], 1),
+                            '最大 (ms)': round(stats['max'], 1)
+                        }
+                        for stage, stats in latency_stats.items()
+                    ])
+                    st.dataframe(latency_df, use_container_width=True, hide_index=True)
+                else:
+                    st.info("暂无问答耗时数据")
+            
+            # 外部API调用统计（共享连接池上的每次请求）
+            http_stats = get_transport().get_stats()
+            with st.expander("🌐 外部API调用统计", expanded=False):
+                if http_stats:
+                    http_df = pd.DataFrame([
+                        {
+                            '调用': name,
+                            '次数': stats['count'],
+                            '错误': stats['errors'],
+                            '发送 (KB)': round(stats['bytes_sent'] / 1024, 1),
+                            '接收 (KB)': round(stats['bytes_received'] / 1024, 1),
+                            '状态码': ', '.join(f"{status}×{count}" for status, count in stats['status'].items()),
+                            'p50 (ms)': round(stats['latency_ms'].get('p50', 0), 1),
+                            'p99 (ms)': round(stats['latency_ms'].get('p99', 0), 1)
+                        }
+                        for name, stats in http_stats.items()
+                    ])
+                    st.dataframe(http_df, use_container_width=True, hide_index=True)
+                else:
+                    st.info("暂无外部API调用")
             
             # 文档上传区域 - 紧凑版
             st.markdown('''
@@ -2048,11 +2135,13 @@ elif page == "农业问答助手":
                                     except:
                                         st.warning("文件内容无法解码为UTF-8")
                                     
-                                    success = rag_system.upload_document(file_content, uploaded_file.name)
-                                    if success:
-                                        st.success("✅ 上传成功")
+                                    upload_result = rag_system.upload_document_detailed(file_content, uploaded_file.name)
+                                    if upload_result['success']:
+                                        st.success("✅ 上传成功，后台处理中")
+                                    elif upload_result['duplicate'] is not None:
+                                        st.warning(f"⚠️ 未上传：{upload_result['reason']}")
                                     else:
-                                        st.error("❌ 上传失败")
+                                        st.error(f"❌ 上传失败：{upload_result['reason'] or '未知原因'}")
                                 except Exception as e:
                                     st.error(f"❌ 处理失败: {str(e)}")
                                     with st.expander("错误详情", expanded=False):
@@ -2118,7 +2207,12 @@ elif page == "农业问答助手":
                 
                 for doc in documents:
                     # 根据处理状态设置不同的样式
-                    if doc['processed']:
+                    if doc.get('processing_error'):
+                        status_icon = "❌"
+                        status_text = "处理失败"
+                        card_style = "background: linear-gradient(135deg, #ffebee, #ffcdd2); border-left: 4px solid #f44336;"
+                        status_color = "#f44336"
+                    elif doc['processed']:
                         status_icon = "✅"
                         status_text = "已处理"
                         card_style = "background: linear-gradient(135deg, #e8f5e8, #f1f8e9); border-left: 4px solid #4caf50;"
@@ -2161,13 +2255,16 @@ elif page == "农业问答助手":
                             st.markdown(f"**📏 文件大小:** {doc['file_size']:,} 字节")
                             st.markdown(f"**⏰ 上传时间:** {doc['upload_time']}")
                             st.markdown(f"**🔄 处理状态:** {status_icon} {status_text}")
+                            if doc.get('processing_error'):
+                                st.error(f"处理失败原因：{doc['processing_error']}（可更新文档内容或重新上传）")
                         
                         with col_actions:
                             # 搜索测试
                             if st.button("🔍 搜索测试", key=f"search_{doc['id']}", use_container_width=True):
                                 test_query = st.text_input("输入搜索关键词", key=f"query_{doc['id']}")
                                 if test_query:
-                                    results = rag_system.search_documents(test_query, top_k=3)
+                                    results = rag_system.search_documents(test_query, top_k=3,
+                                                                          document_ids=[doc['id']])
                                     if results:
                                         st.write("**搜索结果:**")
                                         for i, result in enumerate(results, 1):
@@ -2176,6 +2273,18 @@ elif page == "农业问答助手":
                                     else:
                                         st.write("未找到相关内容")
                             
+                            # 更新文档（只重新处理变化的片段）
+                            new_version = st.file_uploader("上传新版本", type=['txt'],
+                                                           key=f"update_file_{doc['id']}",
+                                                           label_visibility="collapsed")
+                            if new_version and st.button("📝 更新", key=f"update_{doc['id']}", use_container_width=True):
+                                update_result = rag_system.update_document(doc['id'], new_version.read(), new_version.name)
+                                if update_result['success']:
+                                    st.success(f"文档已更新：复用 {update_result['reused_chunks']} 个片段，"
+                                               f"新增 {update_result['added_chunks']} 个，删除 {update_result['removed_chunks']} 个")
+                                else:
+                                    st.error("更新失败")
+                            
                             # 删除文档
                             if st.button("🗑️ 删除", key=f"delete_{doc['id']}", use_container_width=True):
                                 if rag_system.delete_document(doc['id']):
@@ -2195,13 +2304,13 @@ elif page == "农业问答助手":
             # 知识库操作
             st.markdown('<div class="sub-header">🔧 知识库操作</div>', unsafe_allow_html=True)
             
-            col1, col2, col3 = st.columns(3)
+            col1, col2, col3, col4 = st.columns(4)
             
             with col1:
                 if st.button("🔄 重建索引", help="重新构建向量索引"):
-                    with st.spinner("正在重建索引..."):
-                        rag_system.rebuild_knowledge_base()
-                        st.success("索引重建完成")
+                    with st.spinner("正在提交重建任务..."):
+                        count = rag_system.rebuild_knowledge_base()
+                        st.success(f"已提交 {count} 个文档重建索引，后台处理中")
                         st.rerun()
             
             with col2:
@@ -2212,6 +2321,9 @@ elif page == "农业问答助手":
                     st.write(f"- 总片段数: {stats['total_chunks']}")
                     st.write(f"- 总大小: {stats['total_size_mb']} MB")
                     st.write(f"- 文件类型分布: {stats['file_types']}")
+                    st.write(f"- 去重后唯一片段数: {stats['unique_chunks']}")
+                    st.write(f"- 待处理文档数: {stats['pending_documents']}")
+                    st.write(f"- 处理失败文档数: {stats.get('failed_documents', 0)}")
             
             with col3:
                 if st.button("🧪 测试搜索", help="测试知识库搜索功能"):
@@ -2226,6 +2338,42 @@ elif page == "农业问答助手":
                                 st.write("---")
                         else:
                             st.write("未找到相关内容")
+            
+            with col4:
+                if st.button("🧹 维护索引", help="检查并修复索引一致性，分片回收数据库空间"):
+                    with st.spinner("正在维护知识库..."):
+                        summary = rag_system.run_maintenance()
+                        st.write("**发现的问题:**")
+                        st.write({name: count for name, count in summary['issues'].items() if count})
+                        st.write(f"- 回收空闲页: {summary['compaction']['pages_freed']}")
+                        st.success("维护完成")
+            
+            with st.expander("📦 索引文件导出/导入"):
+                if st.button("📤 导出索引文件", help="导出文档、片段、向量和倒排索引，供新节点直接导入"):
+                    with tempfile.TemporaryDirectory() as temp_dir:
+                        archive_path = os.path.join(temp_dir, "kb_index.zip")
+                        manifest = rag_system.export_index(archive_path)
+                        if manifest:
+                            with open(archive_path, "rb") as f:
+                                st.download_button("💾 下载索引文件", f.read(),
+                                                   file_name=f"kb_index_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
+                                                   mime="application/zip")
+                            st.write(manifest['tables'])
+                        else:
+                            st.error("导出失败")
+                
+                archive_file = st.file_uploader("选择索引文件", type=['zip'], key="kb_index_upload")
+                replace_existing = st.checkbox("清空现有知识库后导入", key="kb_index_replace")
+                if archive_file is not None and st.button("📥 导入索引文件"):
+                    with tempfile.TemporaryDirectory() as temp_dir:
+                        archive_path = os.path.join(temp_dir, "kb_index.zip")
+                        with open(archive_path, "wb") as f:
+                            f.write(archive_file.getvalue())
+                        if rag_system.import_index(archive_path, replace=replace_existing):
+                            st.success("✅ 索引文件导入成功")
+                            st.rerun()
+                        else:
+                            st.error("导入失败，请检查索引文件版本或知识库是否为空")
 
 
 elif page == "种植计划":
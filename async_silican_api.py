@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+硅基流动API的异步客户端
+方法与SilicanAPI相同但均为协程，可用asyncio.gather并发发出大量调用而不占用线程；
+所有实例共用并发上限（信号量）和令牌桶速率限制，按服务商配额设置后并发调用不会触发429
+
+用法：
+    async with AsyncSilicanAPI(api_key) as api:
+        answers = await asyncio.gather(*(api.agricultural_qa(q) for q in questions))
+"""
+
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from collections import deque
+import asyncio
+import json
+import threading
+import time
+
+from silican_api import SilicanAPI, CircuitOpenError, API_ERROR_PREFIXES, DEFAULT_HEALTH_DATA, \
+    HEALTH_ASSESSMENT_PROMPT, HEALTH_DESCRIPTION_PROMPT, HEALTH_SINGLE_CALL_PROMPT, retry_on_failure
+
+# 尝试导入aiohttp，如果失败则只能使用同步客户端
+try:
+    import aiohttp
+    HAS_AIOHTTP = True
+except ImportError:
+    HAS_AIOHTTP = False
+
+# 可重试的网络异常（重试和熔断策略与同步客户端相同，共用同一个熔断器）
+ASYNC_RETRY_EXCEPTIONS = (asyncio.TimeoutError, aiohttp.ClientConnectionError) if HAS_AIOHTTP \
+    else (asyncio.TimeoutError,)
+
+# 默认并发和速率限制，应按服务商给账号的配额调整
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_REQUESTS_PER_MINUTE = 300
+DEFAULT_BURST = 10
+
+
+class TokenBucket:
+    """令牌桶速率限制（线程安全，不依赖事件循环，多个事件循环共用同一配额）"""
+
+    def __init__(self, requests_per_minute: float, burst: int):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """预占一个令牌，返回需要等待的秒数（令牌不足时按生成速度排队）"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    async def acquire(self) -> None:
+        """等待直到取得令牌"""
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class ProcessSemaphore:
+    """
+    进程级并发上限，可在任意线程的任意事件循环中使用
+
+    asyncio.Semaphore只能在创建它的事件循环中使用，而asyncio.run每次调用都新建事件循环，
+    按事件循环分别计数会让每个会话或线程各占一份上限；这里用线程锁计数，
+    名额不足时在调用方的事件循环上等待，释放时把名额直接交给最早的等待者
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.waiters: Deque[Tuple[asyncio.AbstractEventLoop, 'asyncio.Future']] = deque()
+        self.lock = threading.Lock()
+
+    async def acquire(self) -> None:
+        """取得一个名额，名额用完时按先后顺序等待"""
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.active < self.limit and not self.waiters:
+                self.active += 1
+                return
+            waiter = (loop, loop.create_future())
+            self.waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self.lock:
+                if waiter in self.waiters:
+                    # 尚未分到名额，退出等待队列即可
+                    self.waiters.remove(waiter)
+                    raise
+            # 名额已交给本调用但任务随后被取消：归还名额（等待本身被取消的情况由_hand_over归还）
+            if waiter[1].done() and not waiter[1].cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        """归还名额：有等待者时直接交给最早的等待者，否则计数减一"""
+        with self.lock:
+            while self.waiters:
+                loop, future = self.waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._hand_over, future)
+                    return
+                except RuntimeError:
+                    # 等待者的事件循环已关闭，交给下一个等待者
+                    continue
+            self.active -= 1
+
+    def _hand_over(self, future: 'asyncio.Future') -> None:
+        """在等待者的事件循环中唤醒它；等待已被取消时把名额继续传下去"""
+        if future.cancelled():
+            self.release()
+        elif not future.done():
+            future.set_result(None)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+# 进程内共享的并发上限和速率限制，所有线程和事件循环中的异步客户端共用
+_concurrency_limit = ProcessSemaphore(DEFAULT_MAX_CONCURRENCY)
+_rate_limiter = TokenBucket(DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_BURST)
+_limits_lock = threading.Lock()
+
+
+def configure_async_limits(max_concurrency: Optional[int] = None, requests_per_minute: Optional[float] = None,
+                           burst: Optional[int] = None) -> None:
+    """设置所有异步客户端共用的并发上限和速率限制（未指定的项保持不变，进行中的调用按原设置完成）"""
+    global _concurrency_limit, _rate_limiter
+    with _limits_lock:
+        if max_concurrency is not None:
+            _concurrency_limit = ProcessSemaphore(max_concurrency)
+        if requests_per_minute is not None or burst is not None:
+            _rate_limiter = TokenBucket(requests_per_minute or _rate_limiter.rate * 60,
+                                        burst or _rate_limiter.capacity)
+
+
+class AsyncSilicanAPI(SilicanAPI):
+    """SilicanAPI的异步版本，请求体构建和结果解析与同步版本共用"""
+
+    def __init__(self, api_key, preprocessor=None, connect_timeout=10, read_timeout=60):
+        if not HAS_AIOHTTP:
+            raise ImportError("未安装aiohttp，无法使用异步客户端")
+        super().__init__(api_key, preprocessor)
+        # 连接超时；读取超时为两段数据之间的最长间隔，与同步版本一致
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self._session = None
+        self._session_loop = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _get_session(self) -> 'aiohttp.ClientSession':
+        """获取当前事件循环上的会话（会话内的连接在调用之间复用）"""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+            self._session_loop = loop
+        return self._session
+
+    async def close(self) -> None:
+        """关闭会话"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _post(self, payload, name, stream=False):
+        """在并发上限和速率限制内发送请求，返回响应（调用方负责释放）"""
+        body = json.dumps(payload).encode('utf-8')
+        await _rate_limiter.acquire()
+        started = time.perf_counter()
+        try:
+            response = await self._get_session().post(f"{self.base_url}/chat/completions", data=body,
+                                                      headers=self._headers(stream=stream))
+        except Exception as e:
+            self.transport.record(name, (time.perf_counter() - started) * 1000, type(e).__name__, len(body),
+                                  failed=True)
+            raise
+        self.transport.record(name, (time.perf_counter() - started) * 1000, str(response.status), len(body),
+                              response.content_length or 0, failed=response.status >= 400)
+        if response.status >= 400:
+            text = await response.text()
+            response.release()
+            raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status,
+                                              message=text, headers=response.headers)
+        return response
+
+    @retry_on_failure(max_retries=3, delay=1, retry_exceptions=ASYNC_RETRY_EXCEPTIONS)
+    async def _request_chat(self, payload, name):
+        """发送对话补全请求并返回回答文本，网络、HTTP和解析错误照常抛出"""
+        async with _concurrency_limit:
+            response = await self._post(payload, name)
+            async with response:
+                result = await response.json(content_type=None)
+        return result["choices"][0]["message"]["content"]
+
+    async def _chat_completion(self, payload, name, error_label="调用失败"):
+        """发送对话补全请求，错误转换为与同步版本相同的提示文本返回"""
+        try:
+            return await self._request_chat(payload, name)
+        except CircuitOpenError as e:
+            return str(e)
+        except asyncio.TimeoutError:
+            return "API调用超时，请检查网络连接后重试"
+        except aiohttp.ClientConnectionError:
+            return "网络连接失败，请检查网络连接"
+        except aiohttp.ClientResponseError as e:
+            return f"API错误 {e.status}: {e.message}"
+        except (KeyError, IndexError, json.JSONDecodeError) as e:
+            return f"解析API响应失败: {str(e)}"
+        except aiohttp.ClientError as e:
+            return f"网络请求失败: {str(e)}"
+        except Exception as e:
+            return f"{error_label}: {str(e)}"
+
+    async def analyze_image(self, image_path, prompt, encoded_image=None, max_tokens=1000):
+        """调用硅基流动API分析图像（同一图像多次调用时可传入已编码的encoded_image）"""
+        if encoded_image is None:
+            encoded_image, _ = await asyncio.to_thread(self._prepare_image, image_path)
+        payload = self._build_image_payload(encoded_image, prompt, max_tokens)
+        return await self._chat_completion(payload, "chat.vision")
+
+    async def detect_crop_health(self, image_path, mode="single"):
+        """检测农作物健康状态（mode含义同SilicanAPI.detect_crop_health）"""
+        # 图像预处理在线程中进行，不阻塞事件循环
+        encoded_image, image_stats = await asyncio.to_thread(self._prepare_image, image_path)
+
+        if mode == "single":
+            analysis_result = await self.analyze_image(image_path, HEALTH_SINGLE_CALL_PROMPT,
+                                                       encoded_image=encoded_image, max_tokens=2500)
+            if analysis_result.startswith(API_ERROR_PREFIXES):
+                return self._build_error_result(analysis_result, image_stats)
+            result_data = self._parse_health_json(analysis_result)
+            if result_data and result_data.get("description") and result_data.get("suggestions"):
+                result = self._build_health_result(result_data, self._as_text(result_data["description"]),
+                                                   self._as_text(result_data["suggestions"]))
+                result["image_stats"] = image_stats
+                return result
+            print("WARNING: 单次调用结果不完整，改为分步分析")
+            mode = "concurrent"
+
+        analysis_result = await self.analyze_image(image_path, HEALTH_ASSESSMENT_PROMPT, encoded_image=encoded_image)
+        if analysis_result.startswith(API_ERROR_PREFIXES):
+            return self._build_error_result(analysis_result, image_stats)
+        result_data = self._parse_health_json(analysis_result) or dict(DEFAULT_HEALTH_DATA)
+
+        suggestion_prompt = self._build_suggestion_prompt(result_data)
+        if mode == "concurrent":
+            description, suggestions = await asyncio.gather(
+                self.analyze_image(image_path, HEALTH_DESCRIPTION_PROMPT, encoded_image=encoded_image),
+                self.analyze_image(image_path, suggestion_prompt, encoded_image=encoded_image)
+            )
+        else:
+            description = await self.analyze_image(image_path, HEALTH_DESCRIPTION_PROMPT,
+                                                   encoded_image=encoded_image)
+            suggestions = await self.analyze_image(image_path, suggestion_prompt, encoded_image=encoded_image)
+
+        result = self._build_health_result(result_data, description, suggestions)
+        result["image_stats"] = image_stats
+        return result
+
+    async def agricultural_qa(self, question):
+        """农业知识问答"""
+        payload = self._build_qa_payload(question)
+        return await self._chat_completion(payload, "chat.qa", error_label="问答失败")
+
+    async def agricultural_qa_stream(self, question):
+        """
+        流式农业知识问答，逐段生成回答文本（异步生成器）
+
+        与同步版本一样，网络或HTTP错误直接抛出aiohttp异常（熔断期间抛出CircuitOpenError）
+        """
+        payload = self._build_qa_payload(question, stream=True)
+        async with _concurrency_limit:
+            response = await self._open_stream(payload)
+            async with response:
+                async for line in response.content:
+                    line = line.decode('utf-8').strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                    except (json.JSONDecodeError, KeyError, IndexError):
+                        continue
+                    if delta:
+                        yield delta
+
+    @retry_on_failure(max_retries=3, delay=1, retry_exceptions=ASYNC_RETRY_EXCEPTIONS)
+    async def _open_stream(self, payload):
+        """建立流式请求（只在收到响应头之前重试）"""
+        return await self._post(payload, "chat.qa_stream", stream=True)
+
+    async def generate_planting_advice(self, crop_type, prompt=None):
+        """生成作物种植建议"""
+        payload = self._build_advice_payload(crop_type, prompt)
+        return await self._chat_completion(payload, "chat.advice", error_label="生成种植建议失败")
+
+    async def extract_events_from_advice(self, advice_text):
+        """从建议文本中提取关键事件"""
+        payload = self._build_events_payload(advice_text)
+        try:
+            content = await self._request_chat(payload, "chat.events")
+            return self._parse_events(content)
+        except asyncio.TimeoutError:
+            print("API调用超时，请检查网络连接后重试")
+            return []
+        except aiohttp.ClientConnectionError:
+            print("网络连接失败，请检查网络连接")
+            return []
+        except Exception as e:
+            print(f"提取事件失败: {str(e)}")
+            return []
+
+
+def detect_crop_health_many(api_key: str, image_paths: List[str], mode: str = "single",
+                            on_result: Optional[Callable[[int, Dict[str, Any]], None]] = None
+                            ) -> List[Dict[str, Any]]:
+    """
+    在同步代码中并发检测多张图像，结果顺序与image_paths一致
+
+    Args:
+        on_result: 每张图像完成时的回调 (序号, 结果)，在调用线程中执行，可用于更新进度
+    """
+    async def run():
+        async with AsyncSilicanAPI(api_key) as api:
+            async def detect(index, image_path):
+                result = await api.detect_crop_health(image_path, mode=mode)
+                if on_result is not None:
+                    on_result(index, result)
+                return result
+            return await asyncio.gather(*(detect(index, path) for index, path in enumerate(image_paths)))
+
+    return list(asyncio.run(run()))
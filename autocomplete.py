@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+问题输入自动补全
+从知识库文档和农业词表中提取作物、病害、虫害等词汇，保存在内存前缀树中，
+每个节点预先保存按词频排序的前k个补全，查询只需沿前缀走到对应节点
+"""
+
+from typing import Dict, Iterable, List, Optional, Tuple
+from collections import Counter
+import os
+import re
+import threading
+
+# 农业词表：作物、病害、虫害、农资和农事操作
+AGRICULTURAL_LEXICON = [
+    # 作物
+    '水稻', '玉米', '小麦', '大豆', '棉花', '油菜', '花生', '马铃薯', '甘薯', '高粱', '谷子',
+    '番茄', '黄瓜', '辣椒', '茄子', '白菜', '甘蓝', '萝卜', '西瓜', '甜瓜', '草莓',
+    '苹果', '梨树', '柑橘', '葡萄', '桃树', '茶树', '蔬菜', '水果', '果树',
+    # 病害
+    '稻瘟病', '纹枯病', '白叶枯病', '稻曲病', '赤霉病', '锈病', '白粉病', '根腐病',
+    '大斑病', '小斑病', '灰霉病', '霜霉病', '晚疫病', '早疫病', '炭疽病', '枯萎病',
+    '病毒病', '青枯病', '软腐病', '黑斑病', '叶斑病', '疫病',
+    # 虫害
+    '稻飞虱', '二化螟', '三化螟', '稻纵卷叶螟', '玉米螟', '黏虫', '蚜虫', '红蜘蛛',
+    '棉铃虫', '小菜蛾', '菜青虫', '白粉虱', '蓟马', '地老虎', '蛴螬', '草地贪夜蛾',
+    # 农资与农事
+    '病虫害', '防治', '农药', '杀虫剂', '杀菌剂', '除草剂', '肥料', '有机肥', '复合肥',
+    '氮肥', '磷肥', '钾肥', '叶面肥', '种植', '栽培', '施肥', '浇水', '灌溉', '播种',
+    '育苗', '移栽', '收获', '田间管理', '土壤', '温度', '湿度', '光照'
+]
+
+# 以这些字结尾的短语多为病害、虫害或农资名称，从知识库文档中提取为补全候选
+TERM_SUFFIXES = set('病虫螟蚜螨瘟菌肥药剂唑')
+SUFFIX_TERM_LENGTHS = (3, 4)
+SUFFIX_TERM_MIN_COUNT = 2  # 文档中出现次数不足的短语视为噪声
+
+
+def extract_terms(text: str) -> Counter:
+    """从文档文本中提取补全词汇及出现次数"""
+    counts = Counter()
+    for term in AGRICULTURAL_LEXICON:
+        occurrences = text.count(term)
+        if occurrences:
+            counts[term] += occurrences
+
+    phrases = Counter()
+    for run in re.findall(r'[\u4e00-\u9fff]+', text):
+        for end, char in enumerate(run, 1):
+            # 后一个字仍是后缀字（如“瘟病”）时，短语在后一个字处结束
+            if char not in TERM_SUFFIXES or (end < len(run) and run[end] in TERM_SUFFIXES):
+                continue
+            for length in SUFFIX_TERM_LENGTHS:
+                if end >= length:
+                    phrases[run[end - length:end]] += 1
+
+    # 短的优先：尾部已经是候选词的长短语（如“稻稻瘟病”之于“稻瘟病”）视为噪声
+    for phrase in sorted(phrases, key=len):
+        if phrases[phrase] < SUFFIX_TERM_MIN_COUNT or phrase in counts:
+            continue
+        if any(phrase[start:] in counts for start in range(1, len(phrase) - 1)):
+            continue
+        counts[phrase] = phrases[phrase]
+    return counts
+
+
+class _TrieNode:
+    """前缀树节点"""
+    __slots__ = ('children', 'term', 'count', 'top')
+
+    def __init__(self):
+        self.children: Dict[str, '_TrieNode'] = {}
+        self.term: Optional[str] = None
+        self.count = 0
+        self.top: List[Tuple[int, str]] = []  # 子树中词频最高的前k个 (词频, 词)
+
+
+class PrefixTrie:
+    """带节点级top-k的前缀树，支持按词增量调整词频"""
+
+    def __init__(self, top_k: int = 8):
+        self.top_k = top_k
+        self.root = _TrieNode()
+        self.term_count = 0
+
+    def update(self, term: str, delta: int) -> None:
+        """调整词频（delta可为负），并沿路径自底向上重算各节点的top-k"""
+        if not term or not delta:
+            return
+        path = [self.root]
+        node = self.root
+        for char in term:
+            child = node.children.get(char)
+            if child is None:
+                if delta < 0:
+                    return  # 不存在的词无需减少
+                child = node.children[char] = _TrieNode()
+            node = child
+            path.append(node)
+
+        was_present = node.count > 0
+        node.term = term
+        node.count = max(0, node.count + delta)
+        self.term_count += (node.count > 0) - was_present
+
+        for depth in range(len(path) - 1, -1, -1):
+            current = path[depth]
+            # 无词且无子节点的节点直接从父节点移除
+            if depth > 0 and current.count == 0 and not current.children:
+                del path[depth - 1].children[term[depth - 1]]
+                continue
+            candidates = [(current.count, current.term)] if current.count > 0 else []
+            for child in current.children.values():
+                candidates.extend(child.top)
+            candidates.sort(key=lambda item: (-item[0], item[1]))
+            current.top = candidates[:self.top_k]
+
+    def complete(self, prefix: str, limit: Optional[int] = None) -> List[Tuple[str, int]]:
+        """返回以prefix开头的高频词 [(词, 词频)]"""
+        node = self.root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return []
+        top = node.top[:limit] if limit else node.top
+        return [(term, count) for count, term in top]
+
+
+class AutocompleteIndex:
+    """线程安全的自动补全索引，首次查询时从数据库加载"""
+
+    def __init__(self, top_k: int = 8):
+        self.top_k = top_k
+        self.lock = threading.RLock()
+        self.trie = PrefixTrie(top_k)
+        self.loaded = False
+
+    def load(self, term_counts: Iterable[Tuple[str, int]]) -> None:
+        """全量加载词频（词表中的词至少计1次，知识库中未出现的也可补全）"""
+        with self.lock:
+            self.trie = PrefixTrie(self.top_k)
+            for term in AGRICULTURAL_LEXICON:
+                self.trie.update(term, 1)
+            for term, count in term_counts:
+                self.trie.update(term, count)
+            self.loaded = True
+
+    def apply(self, term_delta: Dict[str, int]) -> None:
+        """增量应用文档上传、更新或删除带来的词频变化（尚未加载时忽略）"""
+        with self.lock:
+            if not self.loaded:
+                return
+            for term, delta in term_delta.items():
+                self.trie.update(term, delta)
+
+    def invalidate(self) -> None:
+        """标记需要重新加载（如导入索引文件后）"""
+        with self.lock:
+            self.loaded = False
+
+    def complete(self, prefix: str, limit: int = 5) -> List[Tuple[str, int]]:
+        """查询补全"""
+        with self.lock:
+            return self.trie.complete(prefix, limit)
+
+
+# 每个数据库文件共享一个补全索引
+_indexes: Dict[str, AutocompleteIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_autocomplete_index(db_path: str) -> AutocompleteIndex:
+    """获取或创建指定数据库的补全索引"""
+    key = os.path.abspath(db_path)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = AutocompleteIndex()
+        return _indexes[key]
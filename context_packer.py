@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RAG提示词上下文打包
+去掉相邻片段之间的重叠文本，按与问题的相关度挑选句子，在给定的token预算内拼接上下文
+"""
+
+from typing import Any, Dict, List
+import math
+import re
+
+# 句子切分（中英文句末标点和换行）
+SENTENCE_PATTERN = re.compile(r'[^。！？!?；;\n]+[。！？!?；;]?')
+
+
+def estimate_tokens(text: str) -> int:
+    """估算token数：汉字约1个token，其他字符约4个合1个token"""
+    cjk_chars = len(re.findall(r'[\u4e00-\u9fff]', text))
+    other_chars = len(re.sub(r'[\u4e00-\u9fff\s]', '', text))
+    return cjk_chars + math.ceil(other_chars / 4)
+
+
+def split_sentences(text: str) -> List[str]:
+    """将文本切分为句子"""
+    return [sentence.strip() for sentence in SENTENCE_PATTERN.findall(text) if sentence.strip()]
+
+
+def remove_adjacent_overlap(docs: List[Dict[str, Any]], max_overlap: int = 200) -> List[Dict[str, Any]]:
+    """
+    去掉同一文档相邻片段之间的重叠文本
+
+    分块时后一个片段以前一个片段的末尾开头，两者同时被检索到时删除后一个片段开头的重复部分
+
+    Returns:
+        片段副本列表（顺序不变，content为去重后的内容）
+    """
+    contents = {(doc['document_id'], doc['chunk_index']): doc['content'] for doc in docs}
+    trimmed = []
+    for doc in docs:
+        doc = dict(doc)
+        previous = contents.get((doc['document_id'], doc['chunk_index'] - 1))
+        if previous:
+            content = doc['content']
+            for length in range(min(max_overlap, len(previous), len(content)), 0, -1):
+                if content.startswith(previous[-length:]):
+                    doc['content'] = content[length:].strip()
+                    break
+        trimmed.append(doc)
+    return trimmed
+
+
+class ContextPacker:
+    """按token预算打包RAG上下文"""
+
+    def __init__(self, token_budget: int = 1500, max_overlap: int = 200):
+        """
+        初始化上下文打包器
+
+        Args:
+            token_budget: 上下文最多占用的token数
+            max_overlap: 相邻片段之间检查的最长重叠字符数
+        """
+        self.token_budget = token_budget
+        self.max_overlap = max_overlap
+
+    def pack(self, docs: List[Dict[str, Any]], query_vector: Dict[str, float]) -> str:
+        """
+        构建上下文
+
+        Args:
+            docs: 检索到的片段（按相关度排序）
+            query_vector: 查询向量，用于计算句子与问题的相关度
+        """
+        docs = remove_adjacent_overlap(docs, self.max_overlap)
+        total_weight = sum(query_vector.values()) or 1.0
+
+        # 收集候选句子：(得分, 片段序号, 句子序号, 句子)，跨片段完全相同的句子只保留一次
+        candidates = []
+        seen = set()
+        for doc_index, doc in enumerate(docs):
+            for sentence_index, sentence in enumerate(split_sentences(doc['content'])):
+                if sentence in seen:
+                    continue
+                seen.add(sentence)
+                coverage = sum(weight for term, weight in query_vector.items() if term in sentence) / total_weight
+                score = coverage + 0.2 * doc.get('similarity_score', 0.0)
+                candidates.append((score, doc_index, sentence_index, sentence))
+
+        # 按得分从高到低放入预算，放不下的句子跳过，继续尝试更短的句子
+        headers = {doc_index: self._header(doc_index, doc) for doc_index, doc in enumerate(docs)}
+        selected = []
+        used_tokens = 0
+        used_docs = set()
+        for score, doc_index, sentence_index, sentence in sorted(candidates, key=lambda item: -item[0]):
+            cost = estimate_tokens(sentence)
+            if doc_index not in used_docs:
+                cost += estimate_tokens(headers[doc_index])
+            if used_tokens + cost > self.token_budget:
+                continue
+            selected.append((doc_index, sentence_index, sentence))
+            used_docs.add(doc_index)
+            used_tokens += cost
+
+        if not selected and candidates:
+            # 最相关的句子本身超出预算时截断保留
+            _, doc_index, sentence_index, sentence = max(candidates, key=lambda item: item[0])
+            selected.append((doc_index, sentence_index, sentence[:self.token_budget]))
+
+        # 按片段排序和句子原顺序输出
+        context_parts = []
+        for doc_index in sorted(set(doc_index for doc_index, _, _ in selected)):
+            sentences = [sentence for index, _, sentence in sorted(selected) if index == doc_index]
+            context_parts.append(f"{headers[doc_index]}\n{''.join(sentences)}\n")
+        return "\n".join(context_parts)
+
+    def _header(self, doc_index: int, doc: Dict[str, Any]) -> str:
+        """片段标题"""
+        return f"文档片段 {doc_index + 1} (相似度: {doc.get('similarity_score', 0.0):.2f}):"
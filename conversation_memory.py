@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多轮问答的对话记忆
+最近几轮对话原样保留，更早的对话压缩进滚动摘要，发送给大模型的对话背景始终控制在固定token预算内；
+每个会话在内存中只保留有限条历史，更早的记录转存到SQLite；转存记录超过保留期后由维护任务清理
+"""
+
+from typing import Any, Callable, Dict, List, Optional
+import json
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+from context_packer import estimate_tokens, split_sentences
+
+# 摘要中每轮对话保留的回答长度（字符）
+SUMMARY_ANSWER_CHARS = 60
+
+# 转存的对话记录默认保留天数（会话结束时通常不会调用clear，需按时间清理）
+DEFAULT_HISTORY_RETENTION_DAYS = 7
+
+# 指代前文的代词和承接词：含有这些词的问题要结合对话背景才能理解
+FOLLOW_UP_REFERENCES = ['这个', '那个', '这种', '那种', '这些', '那些', '这样', '那样', '它们', '它', '他们',
+                        '上面', '上述', '前面', '刚才', '刚刚', '之前说', '你说', '该病', '该虫', '此病', '同样']
+# 以这些词开头的问题通常省略了前文的主语（如“那玉米呢”“还有别的办法吗”）
+FOLLOW_UP_PREFIXES = ('那', '还有', '还能', '还要', '另外', '此外', '再', '然后', '所以', '为什么', '为啥')
+# 去掉标点后不超过该长度的问题视为省略了前文内容（如“为什么？”“用量呢”）
+FOLLOW_UP_MAX_CHARS = 4
+
+
+def is_follow_up_question(question: str) -> bool:
+    """判断问题是否依赖前文（含指代词、以承接词开头、以“呢”结尾的省略问句或过短）"""
+    text = re.sub(r'[^\u4e00-\u9fff\w]', '', question)
+    if len(text) <= FOLLOW_UP_MAX_CHARS:
+        return True
+    if text.startswith(FOLLOW_UP_PREFIXES) or text.endswith('呢'):
+        return True
+    return any(reference in text for reference in FOLLOW_UP_REFERENCES)
+
+
+def purge_conversation_history(db_path: str, max_age_days: float = DEFAULT_HISTORY_RETENTION_DAYS,
+                               batch_size: int = 500, pause: float = 0.0) -> int:
+    """
+    删除超过保留期的转存对话记录
+
+    Args:
+        db_path: 数据库文件路径
+        max_age_days: 保留天数，早于该时间转存的记录被删除
+        batch_size: 每个写事务删除的行数
+        pause: 两个写事务之间的间隔（秒），让出写锁给前台请求
+
+    Returns:
+        删除的记录数
+    """
+    cutoff = datetime.now() - timedelta(days=max_age_days)
+    deleted = 0
+    try:
+        conn = sqlite3.connect(db_path, timeout=30)
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'qa_conversation_history'")
+        if c.fetchone() is None:
+            conn.close()
+            return 0
+        while True:
+            c.execute('''DELETE FROM qa_conversation_history WHERE id IN
+                         (SELECT id FROM qa_conversation_history WHERE created_at < ? LIMIT ?)''',
+                      (cutoff, batch_size))
+            conn.commit()
+            deleted += c.rowcount
+            if c.rowcount < batch_size:
+                break
+            time.sleep(pause)
+        conn.close()
+    except Exception as e:
+        print(f"ERROR: 清理过期对话历史失败: {str(e)}")
+    return deleted
+
+
+def summarize_locally(previous_summary: str, turns: List[Dict[str, Any]]) -> str:
+    """本地摘要：每轮只保留问题和回答的第一句，追加到已有摘要后"""
+    lines = [previous_summary] if previous_summary else []
+    for turn in turns:
+        sentences = split_sentences(turn.get('answer', ''))
+        first_sentence = sentences[0][:SUMMARY_ANSWER_CHARS] if sentences else ''
+        lines.append(f"问：{turn['question']}；答：{first_sentence}")
+    return '\n'.join(lines)
+
+
+def _truncate_to_tokens(text: str, max_tokens: int, keep_tail: bool = False) -> str:
+    """按估算token数截断文本（keep_tail为True时保留末尾）"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        part = text[-middle:] if keep_tail else text[:middle]
+        if estimate_tokens(part) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    if low == 0:
+        return ''
+    return text[-low:] if keep_tail else text[:low]
+
+
+class ConversationMemory:
+    """单个会话的对话记忆"""
+
+    def __init__(self, session_id: str, db_path: str = "crop_health.db", max_turns_in_memory: int = 50,
+                 recent_turns: int = 3, token_budget: int = 800,
+                 summarizer: Optional[Callable[[str, List[Dict[str, Any]]], str]] = None):
+        """
+        初始化对话记忆
+
+        Args:
+            session_id: 会话标识
+            db_path: 转存历史记录的数据库
+            max_turns_in_memory: 内存中最多保留的历史条数
+            recent_turns: 原样放入对话背景的最近轮数
+            token_budget: 对话背景（摘要+最近几轮）的token上限
+            summarizer: 摘要函数 (已有摘要, 新移出的轮次) -> 新摘要，可用廉价模型调用；默认本地摘要
+        """
+        self.session_id = session_id
+        self.db_path = db_path
+        self.max_turns_in_memory = max_turns_in_memory
+        self.recent_turns = recent_turns
+        self.token_budget = token_budget
+        self.summarizer = summarizer
+        self.turns: List[Dict[str, Any]] = []  # 内存中的历史（最新的在末尾）
+        self.summary = ""
+        self.summarized_count = 0  # 已压缩进摘要的轮数（按全部历史计）
+        self.total_turns = 0
+        self.lock = threading.Lock()
+        self.init_database()
+
+    def _connect(self):
+        """创建数据库连接"""
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def init_database(self) -> None:
+        """创建历史记录转存表"""
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS qa_conversation_history
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      session_id TEXT NOT NULL,
+                      turn_index INTEGER NOT NULL,
+                      record TEXT NOT NULL,
+                      created_at TIMESTAMP)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_conversation_session
+                     ON qa_conversation_history(session_id, turn_index)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_conversation_created
+                     ON qa_conversation_history(created_at)''')
+        conn.commit()
+        conn.close()
+
+    def add_turn(self, turn: Dict[str, Any]) -> None:
+        """记录一轮问答（至少包含question和answer），必要时更新摘要并转存旧记录"""
+        with self.lock:
+            self.turns.append(turn)
+            self.total_turns += 1
+
+            # 移出最近几轮窗口的对话压缩进摘要
+            pending_count = self.total_turns - self.recent_turns - self.summarized_count
+            if pending_count > 0:
+                start = len(self.turns) - self.recent_turns - pending_count
+                self._update_summary(self.turns[start:start + pending_count])
+                self.summarized_count += pending_count
+
+            if len(self.turns) > self.max_turns_in_memory:
+                overflow = len(self.turns) - self.max_turns_in_memory
+                self._spill(self.turns[:overflow], self.total_turns - len(self.turns))
+                del self.turns[:overflow]
+
+    def _update_summary(self, turns: List[Dict[str, Any]]) -> None:
+        """更新滚动摘要，超出预算时保留较新的部分"""
+        summary = None
+        if self.summarizer is not None:
+            try:
+                summary = self.summarizer(self.summary, turns)
+            except Exception as e:
+                print(f"WARNING: 对话摘要生成失败，使用本地摘要: {str(e)}")
+        if not summary:
+            summary = summarize_locally(self.summary, turns)
+        # 摘要最多占对话背景预算的一半，其余留给最近几轮；超出时先整行丢弃最早的内容
+        summary_budget = self.token_budget // 2
+        lines = summary.split('\n')
+        while len(lines) > 1 and estimate_tokens('\n'.join(lines)) > summary_budget:
+            lines.pop(0)
+        self.summary = _truncate_to_tokens('\n'.join(lines), summary_budget, keep_tail=True)
+
+    def _spill(self, turns: List[Dict[str, Any]], first_index: int) -> None:
+        """将较早的历史记录转存到数据库"""
+        try:
+            conn = self._connect()
+            c = conn.cursor()
+            c.executemany('''INSERT INTO qa_conversation_history (session_id, turn_index, record, created_at)
+                             VALUES (?, ?, ?, ?)''',
+                          [(self.session_id, first_index + offset, json.dumps(turn, ensure_ascii=False, default=str),
+                            datetime.now()) for offset, turn in enumerate(turns)])
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"ERROR: 对话历史转存失败: {str(e)}")
+
+    def build_context(self) -> str:
+        """构建对话背景（摘要+最近几轮），不超过token预算；没有历史时返回空字符串"""
+        with self.lock:
+            recent = self.turns[-self.recent_turns:] if self.recent_turns > 0 else []
+            summary = self.summary
+
+        parts = []
+        used_tokens = 0
+        if summary:
+            parts.append(f"较早对话摘要：\n{summary}")
+            used_tokens += estimate_tokens(parts[0])
+
+        # 从最近一轮往前放入，剩余预算在尚未放入的轮次间平分，放不下时截断回答
+        recent_header = "最近对话："
+        used_tokens += estimate_tokens(recent_header)
+        recent_parts = []
+        for position, turn in enumerate(reversed(recent)):
+            allowance = (self.token_budget - used_tokens) // (len(recent) - position)
+            question_part = f"用户：{turn['question']}\n助手："
+            question_tokens = estimate_tokens(question_part)
+            if question_tokens >= allowance:
+                break
+            answer = _truncate_to_tokens(turn.get('answer', ''), allowance - question_tokens)
+            recent_parts.append(question_part + answer)
+            used_tokens += question_tokens + estimate_tokens(answer)
+        if recent_parts:
+            parts.append(recent_header + "\n" + "\n".join(reversed(recent_parts)))
+        return "\n\n".join(parts)
+
+    def load_all(self) -> List[Dict[str, Any]]:
+        """读取完整历史（数据库中转存的记录+内存中的记录），按时间先后排列"""
+        try:
+            conn = self._connect()
+            c = conn.cursor()
+            c.execute('''SELECT record FROM qa_conversation_history
+                         WHERE session_id = ? ORDER BY turn_index''', (self.session_id,))
+            spilled = [json.loads(row[0]) for row in c.fetchall()]
+            conn.close()
+        except Exception as e:
+            print(f"ERROR: 读取对话历史失败: {str(e)}")
+            spilled = []
+        with self.lock:
+            return spilled + list(self.turns)
+
+    def clear(self) -> None:
+        """清空会话历史、摘要和转存记录"""
+        with self.lock:
+            self.turns = []
+            self.summary = ""
+            self.summarized_count = 0
+            self.total_turns = 0
+        try:
+            conn = self._connect()
+            c = conn.cursor()
+            c.execute("DELETE FROM qa_conversation_history WHERE session_id = ?", (self.session_id,))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"ERROR: 清空对话历史失败: {str(e)}")
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+常见问题库
+保存常见问题及预先生成的回答，问答时先用知识库的分词和向量方法匹配常见问题，
+命中时直接返回已有回答，不检索也不调用API；回答由离线批量任务生成和刷新，重启后仍然有效；
+命中次数先在内存中累计，再分批写入数据库，问答路径上不开写事务
+
+用法：
+    python faq_store.py add "水稻怎么施肥？" "如何防治稻瘟病？"
+    python faq_store.py import faq_questions.txt
+    python faq_store.py refresh --api-key sk-xxx --concurrency 4
+    python faq_store.py list
+"""
+
+from typing import Any, Dict, List, Optional, TYPE_CHECKING
+from collections import Counter
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from rag_knowledge_base_simple import (QUERY_STOP_CHARS, SimpleRAGKnowledgeBase, iter_batches,
+                                       log_error, log_info, log_success, log_warning)
+from semantic_cache import normalize_question, question_entities
+
+if TYPE_CHECKING:
+    from rag_qa_system_simple import SimpleRAGQASystem
+
+# 问题与常见问题的余弦相似度达到该值才视为同一问题
+FAQ_MATCH_THRESHOLD = 0.9
+
+# 内存中累计的命中次数达到该数量或距上次写入超过该时间（秒）时写入数据库
+FAQ_HIT_FLUSH_SIZE = 50
+FAQ_HIT_FLUSH_INTERVAL = 60
+# 问答路径上写入命中次数时等待写锁的时间（秒），拿不到锁时留到下次写入
+FAQ_HIT_FLUSH_TIMEOUT = 0.1
+
+
+class FAQStore:
+    """常见问题及预生成回答（与知识库共用数据库）"""
+
+    def __init__(self, knowledge_base: SimpleRAGKnowledgeBase, threshold: float = FAQ_MATCH_THRESHOLD):
+        self.knowledge_base = knowledge_base
+        self.threshold = threshold
+        self.pending_hits: Counter = Counter()  # 尚未写入数据库的命中次数
+        self.last_flush = time.monotonic()
+        self.hits_lock = threading.Lock()
+        self.init_database()
+
+    def init_database(self) -> None:
+        """创建常见问题表和问题词倒排索引"""
+        conn = self.knowledge_base._connect()
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS faq_entries
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      question TEXT NOT NULL,
+                      normalized TEXT UNIQUE NOT NULL,
+                      norm REAL NOT NULL,
+                      answer TEXT,
+                      source TEXT,
+                      index_version INTEGER,
+                      hit_count INTEGER DEFAULT 0,
+                      created_at TIMESTAMP,
+                      answered_at TIMESTAMP)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS faq_postings
+                     (term TEXT NOT NULL,
+                      faq_id INTEGER NOT NULL,
+                      weight REAL NOT NULL,
+                      PRIMARY KEY (term, faq_id))''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_faq_postings_faq ON faq_postings(faq_id)")
+        conn.commit()
+        conn.close()
+
+    def _question_vector(self, question: str) -> Dict[str, float]:
+        """问题向量：去掉疑问词和停用字后，用知识库的分词和词频方法计算"""
+        normalized = normalize_question(question)
+        vector = self.knowledge_base._compute_vector(normalized)
+        return {term: weight for term, weight in vector.items() if term not in QUERY_STOP_CHARS} or vector
+
+    def add_questions(self, questions: List[str]) -> int:
+        """添加常见问题（已存在的同义问题跳过），返回新增数"""
+        conn = self.knowledge_base._connect()
+        c = conn.cursor()
+        added = 0
+        try:
+            for question in questions:
+                question = question.strip()
+                normalized = normalize_question(question)
+                if not normalized:
+                    continue
+                vector = self._question_vector(question)
+                c.execute('''INSERT OR IGNORE INTO faq_entries (question, normalized, norm, created_at)
+                             VALUES (?, ?, ?, ?)''',
+                          (question, normalized, self.knowledge_base.vector_norm(vector), datetime.now()))
+                if c.rowcount == 0:
+                    continue
+                faq_id = c.lastrowid
+                c.executemany("INSERT INTO faq_postings (term, faq_id, weight) VALUES (?, ?, ?)",
+                              [(term, faq_id, weight) for term, weight in vector.items()])
+                added += 1
+            conn.commit()
+        finally:
+            conn.close()
+        log_success(f"新增 {added} 个常见问题")
+        return added
+
+    def remove_question(self, faq_id: int) -> bool:
+        """删除常见问题"""
+        conn = self.knowledge_base._connect()
+        c = conn.cursor()
+        c.execute("DELETE FROM faq_postings WHERE faq_id = ?", (faq_id,))
+        c.execute("DELETE FROM faq_entries WHERE id = ?", (faq_id,))
+        removed = c.rowcount > 0
+        conn.commit()
+        conn.close()
+        return removed
+
+    def match(self, question: str) -> Optional[Dict[str, Any]]:
+        """
+        查找与问题匹配且已有回答的常见问题
+
+        Returns:
+            包含id、question、answer、source、similarity的字典，未命中返回None
+        """
+        vector = self._question_vector(question)
+        if not vector:
+            return None
+        entities = question_entities(normalize_question(question))
+        query_norm = self.knowledge_base.vector_norm(vector)
+
+        try:
+            conn = self.knowledge_base._connect()
+            c = conn.cursor()
+            scores: Dict[int, float] = {}
+            for terms in iter_batches(list(vector)):
+                placeholders = ','.join('?' * len(terms))
+                c.execute(f"SELECT term, faq_id, weight FROM faq_postings WHERE term IN ({placeholders})", terms)
+                for term, faq_id, weight in c.fetchall():
+                    scores[faq_id] = scores.get(faq_id, 0.0) + vector[term] * weight
+            if not scores:
+                conn.close()
+                return None
+
+            # 只需核对点积最高的几个候选
+            candidates = sorted(scores, key=scores.get, reverse=True)[:5]
+            placeholders = ','.join('?' * len(candidates))
+            c.execute(f'''SELECT id, question, answer, source, norm FROM faq_entries
+                          WHERE id IN ({placeholders}) AND answer IS NOT NULL''', candidates)
+            best = None
+            for faq_id, faq_question, answer, source, norm in c.fetchall():
+                # 作物、病害或数值不同的常见问题字面再相近也不能返回其回答
+                if question_entities(normalize_question(faq_question)) != entities:
+                    continue
+                similarity = scores[faq_id] / (query_norm * norm) if norm else 0.0
+                if similarity >= self.threshold and (best is None or similarity > best['similarity']):
+                    best = {'id': faq_id, 'question': faq_question, 'answer': answer,
+                            'source': source, 'similarity': similarity}
+            conn.close()
+        except Exception as e:
+            log_error(f"常见问题匹配失败: {str(e)}")
+            return None
+
+        if best is not None:
+            self._record_hit(best['id'])
+        return best
+
+    def _record_hit(self, faq_id: int) -> None:
+        """在内存中累计命中次数，累计较多或间隔较久时尝试写入（拿不到写锁时不等待）"""
+        with self.hits_lock:
+            self.pending_hits[faq_id] += 1
+            due = (sum(self.pending_hits.values()) >= FAQ_HIT_FLUSH_SIZE
+                   or time.monotonic() - self.last_flush >= FAQ_HIT_FLUSH_INTERVAL)
+        if due:
+            self.flush_hits(timeout=FAQ_HIT_FLUSH_TIMEOUT)
+
+    def flush_hits(self, timeout: Optional[float] = None) -> int:
+        """
+        将内存中累计的命中次数写入数据库，写入失败时保留到下次
+
+        Args:
+            timeout: 等待写锁的时间（秒），默认使用知识库连接的超时
+
+        Returns:
+            写入的命中次数
+        """
+        with self.hits_lock:
+            hits = self.pending_hits
+            self.pending_hits = Counter()
+            self.last_flush = time.monotonic()
+        if not hits:
+            return 0
+        try:
+            if timeout is None:
+                conn = self.knowledge_base._connect()
+            else:
+                conn = sqlite3.connect(self.knowledge_base.db_path, timeout=timeout)
+            conn.executemany("UPDATE faq_entries SET hit_count = hit_count + ? WHERE id = ?",
+                             [(count, faq_id) for faq_id, count in hits.items()])
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            log_warning(f"常见问题命中次数写入失败，稍后重试: {str(e)}")
+            with self.hits_lock:
+                self.pending_hits.update(hits)
+            return 0
+        return sum(hits.values())
+
+    def list_questions(self) -> List[Dict[str, Any]]:
+        """列出全部常见问题（按命中次数排序）"""
+        self.flush_hits()
+        conn = self.knowledge_base._connect()
+        c = conn.cursor()
+        c.execute('''SELECT id, question, answer IS NOT NULL, source, index_version, hit_count, answered_at
+                     FROM faq_entries ORDER BY hit_count DESC, id''')
+        rows = [{
+            'id': row[0], 'question': row[1], 'answered': bool(row[2]), 'source': row[3],
+            'index_version': row[4], 'hit_count': row[5], 'answered_at': row[6]
+        } for row in c.fetchall()]
+        conn.close()
+        return rows
+
+    def refresh(self, qa_system: 'SimpleRAGQASystem', api_key: Optional[str] = None, concurrency: int = 4,
+                stale_only: bool = True) -> Dict[str, Any]:
+        """
+        离线批量生成常见问题的回答
+
+        Args:
+            qa_system: 用于生成回答的问答系统
+            api_key: API密钥
+            concurrency: 并发调用数
+            stale_only: 只刷新没有回答或知识库已变化后未更新的问题
+        """
+        index_version = self.knowledge_base.get_index_version()
+        conn = self.knowledge_base._connect()
+        c = conn.cursor()
+        if stale_only:
+            c.execute('''SELECT id, question FROM faq_entries
+                         WHERE answer IS NULL OR index_version IS NULL OR index_version != ?''', (index_version,))
+        else:
+            c.execute("SELECT id, question FROM faq_entries")
+        entries = c.fetchall()
+        conn.close()
+        if not entries:
+            log_info("没有需要刷新的常见问题")
+            return {'refreshed': 0, 'failed': 0, 'stats': None}
+
+        batch = qa_system.answer_many([question for _, question in entries], concurrency=concurrency,
+                                      api_key=api_key)
+        updates = [(result['answer'], result['source'], index_version, datetime.now(), faq_id)
+                   for (faq_id, _), result in zip(entries, batch['results']) if 'error' not in result]
+
+        conn = self.knowledge_base._connect()
+        c = conn.cursor()
+        c.executemany('''UPDATE faq_entries SET answer = ?, source = ?, index_version = ?, answered_at = ?
+                         WHERE id = ?''', updates)
+        conn.commit()
+        conn.close()
+
+        failed = len(entries) - len(updates)
+        if failed:
+            log_warning(f"{failed} 个常见问题回答生成失败，保留原回答")
+        log_success(f"已刷新 {len(updates)} 个常见问题的回答")
+        return {'refreshed': len(updates), 'failed': failed, 'stats': batch['stats']}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="常见问题库管理")
+    parser.add_argument("--db", default="crop_health.db", help="数据库文件路径")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    add_parser = subparsers.add_parser("add", help="添加常见问题")
+    add_parser.add_argument("questions", nargs="+", help="问题")
+
+    import_parser = subparsers.add_parser("import", help="从文本文件导入常见问题（每行一个）")
+    import_parser.add_argument("path", help="问题文件路径")
+
+    refresh_parser = subparsers.add_parser("refresh", help="批量生成或刷新回答")
+    refresh_parser.add_argument("--api-key", required=True, help="硅基流动API密钥")
+    refresh_parser.add_argument("--concurrency", type=int, default=4, help="并发调用数")
+    refresh_parser.add_argument("--all", action="store_true", help="刷新全部问题（默认只刷新过期的）")
+
+    remove_parser = subparsers.add_parser("remove", help="删除常见问题")
+    remove_parser.add_argument("faq_id", type=int, help="常见问题ID")
+
+    subparsers.add_parser("list", help="列出常见问题")
+    args = parser.parse_args()
+
+    knowledge_base = SimpleRAGKnowledgeBase(db_path=args.db, async_ingestion=False)
+    store = FAQStore(knowledge_base)
+    if args.action == "add":
+        store.add_questions(args.questions)
+    elif args.action == "import":
+        with open(args.path, 'r', encoding='utf-8') as f:
+            store.add_questions([line for line in f if line.strip()])
+    elif args.action == "refresh":
+        from rag_qa_system_simple import SimpleRAGQASystem
+        qa_system = SimpleRAGQASystem(args.api_key, db_path=args.db)
+        summary = store.refresh(qa_system, concurrency=args.concurrency, stale_only=not args.all)
+        log_info(json.dumps(summary, ensure_ascii=False, indent=2))
+    elif args.action == "remove":
+        if not store.remove_question(args.faq_id):
+            log_warning(f"常见问题 {args.faq_id} 不存在")
+    else:
+        for entry in store.list_questions():
+            status = "已回答" if entry['answered'] else "待生成"
+            print(f"[{entry['id']}] {entry['question']}  ({status}, 命中 {entry['hit_count']} 次)")
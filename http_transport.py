@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+共享HTTP传输层
+所有外部API调用共用一个带连接池的keep-alive会话，避免每次请求重新建立TCP和TLS连接；
+按调用名称记录每次请求的耗时、收发字节数和状态码
+"""
+
+from typing import Any, Dict, Optional
+from collections import Counter
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from tracing import LatencyHistograms, annotate
+
+# 默认连接池和超时设置
+DEFAULT_POOL_CONNECTIONS = 10   # 缓存连接池的主机数
+DEFAULT_POOL_MAXSIZE = 20       # 每个主机保持的最大连接数（应不小于并发线程数）
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+
+class HTTPTransport:
+    """线程安全的共享HTTP会话及调用统计"""
+
+    def __init__(self, pool_connections: int = DEFAULT_POOL_CONNECTIONS, pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT, read_timeout: float = DEFAULT_READ_TIMEOUT):
+        """
+        初始化传输层
+
+        Args:
+            pool_connections: 缓存连接池的主机数
+            pool_maxsize: 每个主机的最大连接数，超出时请求等待空闲连接
+            connect_timeout: 默认连接超时（秒）
+            read_timeout: 默认读取超时（秒）
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.lock = threading.Lock()
+        self.latencies = LatencyHistograms()
+        self.calls: Dict[str, Dict[str, Any]] = {}
+
+    def request(self, method: str, url: str, name: Optional[str] = None, timeout: Any = None,
+                **kwargs) -> requests.Response:
+        """
+        发送请求（参数与requests.request相同），网络异常照常抛出
+
+        Args:
+            name: 统计用的调用名称，默认使用URL路径
+            timeout: 超时设置，默认使用传输层的连接/读取超时
+        """
+        name = name or url.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        response = None
+        error = None
+        try:
+            response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+            return response
+        except requests.exceptions.RequestException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self._record(name, (time.perf_counter() - started) * 1000, response, error,
+                         streamed=kwargs.get('stream', False))
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """发送GET请求"""
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """发送POST请求"""
+        return self.request("POST", url, **kwargs)
+
+    def _record(self, name: str, latency_ms: float, response: Optional[requests.Response],
+                error: Optional[str], streamed: bool = False) -> None:
+        """记录一次调用（流式响应的耗时为收到响应头的时间，字节数取Content-Length）"""
+        sent_bytes = 0
+        received_bytes = 0
+        status = error or 'unknown'
+        if response is not None:
+            status = str(response.status_code)
+            body = response.request.body if response.request is not None else None
+            sent_bytes = len(body) if body else 0
+            content_length = response.headers.get('Content-Length')
+            if content_length and content_length.isdigit():
+                received_bytes = int(content_length)
+            elif not streamed:
+                received_bytes = len(response.content)
+        failed = error is not None or (response is not None and response.status_code >= 400)
+        self.record(name, latency_ms, status, sent_bytes, received_bytes, failed)
+
+    def record(self, name: str, latency_ms: float, status: str, bytes_sent: int = 0, bytes_received: int = 0,
+               failed: bool = False) -> None:
+        """记录一次调用（也供不经过本会话的客户端，如异步客户端，汇总到同一统计中）"""
+        annotate(http_status=status)
+        self.latencies.record(name, latency_ms)
+        with self.lock:
+            stats = self.calls.get(name)
+            if stats is None:
+                stats = self.calls[name] = {'count': 0, 'errors': 0, 'bytes_sent': 0, 'bytes_received': 0,
+                                            'status': Counter()}
+            stats['count'] += 1
+            stats['errors'] += failed
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+            stats['status'][status] += 1
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """按调用名称汇总的次数、错误数、字节数、状态码分布和耗时分位数（毫秒）"""
+        latency_stats = self.latencies.get_stats()
+        with self.lock:
+            return {
+                name: {
+                    'count': stats['count'],
+                    'errors': stats['errors'],
+                    'bytes_sent': stats['bytes_sent'],
+                    'bytes_received': stats['bytes_received'],
+                    'status': dict(stats['status']),
+                    'latency_ms': latency_stats.get(name, {})
+                }
+                for name, stats in self.calls.items()
+            }
+
+    def close(self) -> None:
+        """关闭会话及其连接池"""
+        self.session.close()
+
+
+# 进程内共享的传输层
+_transport: Optional[HTTPTransport] = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> HTTPTransport:
+    """获取共享的传输层（首次调用时按默认设置创建）"""
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = HTTPTransport()
+        return _transport
+
+
+def configure_transport(**kwargs) -> HTTPTransport:
+    """按新的连接池和超时设置替换共享传输层（参数同HTTPTransport）"""
+    global _transport
+    with _transport_lock:
+        previous = _transport
+        _transport = HTTPTransport(**kwargs)
+    if previous is not None:
+        previous.close()
+    return _transport
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上传视觉模型前的图像预处理
+按最长边缩小分辨率、以指定质量重新压缩为JPEG并去除EXIF信息，减小请求体积和模型耗时；
+每张图像记录压缩前后的字节数，便于在样本集上权衡图像大小与识别准确率
+
+用法：
+    python image_preprocess.py samples/ --max-long-edge 1024 --jpeg-quality 80
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+import argparse
+import io
+import os
+
+# 尝试导入Pillow，如果失败则不做预处理，直接上传原图
+try:
+    from PIL import Image, ImageOps
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+# 默认设置：最长边1568像素时视觉模型的识别效果基本不受影响
+DEFAULT_MAX_LONG_EDGE = 1568
+DEFAULT_JPEG_QUALITY = 85
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+class ImagePreprocessor:
+    """图像缩放、重新压缩和EXIF去除"""
+
+    def __init__(self, max_long_edge: Optional[int] = DEFAULT_MAX_LONG_EDGE,
+                 jpeg_quality: int = DEFAULT_JPEG_QUALITY, strip_exif: bool = True, enabled: bool = True):
+        """
+        初始化预处理设置
+
+        Args:
+            max_long_edge: 最长边像素上限，None表示不缩放
+            jpeg_quality: JPEG压缩质量（1-95）
+            strip_exif: 是否去除EXIF等元数据（去除前先按EXIF方向旋正图像）
+            enabled: 是否启用预处理；关闭或未安装Pillow时直接使用原图
+        """
+        self.max_long_edge = max_long_edge
+        self.jpeg_quality = jpeg_quality
+        self.strip_exif = strip_exif
+        self.enabled = enabled
+
+    def process(self, image_path: str) -> Tuple[bytes, Dict[str, Any]]:
+        """
+        读取并预处理图像
+
+        Returns:
+            (图像字节, 统计信息)，统计信息包含original_bytes、processed_bytes、bytes_saved、
+            original_size、processed_size、processed（是否使用了预处理结果）
+        """
+        with open(image_path, "rb") as image_file:
+            original = image_file.read()
+        stats = {
+            'original_bytes': len(original),
+            'processed_bytes': len(original),
+            'bytes_saved': 0,
+            'original_size': None,
+            'processed_size': None,
+            'processed': False
+        }
+        if not self.enabled or not HAS_PIL:
+            return original, stats
+
+        try:
+            with Image.open(io.BytesIO(original)) as image:
+                stats['original_size'] = image.size
+                has_metadata = bool(image.info.get('exif') or image.info.get('icc_profile'))
+                if self.strip_exif:
+                    # 手机照片的方向记录在EXIF中，去除前先旋正
+                    image = ImageOps.exif_transpose(image)
+                resized = False
+                if self.max_long_edge and max(image.size) > self.max_long_edge:
+                    image.thumbnail((self.max_long_edge, self.max_long_edge), Image.LANCZOS)
+                    resized = True
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+
+                save_options = {'format': 'JPEG', 'quality': self.jpeg_quality, 'optimize': True}
+                if not self.strip_exif and image.info.get('exif'):
+                    save_options['exif'] = image.info['exif']
+                buffer = io.BytesIO()
+                image.save(buffer, **save_options)
+                processed = buffer.getvalue()
+                processed_size = image.size
+        except Exception as e:
+            print(f"WARNING: 图像预处理失败，使用原图: {str(e)}")
+            return original, stats
+
+        # 未缩放、无需去除元数据且重新压缩后反而更大时保留原图
+        if not resized and not (self.strip_exif and has_metadata) and len(processed) >= len(original):
+            stats['processed_size'] = stats['original_size']
+            return original, stats
+
+        stats.update({
+            'processed_bytes': len(processed),
+            'bytes_saved': len(original) - len(processed),
+            'processed_size': processed_size,
+            'processed': True
+        })
+        return processed, stats
+
+
+def preprocess_directory(directory: str, preprocessor: ImagePreprocessor) -> List[Dict[str, Any]]:
+    """预处理目录下的全部图像（不写回文件），返回每张图像的统计信息"""
+    results = []
+    for name in sorted(os.listdir(directory)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        _, stats = preprocessor.process(os.path.join(directory, name))
+        stats['file'] = name
+        results.append(stats)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="统计样本图像预处理前后的大小")
+    parser.add_argument("directory", help="样本图像目录")
+    parser.add_argument("--max-long-edge", type=int, default=DEFAULT_MAX_LONG_EDGE, help="最长边像素上限，0表示不缩放")
+    parser.add_argument("--jpeg-quality", type=int, default=DEFAULT_JPEG_QUALITY, help="JPEG压缩质量")
+    parser.add_argument("--keep-exif", action="store_true", help="保留EXIF信息")
+    args = parser.parse_args()
+
+    if not HAS_PIL:
+        print("ERROR: 未安装Pillow，无法预处理图像")
+        raise SystemExit(1)
+
+    preprocessor = ImagePreprocessor(max_long_edge=args.max_long_edge or None, jpeg_quality=args.jpeg_quality,
+                                     strip_exif=not args.keep_exif)
+    results = preprocess_directory(args.directory, preprocessor)
+    for stats in results:
+        print(f"{stats['file']}: {stats['original_size']} -> {stats['processed_size']}, "
+              f"{stats['original_bytes'] / 1024:.1f} KB -> {stats['processed_bytes'] / 1024:.1f} KB")
+    total_original = sum(stats['original_bytes'] for stats in results)
+    total_processed = sum(stats['processed_bytes'] for stats in results)
+    if total_original:
+        print(f"共 {len(results)} 张图像，{total_original / 1024:.1f} KB -> {total_processed / 1024:.1f} KB，"
+              f"节省 {(1 - total_processed / total_original) * 100:.1f}%")
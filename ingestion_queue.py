@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+知识库文档异步处理队列
+上传时只保存原始文档，分块、关键词提取和索引构建交给后台工作线程完成
+"""
+
+from typing import Callable, Dict, Optional
+import os
+import queue
+import threading
+import time
+
+
+class IngestionQueue:
+    """线程安全的文档处理队列（后台工作线程池）"""
+
+    def __init__(self, processor: Callable[[int], bool], num_workers: int = 2,
+                 on_complete: Optional[Callable[[int, bool], None]] = None):
+        """
+        初始化处理队列
+
+        Args:
+            processor: 处理单个文档的函数，参数为文档ID，返回是否成功
+            num_workers: 后台工作线程数
+            on_complete: 文档处理结束后的回调，参数为文档ID和是否成功
+        """
+        self.processor = processor
+        self.num_workers = max(1, num_workers)
+        self.on_complete = on_complete
+        self.tasks = queue.Queue()
+        self.queued = set()  # 已入队尚未开始处理的文档ID，避免重复入队
+        self.running = set()  # 正在处理的文档ID
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.processed_count = 0
+        self.failed_count = 0
+        self.workers = []
+
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self._worker_loop,
+                                      name=f"kb-ingest-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, document_id: int) -> bool:
+        """
+        提交文档处理任务
+
+        Returns:
+            是否新入队（已在队列中的文档返回False）
+        """
+        with self.lock:
+            # 正在处理的文档允许再次入队，保证处理期间的更新不会丢失
+            if document_id in self.queued:
+                return False
+            self.queued.add(document_id)
+        self.tasks.put(document_id)
+        return True
+
+    def _worker_loop(self) -> None:
+        """工作线程主循环"""
+        while True:
+            document_id = self.tasks.get()
+            with self.lock:
+                self.queued.discard(document_id)
+                self.running.add(document_id)
+            success = False
+            try:
+                success = bool(self.processor(document_id))
+            except Exception as e:
+                print(f"ERROR: 后台处理文档 {document_id} 失败: {str(e)}")
+            finally:
+                # 先执行回调（如清理搜索缓存），再标记完成，保证等待方看到的是最新状态
+                if self.on_complete is not None:
+                    try:
+                        self.on_complete(document_id, success)
+                    except Exception as e:
+                        print(f"ERROR: 文档处理回调失败: {str(e)}")
+
+                with self.lock:
+                    self.running.discard(document_id)
+                    if success:
+                        self.processed_count += 1
+                    else:
+                        self.failed_count += 1
+                    self.idle.notify_all()
+                self.tasks.task_done()
+
+    def is_pending(self, document_id: int) -> bool:
+        """检查文档是否仍在排队或处理中"""
+        with self.lock:
+            return document_id in self.queued or document_id in self.running
+
+    def pending_count(self) -> int:
+        """获取排队和处理中的文档数"""
+        with self.lock:
+            return len(self.queued | self.running)
+
+    def wait_until_idle(self, timeout: Optional[float] = None) -> bool:
+        """
+        等待队列清空
+
+        Returns:
+            超时前队列是否已清空
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while self.queued or self.running:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.idle.wait(remaining)
+            return True
+
+    def get_stats(self) -> Dict[str, int]:
+        """获取队列统计信息"""
+        with self.lock:
+            return {
+                'workers': self.num_workers,
+                'pending': len(self.queued | self.running),
+                'processed_count': self.processed_count,
+                'failed_count': self.failed_count
+            }
+
+
+# 每个数据库文件共享一个处理队列，避免每个会话各自启动工作线程
+_queues: Dict[str, IngestionQueue] = {}
+_queues_lock = threading.Lock()
+
+
+def get_ingestion_queue(db_path: str, processor: Callable[[int], bool], num_workers: int = 2,
+                        on_complete: Optional[Callable[[int, bool], None]] = None) -> IngestionQueue:
+    """获取或创建指定数据库的处理队列"""
+    key = os.path.abspath(db_path)
+    with _queues_lock:
+        if key not in _queues:
+            _queues[key] = IngestionQueue(processor, num_workers, on_complete)
+        return _queues[key]
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+知识库索引文件导出与导入
+将文档、片段、向量、倒排索引和签名打包为一个带版本和校验和的归档文件，
+新节点导入时直接批量写入，无需逐个片段重新处理
+"""
+
+from typing import Any, Dict, Optional
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+from datetime import datetime
+
+from rag_knowledge_base_simple import (INDEX_FORMAT_VERSION, KNOWLEDGE_BASE_TABLES, LSH_BANDS,
+                                       MINHASH_NUM_PERM, SimpleRAGKnowledgeBase,
+                                       log_error, log_info, log_success)
+
+ARCHIVE_FORMAT = "crop-kb-index"
+ARCHIVE_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+INDEX_DB_NAME = "index.db"
+
+
+def _index_params(knowledge_base: SimpleRAGKnowledgeBase) -> Dict[str, Any]:
+    """影响索引内容的参数，导入时必须与当前程序一致"""
+    return {
+        'index_format_version': INDEX_FORMAT_VERSION,
+        'minhash_num_perm': MINHASH_NUM_PERM,
+        'minhash_shingle_size': knowledge_base.minhasher.shingle_size,
+        'lsh_bands': LSH_BANDS
+    }
+
+
+def _file_sha256(path: str) -> str:
+    """计算文件的SHA-256校验和"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _table_columns(c, schema: str, table: str) -> list:
+    """获取表的列名"""
+    c.execute(f"PRAGMA {schema}.table_info({table})")
+    return [row[1] for row in c.fetchall()]
+
+
+def export_index(knowledge_base: SimpleRAGKnowledgeBase, archive_path: str) -> Optional[Dict[str, Any]]:
+    """
+    导出知识库索引文件
+
+    Returns:
+        归档清单，失败时返回None
+    """
+    temp_dir = tempfile.mkdtemp(prefix="kb_export_")
+    index_path = os.path.join(temp_dir, INDEX_DB_NAME)
+    conn = None
+    try:
+        conn = knowledge_base._connect()
+        c = conn.cursor()
+        c.execute("ATTACH DATABASE ? AS artifact", (index_path,))
+
+        # 在同一个读事务中复制所有表，保证导出的是一致的快照
+        c.execute("BEGIN")
+        table_counts = {}
+        for table in KNOWLEDGE_BASE_TABLES:
+            c.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,))
+            ddl = c.fetchone()[0]
+            c.execute(ddl.replace(f"CREATE TABLE {table}", f"CREATE TABLE artifact.{table}", 1))
+            c.execute(f"INSERT INTO artifact.{table} SELECT * FROM main.{table}")
+            table_counts[table] = c.rowcount
+        conn.commit()
+        c.execute("DETACH DATABASE artifact")
+        conn.close()
+        conn = None
+
+        manifest = {
+            'format': ARCHIVE_FORMAT,
+            'archive_version': ARCHIVE_VERSION,
+            'created_at': datetime.now().isoformat(),
+            'index_params': _index_params(knowledge_base),
+            'tables': table_counts,
+            'index_db_sha256': _file_sha256(index_path),
+            'index_db_size': os.path.getsize(index_path)
+        }
+
+        with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(MANIFEST_NAME, json.dumps(manifest, ensure_ascii=False, indent=2))
+            archive.write(index_path, INDEX_DB_NAME)
+
+        log_success(f"知识库索引已导出到 {archive_path}：{table_counts.get('knowledge_documents', 0)} 个文档")
+        return manifest
+
+    except Exception as e:
+        log_error(f"导出知识库索引失败: {str(e)}")
+        try:
+            if conn:
+                conn.rollback()
+                conn.close()
+        except:
+            pass
+        return None
+    finally:
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        os.rmdir(temp_dir)
+
+
+def import_index(knowledge_base: SimpleRAGKnowledgeBase, archive_path: str, replace: bool = False) -> bool:
+    """
+    导入知识库索引文件（校验版本和校验和后批量写入）
+
+    Args:
+        knowledge_base: 导入目标知识库
+        archive_path: 归档文件路径
+        replace: 知识库非空时是否清空后导入
+    """
+    temp_dir = tempfile.mkdtemp(prefix="kb_import_")
+    index_path = os.path.join(temp_dir, INDEX_DB_NAME)
+    conn = None
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            manifest = json.loads(archive.read(MANIFEST_NAME).decode('utf-8'))
+            if manifest.get('format') != ARCHIVE_FORMAT or manifest.get('archive_version') != ARCHIVE_VERSION:
+                log_error(f"不支持的索引文件格式: {manifest.get('format')} v{manifest.get('archive_version')}")
+                return False
+            if manifest.get('index_params') != _index_params(knowledge_base):
+                log_error(f"索引参数不一致，无法导入: {manifest.get('index_params')}")
+                return False
+            archive.extract(INDEX_DB_NAME, temp_dir)
+
+        if _file_sha256(index_path) != manifest['index_db_sha256']:
+            log_error("索引文件校验和不匹配，文件可能已损坏")
+            return False
+
+        conn = knowledge_base._connect()
+        c = conn.cursor()
+        c.execute("ATTACH DATABASE ? AS artifact", (index_path,))
+
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT COUNT(*) FROM main.knowledge_documents")
+        if c.fetchone()[0] > 0:
+            if not replace:
+                log_error("知识库不为空，如需覆盖请指定replace=True")
+                conn.rollback()
+                conn.close()
+                return False
+            for table in KNOWLEDGE_BASE_TABLES:
+                c.execute(f"DELETE FROM main.{table}")
+
+        for table in KNOWLEDGE_BASE_TABLES:
+            # 按列名对齐，兼容列顺序不同的数据库
+            columns = [column for column in _table_columns(c, 'artifact', table)
+                       if column in set(_table_columns(c, 'main', table))]
+            column_list = ', '.join(columns)
+            c.execute(f"INSERT INTO main.{table} ({column_list}) SELECT {column_list} FROM artifact.{table}")
+            if c.rowcount != manifest['tables'].get(table):
+                raise ValueError(f"表 {table} 行数与清单不一致")
+
+        knowledge_base._bump_index_version(c)
+        knowledge_base._bump_metadata_version(c)
+        conn.commit()
+        c.execute("DETACH DATABASE artifact")
+        conn.close()
+        conn = None
+
+        knowledge_base.search_cache.clear()
+        knowledge_base.autocomplete_index.invalidate()
+        log_success(f"已导入知识库索引：{manifest['tables'].get('knowledge_documents', 0)} 个文档，"
+                    f"{manifest['tables'].get('chunk_store', 0)} 个唯一片段")
+        return True
+
+    except Exception as e:
+        log_error(f"导入知识库索引失败: {str(e)}")
+        try:
+            if conn:
+                conn.rollback()
+                conn.close()
+        except:
+            pass
+        return False
+    finally:
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        os.rmdir(temp_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="知识库索引文件导出与导入")
+    parser.add_argument("action", choices=["export", "import"], help="导出或导入")
+    parser.add_argument("archive", help="索引文件路径")
+    parser.add_argument("--db", default="crop_health.db", help="数据库文件路径")
+    parser.add_argument("--replace", action="store_true", help="导入时清空已有知识库")
+    args = parser.parse_args()
+
+    knowledge_base = SimpleRAGKnowledgeBase(db_path=args.db, async_ingestion=False)
+    if args.action == "export":
+        result = export_index(knowledge_base, args.archive)
+        if result:
+            log_info(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        import_index(knowledge_base, args.archive, replace=args.replace)
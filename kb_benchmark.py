@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+知识库检索基准测试
+1. 按固定随机种子生成中文农业文档和问题（1k/100k/1M片段规模），结果可复现
+2. 标注问题集格式（JSONL，每行一个问题）：
+   {"id": "q00001", "question": "……", "relevant_documents": ["synthetic_000123.txt"]}
+   relevant_documents为能回答该问题的文档文件名，人工标注的真实问题集使用同一格式
+3. 对每种相似度算法统计recall@k、MRR、搜索延迟p50/p99、导入吞吐量和峰值内存，输出JSON便于对比
+
+用法：
+    python kb_benchmark.py generate bench_1k --scale 1k
+    python kb_benchmark.py run --corpus bench_1k --output result.json
+    python kb_benchmark.py run --db crop_health.db --questions my_questions.jsonl
+"""
+
+from typing import Any, Dict, Iterator, List, Optional
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from rag_knowledge_base_simple import SimpleRAGKnowledgeBase, log_error, log_info, log_success
+
+try:
+    import resource
+    HAS_RESOURCE = True
+except ImportError:  # Windows没有resource模块，不统计峰值内存
+    HAS_RESOURCE = False
+
+# 规模预设：目标片段数
+SCALES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+CHUNKS_PER_DOCUMENT = 4
+CHUNK_CHARS = 400  # 小于chunk_text默认的500字（片段间有重叠），使每篇文档大致切成CHUNKS_PER_DOCUMENT个片段
+RECALL_AT = (1, 3, 5, 10)
+DOCUMENTS_FILE = "documents.jsonl"
+QUESTIONS_FILE = "questions.jsonl"
+
+# 文档内容素材
+CROPS = ['水稻', '玉米', '小麦', '大豆', '棉花', '油菜', '花生', '马铃薯', '番茄', '黄瓜',
+         '辣椒', '茄子', '白菜', '西瓜', '草莓', '苹果', '柑橘', '葡萄', '茶树', '甘薯']
+PROBLEMS = ['稻瘟病', '纹枯病', '赤霉病', '锈病', '白粉病', '根腐病', '灰霉病', '霜霉病', '晚疫病',
+            '炭疽病', '枯萎病', '病毒病', '蚜虫', '红蜘蛛', '蓟马', '棉铃虫', '地老虎', '白粉虱']
+SYMPTOMS = ['叶片出现褐色病斑并逐渐扩大', '植株矮小叶片发黄', '茎基部腐烂变黑', '叶背有白色霉层',
+            '果实表面凹陷并长出霉斑', '新叶卷曲皱缩', '根系变褐须根减少', '叶片失绿并出现黄白色斑点']
+TREATMENTS = ['及时清除病残体并喷施对口杀菌剂', '轮换使用不同作用机理的药剂', '在发生初期用生物农药防治',
+              '加强通风降低田间湿度', '悬挂黄板并释放天敌', '选用抗病品种并进行种子消毒',
+              '合理密植并增施磷钾肥', '雨后及时排水防止积水']
+MANAGEMENT = ['保持土壤湿润但避免积水', '根据土壤检测结果平衡施肥', '定期巡田观察病虫发生情况',
+              '高温时段避免喷药', '收获后深翻土壤减少越冬病源', '苗期适当控水促进根系下扎',
+              '追肥以氮肥为主配合钾肥', '注意天气预报提前做好防灾准备']
+REGIONS = ['东北平原', '华北平原', '长江中下游', '西南山区', '华南丘陵', '西北灌区', '黄淮海地区']
+# 地块名用字：三个字组合出各文档唯一的地块名，使问题只能由对应文档回答
+PLACE_CHARS = ('岚峪泾畈垸圩埠坳岙坪塬垌岗埂沱浦渚汊湾滩洼荡墩坝堰陂'
+               '枫榆杉柏桦杞榕楠樟桐槐椿柳杏梓栎楸桉橡棠芷蘅芸茗蓼'
+               '翠碧黛绯缃绛赭琥珀瑾璋琮瑜瑶玳珂琳璐珈璇琪瑷瑭璞瓒'
+               '鹭鹤鸥雁鹊莺鸾凫鹂鸿麟骐骏驹骅骝貔麒鲲鹏')
+
+
+def _place_name(index: int) -> str:
+    """文档序号对应的唯一地块名（序号经乘法置换打散，相邻序号的地块名不相似）"""
+    base = len(PLACE_CHARS)
+    code = (index * 7919 + 104729) % (base ** 3)
+    return ''.join(PLACE_CHARS[(code // base ** power) % base] for power in range(3)) + '村'
+
+
+def _document_topic(index: int, seed: int) -> Dict[str, str]:
+    """文档的主题（地块、作物、病虫害），只依赖序号和种子"""
+    rng = random.Random(f"{seed}:{index}")
+    return {
+        'place': _place_name(index),
+        'crop': rng.choice(CROPS),
+        'problem': rng.choice(PROBLEMS),
+        'symptom': rng.choice(SYMPTOMS),
+        'treatment': rng.choice(TREATMENTS),
+        'region': rng.choice(REGIONS)
+    }
+
+
+def document_filename(index: int) -> str:
+    """合成文档的文件名"""
+    return f"synthetic_{index:07d}.txt"
+
+
+def generate_document(index: int, seed: int = 42, chunks: int = CHUNKS_PER_DOCUMENT) -> str:
+    """生成一篇合成文档（同一序号和种子总是生成相同内容）"""
+    topic = _document_topic(index, seed)
+    rng = random.Random(f"{seed}:{index}:body")
+    sentences = [
+        f"{topic['place']}{topic['crop']}种植基地位于{topic['region']}，今年种植面积约{rng.randint(50, 900)}亩",
+        f"近期{topic['place']}的{topic['crop']}田块出现{topic['problem']}，主要症状是{topic['symptom']}",
+        f"针对{topic['problem']}，{topic['place']}农技站建议{topic['treatment']}"
+    ]
+    target_chars = chunks * CHUNK_CHARS
+    while sum(len(sentence) + 1 for sentence in sentences) < target_chars:
+        crop = topic['crop'] if rng.random() < 0.5 else rng.choice(CROPS)
+        sentences.append(f"{crop}生长期间应{rng.choice(MANAGEMENT)}，同时{rng.choice(TREATMENTS)}")
+    return '。'.join(sentences) + '。'
+
+
+def generate_question(index: int, seed: int = 42) -> str:
+    """为指定文档生成一个只有该文档能回答的问题"""
+    topic = _document_topic(index, seed)
+    rng = random.Random(f"{seed}:{index}:question")
+    template = rng.choice([
+        "{place}的{crop}出现了{problem}，应该怎么防治？",
+        "{place}{crop}的{problem}有什么症状？",
+        "{place}农技站对{crop}{problem}有什么建议？"
+    ])
+    return template.format(**topic)
+
+
+def iter_documents(num_documents: int, seed: int = 42) -> Iterator[Dict[str, str]]:
+    """逐篇生成合成文档"""
+    for index in range(num_documents):
+        yield {'filename': document_filename(index), 'text': generate_document(index, seed)}
+
+
+def generate_corpus(output_dir: str, scale: str = '1k', num_questions: int = 200,
+                    seed: int = 42) -> Dict[str, Any]:
+    """
+    生成合成文档集和标注问题集
+
+    Args:
+        output_dir: 输出目录（写入documents.jsonl和questions.jsonl）
+        scale: 规模（1k/100k/1m，按片段数计）
+        num_questions: 问题数
+        seed: 随机种子
+    """
+    num_documents = math.ceil(SCALES[scale] / CHUNKS_PER_DOCUMENT)
+    os.makedirs(output_dir, exist_ok=True)
+
+    with open(os.path.join(output_dir, DOCUMENTS_FILE), 'w', encoding='utf-8') as f:
+        for document in iter_documents(num_documents, seed):
+            f.write(json.dumps(document, ensure_ascii=False) + '\n')
+
+    rng = random.Random(seed)
+    sampled = sorted(rng.sample(range(num_documents), min(num_questions, num_documents)))
+    questions = [{
+        'id': f"q{number:05d}",
+        'question': generate_question(index, seed),
+        'relevant_documents': [document_filename(index)]
+    } for number, index in enumerate(sampled, 1)]
+    save_questions(os.path.join(output_dir, QUESTIONS_FILE), questions)
+
+    summary = {'scale': scale, 'target_chunks': SCALES[scale], 'documents': num_documents,
+               'questions': len(questions), 'seed': seed}
+    log_success(f"已生成 {num_documents} 篇文档和 {len(questions)} 个问题: {output_dir}")
+    return summary
+
+
+def load_questions(path: str) -> List[Dict[str, Any]]:
+    """读取标注问题集（跳过空行，缺少字段的问题报错）"""
+    questions = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not item.get('question') or not item.get('relevant_documents'):
+                raise ValueError(f"{path} 第{line_number}行缺少question或relevant_documents")
+            item.setdefault('id', f"q{line_number:05d}")
+            questions.append(item)
+    return questions
+
+
+def save_questions(path: str, questions: List[Dict[str, Any]]) -> None:
+    """保存标注问题集"""
+    with open(path, 'w', encoding='utf-8') as f:
+        for item in questions:
+            f.write(json.dumps(item, ensure_ascii=False) + '\n')
+
+
+def peak_rss_mb() -> Optional[float]:
+    """进程峰值常驻内存（MB），不支持的平台返回None"""
+    if not HAS_RESOURCE:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux单位为KB，macOS为字节
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    """分位数（最近秩法）"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def ingest_corpus(knowledge_base: SimpleRAGKnowledgeBase, documents_path: str) -> Dict[str, Any]:
+    """导入合成文档集并统计吞吐量"""
+    documents = 0
+    failed = 0
+    total_bytes = 0
+    start_time = time.perf_counter()
+    with open(documents_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            document = json.loads(line)
+            content = document['text'].encode('utf-8')
+            if knowledge_base.upload_document(content, document['filename'], wait=True):
+                documents += 1
+                total_bytes += len(content)
+            else:
+                failed += 1
+    elapsed = time.perf_counter() - start_time
+
+    chunks = knowledge_base.get_knowledge_base_stats()['total_chunks']
+    return {
+        'documents': documents,
+        'failed_documents': failed,
+        'chunks': chunks,
+        'seconds': elapsed,
+        'documents_per_second': documents / elapsed if elapsed > 0 else 0.0,
+        'chunks_per_second': chunks / elapsed if elapsed > 0 else 0.0,
+        'mb_per_second': total_bytes / (1024 * 1024) / elapsed if elapsed > 0 else 0.0,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def evaluate_retrieval(knowledge_base: SimpleRAGKnowledgeBase, questions: List[Dict[str, Any]],
+                       top_k: int = max(RECALL_AT)) -> Dict[str, Any]:
+    """
+    评估检索质量和延迟
+
+    每个问题搜索前清空搜索缓存，测量的是未命中缓存时的延迟
+    """
+    recall_sums = {k: 0.0 for k in RECALL_AT if k <= top_k}
+    reciprocal_rank_sum = 0.0
+    latencies = []
+
+    for item in questions:
+        relevant = set(item['relevant_documents'])
+        knowledge_base.search_cache.clear()
+        start_time = time.perf_counter()
+        results = knowledge_base.search_similar_documents(item['question'], top_k=top_k)
+        latencies.append((time.perf_counter() - start_time) * 1000)
+
+        # 同一文档的多个片段只按首次出现计排名
+        ranked_documents = []
+        for result in results:
+            if result['filename'] not in ranked_documents:
+                ranked_documents.append(result['filename'])
+
+        for k in recall_sums:
+            recall_sums[k] += len(relevant & set(ranked_documents[:k])) / len(relevant)
+        for rank, filename in enumerate(ranked_documents, 1):
+            if filename in relevant:
+                reciprocal_rank_sum += 1 / rank
+                break
+
+    count = len(questions) or 1
+    return {
+        'questions': len(questions),
+        'recall': {f"@{k}": recall_sum / count for k, recall_sum in recall_sums.items()},
+        'mrr': reciprocal_rank_sum / count,
+        'latency_ms': {
+            'p50': _percentile(latencies, 0.50),
+            'p99': _percentile(latencies, 0.99),
+            'mean': sum(latencies) / len(latencies) if latencies else 0.0
+        },
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def run_benchmark(corpus_dir: Optional[str] = None, db_path: Optional[str] = None,
+                  questions_path: Optional[str] = None,
+                  methods: tuple = ('cosine', 'keyword')) -> Dict[str, Any]:
+    """
+    运行基准测试
+
+    Args:
+        corpus_dir: 合成文档集目录，给出时导入到新的临时数据库（或db_path指定的新文件）
+        db_path: 已有知识库数据库；不给corpus_dir时直接在其上评估检索
+        questions_path: 标注问题集，默认使用corpus_dir中的questions.jsonl（不给corpus_dir时必须指定）
+        methods: 要评估的相似度算法
+    """
+    if corpus_dir is None and db_path is None:
+        raise ValueError("需要指定corpus_dir或db_path")
+    if corpus_dir is None and questions_path is None:
+        raise ValueError("不给corpus_dir时需要指定questions_path")
+    if corpus_dir is None and not os.path.exists(db_path):
+        raise ValueError(f"数据库 {db_path} 不存在")
+    questions_path = questions_path or os.path.join(corpus_dir, QUESTIONS_FILE)
+    questions = load_questions(questions_path)
+
+    temp_dir = None
+    if corpus_dir is not None and db_path is None:
+        temp_dir = tempfile.mkdtemp(prefix="kb_benchmark_")
+        db_path = os.path.join(temp_dir, "benchmark.db")
+    elif corpus_dir is not None and os.path.exists(db_path):
+        raise ValueError(f"导入文档集需要新的数据库文件，{db_path} 已存在")
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'corpus': corpus_dir,
+        'db_path': None if temp_dir else db_path,
+        'questions_file': questions_path,
+        'ingest': None,
+        'methods': {}
+    }
+    try:
+        if corpus_dir is not None:
+            # 索引与相似度算法无关，只导入一次；允许近似重复，避免模板相近的合成文档被拒绝
+            knowledge_base = SimpleRAGKnowledgeBase(db_path=db_path, async_ingestion=False,
+                                                    near_duplicate_action="allow")
+            log_info(f"导入文档集: {corpus_dir}")
+            report['ingest'] = ingest_corpus(knowledge_base, os.path.join(corpus_dir, DOCUMENTS_FILE))
+
+        for method in methods:
+            knowledge_base = SimpleRAGKnowledgeBase(db_path=db_path, similarity_method=method,
+                                                    async_ingestion=False)
+            log_info(f"评估检索: {method}")
+            report['methods'][method] = evaluate_retrieval(knowledge_base, questions)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="知识库检索基准测试")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="生成合成文档集和标注问题集")
+    generate_parser.add_argument("output_dir", help="输出目录")
+    generate_parser.add_argument("--scale", choices=sorted(SCALES), default="1k", help="规模（片段数）")
+    generate_parser.add_argument("--questions", type=int, default=200, help="问题数")
+    generate_parser.add_argument("--seed", type=int, default=42, help="随机种子")
+
+    run_parser = subparsers.add_parser("run", help="运行基准测试")
+    run_parser.add_argument("--corpus", help="合成文档集目录（导入到新数据库后评估）")
+    run_parser.add_argument("--db", help="数据库文件路径（不给--corpus时评估已有知识库）")
+    run_parser.add_argument("--questions", help="标注问题集路径")
+    run_parser.add_argument("--methods", nargs="+", choices=["cosine", "keyword"],
+                            default=["cosine", "keyword"], help="相似度算法")
+    run_parser.add_argument("--output", help="结果JSON输出路径（默认打印）")
+    args = parser.parse_args()
+
+    if args.action == "generate":
+        generate_corpus(args.output_dir, args.scale, args.questions, args.seed)
+    else:
+        try:
+            result = run_benchmark(args.corpus, args.db, args.questions, tuple(args.methods))
+        except (ValueError, OSError) as e:
+            log_error(f"基准测试失败: {str(e)}")
+            raise SystemExit(1)
+        output = json.dumps(result, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                f.write(output)
+            log_success(f"结果已保存: {args.output}")
+        else:
+            print(output)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+知识库索引一致性检查与压缩
+查找中途失败遗留的孤立片段、失效的倒排索引和引用计数偏差，只重建受影响的部分，
+清理超过保留期的转存对话记录，然后分片执行增量VACUUM和ANALYZE，避免长时间持有写锁阻塞搜索
+"""
+
+from typing import Any, Dict, List
+import argparse
+import json
+import time
+
+from conversation_memory import DEFAULT_HISTORY_RETENTION_DAYS, purge_conversation_history
+from rag_knowledge_base_simple import (KNOWLEDGE_BASE_TABLES, SimpleRAGKnowledgeBase, compress_text,
+                                       decompress_text, iter_batches, log_info, log_success, log_warning)
+
+# 小于该字节数的未压缩文本不视为问题
+COMPRESS_MIN_BYTES = 256
+
+
+class KnowledgeBaseMaintenance:
+    """知识库维护任务（一致性检查、修复与分片压缩）"""
+
+    def __init__(self, knowledge_base: SimpleRAGKnowledgeBase, batch_size: int = 500,
+                 pause: float = 0.05, history_retention_days: float = DEFAULT_HISTORY_RETENTION_DAYS):
+        """
+        初始化维护任务
+
+        Args:
+            knowledge_base: 要维护的知识库
+            batch_size: 每个写事务处理的行数
+            pause: 两个写事务之间的间隔（秒），让出写锁给前台请求
+            history_retention_days: 转存对话记录的保留天数
+        """
+        self.knowledge_base = knowledge_base
+        self.batch_size = batch_size
+        self.pause = pause
+        self.history_retention_days = history_retention_days
+
+    def check(self) -> Dict[str, List[Any]]:
+        """只检查不修复，返回各类问题对应的行标识"""
+        conn = self.knowledge_base._connect()
+        c = conn.cursor()
+        issues = {}
+
+        # 文档已删除但片段仍在
+        c.execute('''SELECT dc.id FROM document_chunks dc
+                     LEFT JOIN knowledge_documents kd ON dc.document_id = kd.id
+                     WHERE kd.id IS NULL''')
+        issues['orphaned_chunks'] = [row[0] for row in c.fetchall()]
+
+        # 片段存储的引用计数与实际引用数不一致
+        c.execute('''SELECT cs.content_hash, cs.ref_count, COUNT(dc.id)
+                     FROM chunk_store cs
+                     LEFT JOIN document_chunks dc ON dc.content_hash = cs.content_hash
+                     GROUP BY cs.content_hash
+                     HAVING cs.ref_count IS NULL OR cs.ref_count != COUNT(dc.id)''')
+        issues['ref_count_drift'] = [(row[0], row[1], row[2]) for row in c.fetchall()]
+
+        # 倒排索引指向已不存在的片段
+        c.execute('''SELECT DISTINCT p.content_hash FROM term_postings p
+                     LEFT JOIN chunk_store cs ON p.content_hash = cs.content_hash
+                     WHERE cs.content_hash IS NULL''')
+        issues['stale_postings'] = [row[0] for row in c.fetchall()]
+
+        # 片段存储中缺少倒排索引或向量模长的片段（模长为0的片段本来就没有索引词）
+        c.execute('''SELECT cs.content_hash FROM chunk_store cs
+                     WHERE cs.vector_norm IS NULL
+                        OR (cs.vector_norm > 0 AND NOT EXISTS
+                            (SELECT 1 FROM term_postings p WHERE p.content_hash = cs.content_hash))''')
+        issues['missing_vectors'] = [row[0] for row in c.fetchall()]
+
+        # 片段引用了不在片段存储中的内容，或标记已处理却没有片段的文档
+        c.execute('''SELECT DISTINCT dc.document_id FROM document_chunks dc
+                     JOIN knowledge_documents kd ON dc.document_id = kd.id
+                     LEFT JOIN chunk_store cs ON dc.content_hash = cs.content_hash
+                     WHERE cs.content_hash IS NULL
+                     UNION
+                     SELECT kd.id FROM knowledge_documents kd
+                     WHERE kd.processed
+                       AND NOT EXISTS (SELECT 1 FROM document_chunks dc WHERE dc.document_id = kd.id)''')
+        document_ids = set(row[0] for row in c.fetchall())
+
+        # 未处理完成又不在处理队列中的文档（处理线程中途退出；已记录处理失败的文档除外）
+        queue = self.knowledge_base.ingestion_queue
+        c.execute("SELECT id FROM knowledge_documents WHERE NOT processed AND processing_error IS NULL")
+        document_ids.update(row[0] for row in c.fetchall()
+                            if queue is None or not queue.is_pending(row[0]))
+        issues['documents_to_reprocess'] = sorted(document_ids)
+
+        # 已删除文档遗留的MinHash签名、LSH分桶、补全词汇和摘要向量
+        c.execute('''SELECT document_id FROM document_minhash
+                     WHERE document_id NOT IN (SELECT id FROM knowledge_documents)
+                     UNION
+                     SELECT DISTINCT document_id FROM document_lsh_bands
+                     WHERE document_id NOT IN (SELECT id FROM knowledge_documents)
+                     UNION
+                     SELECT DISTINCT document_id FROM document_terms
+                     WHERE document_id NOT IN (SELECT id FROM knowledge_documents)
+                     UNION
+                     SELECT document_id FROM document_summary
+                     WHERE document_id NOT IN (SELECT id FROM knowledge_documents)
+                     UNION
+                     SELECT DISTINCT document_id FROM summary_postings
+                     WHERE document_id NOT IN (SELECT id FROM knowledge_documents)''')
+        issues['orphaned_signatures'] = [row[0] for row in c.fetchall()]
+
+        # 旧版本未压缩存储的文本（很短的文本压缩后不会更小，本来就按原文存储）
+        c.execute(f"SELECT id FROM knowledge_documents WHERE typeof(content) = 'text' "
+                  f"AND LENGTH(CAST(content AS BLOB)) >= {COMPRESS_MIN_BYTES}")
+        issues['uncompressed_documents'] = [row[0] for row in c.fetchall()]
+        c.execute(f"SELECT content_hash FROM chunk_store WHERE content_length IS NULL "
+                  f"OR (typeof(content) = 'text' AND LENGTH(CAST(content AS BLOB)) >= {COMPRESS_MIN_BYTES})")
+        issues['uncompressed_chunks'] = [row[0] for row in c.fetchall()]
+
+        conn.close()
+        return issues
+
+    def repair(self, issues: Dict[str, List[Any]] = None) -> Dict[str, int]:
+        """修复检查出的问题，只重建受影响的片段和文档，返回各类修复数量"""
+        if issues is None:
+            issues = self.check()
+        kb = self.knowledge_base
+        repaired = {}
+        # 检查与修复之间前台上传可能已经改变了数据，每个写事务内都按当前数据重新确认后才删除
+
+        # 孤立片段：删除并释放片段存储引用（只删除所属文档在事务内仍不存在的片段）
+        def delete_orphaned_chunks(c, batch):
+            placeholders = ','.join('?' * len(batch))
+            c.execute(f'''SELECT id FROM document_chunks WHERE id IN ({placeholders})
+                          AND document_id NOT IN (SELECT id FROM knowledge_documents)''', batch)
+            kb._delete_chunk_ids(c, [row[0] for row in c.fetchall()])
+        repaired['orphaned_chunks'] = self._run_batches(issues['orphaned_chunks'], delete_orphaned_chunks)
+
+        # 引用计数：按修复时的实际引用数重算（删除孤立片段后引用数可能已变化），
+        # 无引用的片段连同倒排索引一起删除
+        def fix_ref_counts(c, batch):
+            hashes = [content_hash for content_hash, _, _ in batch]
+            placeholders = ','.join('?' * len(hashes))
+            c.execute(f'''UPDATE chunk_store SET ref_count =
+                              (SELECT COUNT(*) FROM document_chunks dc
+                               WHERE dc.content_hash = chunk_store.content_hash)
+                          WHERE content_hash IN ({placeholders})''', hashes)
+            c.execute(f'''SELECT content_hash FROM chunk_store WHERE content_hash IN ({placeholders})
+                          AND ref_count = 0
+                          AND content_hash NOT IN (SELECT content_hash FROM document_chunks)''', hashes)
+            unused = [row[0] for row in c.fetchall()]
+            if unused:
+                unused_placeholders = ','.join('?' * len(unused))
+                c.execute(f"DELETE FROM term_postings WHERE content_hash IN ({unused_placeholders})", unused)
+                c.execute(f"DELETE FROM chunk_store WHERE content_hash IN ({unused_placeholders})", unused)
+        repaired['ref_count_drift'] = self._run_batches(issues['ref_count_drift'], fix_ref_counts)
+
+        # 失效的倒排索引（检查后同一内容可能又被上传，片段存储中仍有的不删除）
+        def delete_postings(c, batch):
+            placeholders = ','.join('?' * len(batch))
+            c.execute(f'''DELETE FROM term_postings WHERE content_hash IN ({placeholders})
+                          AND content_hash NOT IN (SELECT content_hash FROM chunk_store)''', batch)
+        repaired['stale_postings'] = self._run_batches(issues['stale_postings'], delete_postings)
+
+        # 缺少向量的片段：重新计算向量和倒排索引
+        def rebuild_vectors(c, batch):
+            placeholders = ','.join('?' * len(batch))
+            c.execute(f"SELECT content_hash, content FROM chunk_store WHERE content_hash IN ({placeholders})",
+                      batch)
+            for content_hash, content in c.fetchall():
+                text = decompress_text(content)
+                vector = kb._compute_vector(text)
+                c.execute("DELETE FROM term_postings WHERE content_hash = ?", (content_hash,))
+                c.executemany("INSERT INTO term_postings (term, content_hash, weight) VALUES (?, ?, ?)",
+                              [(term, content_hash, weight) for term, weight in vector.items()])
+                c.execute('''UPDATE chunk_store SET vector_norm = ?, keywords = ?, content_length = ?
+                             WHERE content_hash = ?''',
+                          (kb.vector_norm(vector), kb.extract_keywords(text), len(text), content_hash))
+        repaired['missing_vectors'] = self._run_batches(issues['missing_vectors'], rebuild_vectors)
+
+        # 遗留的签名、分桶、补全词汇和摘要向量（补全前缀树随后重新加载）
+        def delete_signatures(c, batch):
+            placeholders = ','.join('?' * len(batch))
+            c.execute(f"SELECT id FROM knowledge_documents WHERE id IN ({placeholders})", batch)
+            existing = set(row[0] for row in c.fetchall())
+            for document_id in batch:
+                if document_id in existing:
+                    continue
+                kb._delete_signature(c, document_id)
+                kb._delete_terms(c, document_id)
+                kb._delete_summary(c, document_id)
+        repaired['orphaned_signatures'] = self._run_batches(issues['orphaned_signatures'], delete_signatures)
+        if repaired['orphaned_signatures']:
+            kb.autocomplete_index.invalidate()
+
+        # 旧版本未压缩的文本
+        def compress_documents(c, batch):
+            placeholders = ','.join('?' * len(batch))
+            c.execute(f"SELECT id, content FROM knowledge_documents WHERE id IN ({placeholders})", batch)
+            for document_id, content in c.fetchall():
+                c.execute("UPDATE knowledge_documents SET content = ? WHERE id = ?",
+                          (compress_text(decompress_text(content)), document_id))
+        repaired['uncompressed_documents'] = self._run_batches(issues['uncompressed_documents'],
+                                                               compress_documents)
+
+        def compress_chunks(c, batch):
+            placeholders = ','.join('?' * len(batch))
+            c.execute(f"SELECT content_hash, content FROM chunk_store WHERE content_hash IN ({placeholders})",
+                      batch)
+            for content_hash, content in c.fetchall():
+                text = decompress_text(content)
+                c.execute("UPDATE chunk_store SET content = ?, content_length = ? WHERE content_hash = ?",
+                          (compress_text(text), len(text), content_hash))
+        repaired['uncompressed_chunks'] = self._run_batches(issues['uncompressed_chunks'], compress_chunks)
+
+        # 片段引用损坏的文档整体重新处理（未变化的片段会从片段存储中复用）
+        for document_id in issues['documents_to_reprocess']:
+            if kb.ingestion_queue is not None:
+                kb.ingestion_queue.submit(document_id)
+            else:
+                kb.process_document(document_id)
+        repaired['documents_to_reprocess'] = len(issues['documents_to_reprocess'])
+
+        if any(repaired.values()):
+            kb.search_cache.clear()
+        return repaired
+
+    def _run_batches(self, items: List[Any], action) -> int:
+        """分批在独立的短事务中执行修复"""
+        for batch in iter_batches(items, self.batch_size):
+            conn = self.knowledge_base._connect()
+            c = conn.cursor()
+            try:
+                c.execute("BEGIN IMMEDIATE")
+                action(c, batch)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+            time.sleep(self.pause)
+        return len(items)
+
+    def compact(self, pages_per_slice: int = 200, max_slices: int = 100,
+                allow_full_vacuum: bool = False) -> Dict[str, Any]:
+        """
+        分片回收空闲页并更新统计信息
+
+        Args:
+            pages_per_slice: 每次增量VACUUM回收的页数
+            max_slices: 最多执行的分片数，超出后留到下次执行
+            allow_full_vacuum: 数据库未开启增量VACUUM时，是否允许执行一次完整VACUUM来开启
+        """
+        conn = self.knowledge_base._connect()
+        c = conn.cursor()
+        report = {'full_vacuum': False, 'slices': 0, 'pages_freed': 0}
+
+        c.execute("PRAGMA auto_vacuum")
+        if c.fetchone()[0] != 2:  # 2 = INCREMENTAL
+            if allow_full_vacuum:
+                # 切换auto_vacuum模式需要完整VACUUM一次，会阻塞写入，只在明确允许时执行
+                log_warning("数据库未开启增量VACUUM，执行一次完整VACUUM")
+                c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                c.execute("VACUUM")
+                report['full_vacuum'] = True
+            else:
+                log_warning("数据库未开启增量VACUUM，跳过空间回收（使用 --full-vacuum 开启）")
+
+        c.execute("PRAGMA auto_vacuum")
+        if c.fetchone()[0] == 2:
+            for _ in range(max_slices):
+                c.execute("PRAGMA freelist_count")
+                before = c.fetchone()[0]
+                if before == 0:
+                    break
+                c.execute(f"PRAGMA incremental_vacuum({int(pages_per_slice)})")
+                c.fetchall()
+                c.execute("PRAGMA freelist_count")
+                report['pages_freed'] += before - c.fetchone()[0]
+                report['slices'] += 1
+                time.sleep(self.pause)
+
+        c.execute("PRAGMA freelist_count")
+        report['freelist_pages'] = c.fetchone()[0]
+
+        # 限制每个表的采样行数，ANALYZE按表分片执行
+        c.execute("PRAGMA analysis_limit = 1000")
+        for table in KNOWLEDGE_BASE_TABLES:
+            c.execute(f"ANALYZE {table}")
+            conn.commit()
+            time.sleep(self.pause)
+        c.execute("PRAGMA optimize")
+
+        conn.close()
+        return report
+
+    def run(self, check_only: bool = False, **compact_options) -> Dict[str, Any]:
+        """执行完整的维护流程：检查、修复、清理过期对话记录、压缩"""
+        issues = self.check()
+        summary = {'issues': {name: len(items) for name, items in issues.items()}}
+        if check_only:
+            return summary
+
+        summary['repaired'] = self.repair(issues)
+        summary['purged_history'] = purge_conversation_history(
+            self.knowledge_base.db_path, self.history_retention_days, self.batch_size, self.pause)
+        summary['compaction'] = self.compact(**compact_options)
+        log_success(f"知识库维护完成: {summary}")
+        return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="知识库索引一致性检查与压缩")
+    parser.add_argument("--db", default="crop_health.db", help="数据库文件路径")
+    parser.add_argument("--check-only", action="store_true", help="只检查不修复")
+    parser.add_argument("--pages-per-slice", type=int, default=200, help="每次增量VACUUM回收的页数")
+    parser.add_argument("--max-slices", type=int, default=100, help="最多执行的VACUUM分片数")
+    parser.add_argument("--pause", type=float, default=0.05, help="分片之间的间隔（秒）")
+    parser.add_argument("--history-days", type=float, default=DEFAULT_HISTORY_RETENTION_DAYS,
+                        help="转存对话记录的保留天数")
+    parser.add_argument("--full-vacuum", action="store_true", help="必要时执行一次完整VACUUM以开启增量VACUUM")
+    args = parser.parse_args()
+
+    # 维护命令在当前进程内同步重新处理文档，不启动后台线程
+    knowledge_base = SimpleRAGKnowledgeBase(db_path=args.db, async_ingestion=False)
+    maintenance = KnowledgeBaseMaintenance(knowledge_base, pause=args.pause,
+                                           history_retention_days=args.history_days)
+    if args.check_only:
+        result = maintenance.run(check_only=True)
+    else:
+        result = maintenance.run(pages_per_slice=args.pages_per_slice, max_slices=args.max_slices,
+                                 allow_full_vacuum=args.full_vacuum)
+    log_info(json.dumps(result, ensure_ascii=False, indent=2))
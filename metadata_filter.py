@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文档属性位图索引
+每个属性值对应一个以文档ID为位的整数位图，多个过滤条件通过按位与求交集，
+搜索时只对交集内文档引用的片段打分
+
+位图长度随最大文档ID增长，这里假定文档ID是knowledge_documents表AUTOINCREMENT分配的正整数且基本连续；
+非正整数ID不进入索引，查询条件中超出索引范围的ID直接忽略
+"""
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import bisect
+from datetime import date, datetime
+
+
+def bitmap_from_ids(document_ids: Iterable[int], max_id: Optional[int] = None) -> int:
+    """由文档ID集合构造位图（跳过非正整数ID和大于max_id的ID）"""
+    bitmap = 0
+    for document_id in document_ids:
+        if document_id < 1 or (max_id is not None and document_id > max_id):
+            continue
+        bitmap |= 1 << document_id
+    return bitmap
+
+
+def bitmap_to_ids(bitmap: int) -> List[int]:
+    """将位图还原为文档ID列表（升序）"""
+    document_ids = []
+    while bitmap:
+        lowest = bitmap & -bitmap
+        document_ids.append(lowest.bit_length() - 1)
+        bitmap ^= lowest
+    return document_ids
+
+
+def normalize_time(value: Any, end_of_day: bool = False) -> Optional[str]:
+    """
+    将时间条件转换为与数据库中upload_time可直接比较的字符串
+
+    Args:
+        value: datetime、date或字符串
+        end_of_day: 只给出日期时是否取当天结束时刻（用于区间上界）
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, date):
+        return f"{value.isoformat()} 23:59:59.999999" if end_of_day else value.isoformat()
+    value = str(value).strip().replace('T', ' ')
+    if end_of_day and len(value) == 10:
+        return f"{value} 23:59:59.999999"
+    return value
+
+
+class DocumentBitmapIndex:
+    """文档属性位图索引（文件类型、文档ID、上传时间）"""
+
+    def __init__(self, rows: Iterable[Tuple[int, str, Any]]):
+        """
+        初始化位图索引
+
+        Args:
+            rows: (文档ID, 文件类型, 上传时间) 列表
+        """
+        self.all_documents = 0
+        self.max_document_id = 0
+        self.file_type_bitmaps: Dict[str, int] = {}
+        self.upload_times: List[Tuple[str, int]] = []
+
+        for document_id, file_type, upload_time in rows:
+            if document_id < 1:
+                print(f"WARNING: 文档ID {document_id} 不是正整数，不加入过滤索引")
+                continue
+            self.max_document_id = max(self.max_document_id, document_id)
+            bit = 1 << document_id
+            self.all_documents |= bit
+            file_type = (file_type or '').lower()
+            self.file_type_bitmaps[file_type] = self.file_type_bitmaps.get(file_type, 0) | bit
+            self.upload_times.append((str(upload_time or ''), document_id))
+
+        # 上传时间有序，区间查询用二分定位
+        self.upload_times.sort()
+        self._time_keys = [upload_time for upload_time, _ in self.upload_times]
+
+    def document_count(self) -> int:
+        """索引中的文档数"""
+        return len(self.upload_times)
+
+    def by_file_types(self, file_types: Iterable[str]) -> int:
+        """按文件类型过滤（'.txt'与'txt'均可）"""
+        bitmap = 0
+        for file_type in file_types:
+            file_type = file_type.lower()
+            if file_type and not file_type.startswith('.'):
+                file_type = '.' + file_type
+            bitmap |= self.file_type_bitmaps.get(file_type, 0)
+        return bitmap
+
+    def by_upload_time(self, uploaded_after: Any = None, uploaded_before: Any = None) -> int:
+        """按上传时间区间过滤（两端均包含）"""
+        start = 0
+        end = len(self._time_keys)
+        lower = normalize_time(uploaded_after)
+        upper = normalize_time(uploaded_before, end_of_day=True)
+        if lower is not None:
+            start = bisect.bisect_left(self._time_keys, lower)
+        if upper is not None:
+            end = bisect.bisect_right(self._time_keys, upper)
+        return bitmap_from_ids(document_id for _, document_id in self.upload_times[start:end])
+
+    def select(self, file_types: Optional[Iterable[str]] = None,
+               document_ids: Optional[Iterable[int]] = None,
+               uploaded_after: Any = None, uploaded_before: Any = None) -> int:
+        """按所有给定条件求交集，返回满足条件的文档位图"""
+        bitmap = self.all_documents
+        if file_types is not None:
+            bitmap &= self.by_file_types(file_types)
+        if document_ids is not None:
+            bitmap &= bitmap_from_ids(document_ids, self.max_document_id)
+        if uploaded_after is not None or uploaded_before is not None:
+            bitmap &= self.by_upload_time(uploaded_after, uploaded_before)
+        return bitmap
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MinHash签名与LSH分桶
+用于在上传时以亚线性时间查找近似重复的文档
+"""
+
+from typing import List, Set
+import random
+import re
+import zlib
+
+# 尝试导入numpy，如果失败则使用纯Python实现
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+# 梅森素数 2^31 - 1：a * x < 2^62，numpy的uint64与Python整数计算结果完全一致
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+class MinHasher:
+    """基于字符shingle的MinHash签名计算"""
+
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5, seed: int = 42):
+        """
+        初始化MinHash
+
+        Args:
+            num_perm: 哈希函数（排列）个数，即签名长度
+            shingle_size: 字符shingle长度
+            seed: 随机种子，固定后签名在不同进程间可比较
+        """
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = random.Random(seed)
+        self.a = [rng.randint(1, MERSENNE_PRIME - 1) for _ in range(num_perm)]
+        self.b = [rng.randint(0, MERSENNE_PRIME - 1) for _ in range(num_perm)]
+
+    def shingles(self, text: str) -> Set[int]:
+        """将文本规范化后切分为字符shingle，并哈希为整数"""
+        # 去掉空白和标点，避免重新排版或编码差异影响结果
+        normalized = re.sub(r'[^\u4e00-\u9fff\w]', '', text.lower())
+        if not normalized:
+            return set()
+        if len(normalized) <= self.shingle_size:
+            return {zlib.crc32(normalized.encode('utf-8')) % MERSENNE_PRIME}
+        return {
+            zlib.crc32(normalized[i:i + self.shingle_size].encode('utf-8')) % MERSENNE_PRIME
+            for i in range(len(normalized) - self.shingle_size + 1)
+        }
+
+    def signature(self, text: str) -> List[int]:
+        """计算文本的MinHash签名"""
+        shingle_hashes = self.shingles(text)
+        if not shingle_hashes:
+            return [MERSENNE_PRIME] * self.num_perm
+
+        if HAS_NUMPY:
+            values = np.fromiter(shingle_hashes, dtype=np.uint64, count=len(shingle_hashes))
+            prime = np.uint64(MERSENNE_PRIME)
+            return [
+                int(((values * np.uint64(a) + np.uint64(b)) % prime).min())
+                for a, b in zip(self.a, self.b)
+            ]
+
+        return [
+            min((a * x + b) % MERSENNE_PRIME for x in shingle_hashes)
+            for a, b in zip(self.a, self.b)
+        ]
+
+
+def estimate_jaccard(sig1: List[int], sig2: List[int]) -> float:
+    """根据两个签名估计Jaccard相似度"""
+    if not sig1 or len(sig1) != len(sig2):
+        return 0.0
+    return sum(1 for x, y in zip(sig1, sig2) if x == y) / len(sig1)
+
+
+def lsh_band_hashes(signature: List[int], bands: int) -> List[str]:
+    """
+    将签名切分为若干band，返回每个band的哈希
+
+    两个文档只要有一个band哈希相同就成为候选，
+    Jaccard相似度为s时成为候选的概率为 1 - (1 - s^r)^b（r为每个band的行数）
+    """
+    rows = max(1, len(signature) // bands)
+    band_hashes = []
+    for band in range(bands):
+        band_values = signature[band * rows:(band + 1) * rows]
+        if not band_values:
+            break
+        band_hashes.append(format(zlib.crc32(','.join(map(str, band_values)).encode('ascii')), '08x'))
+    return band_hashes
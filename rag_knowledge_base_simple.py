@@ -4,10 +4,18 @@ import json
 import hashlib
 import math
 import re
+import threading
+import unicodedata
+import zlib
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 from collections import Counter
 from lru_cache import get_vector_cache, get_search_cache, cache_manager
+from tracing import annotate
+from ingestion_queue import get_ingestion_queue
+from minhash_lsh import MinHasher, estimate_jaccard, lsh_band_hashes
+from metadata_filter import DocumentBitmapIndex, bitmap_to_ids
+from autocomplete import extract_terms, get_autocomplete_index
 
 # 尝试导入numpy，如果失败则使用替代方案
 try:
@@ -42,25 +50,114 @@ def log_error(message):
 def log_success(message):
     print(f"SUCCESS: {message}")
 
+# SQLite单条语句的参数个数有上限，IN查询需要分批
+SQL_BATCH_SIZE = 500
+
+def compress_text(text: str) -> Any:
+    """压缩文本用于存储；压缩后不更小的短文本保持原样"""
+    data = text.encode('utf-8')
+    compressed = zlib.compress(data, 6)
+    return compressed if len(compressed) < len(data) else text
+
+def decompress_text(value: Any) -> str:
+    """还原存储的文本（BLOB为压缩内容，TEXT为旧版本或未压缩内容）"""
+    if value is None:
+        return ''
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode('utf-8')
+    return value
+
+# 索引格式版本，分词、向量或分桶方式变化时递增（导入索引文件时校验）
+INDEX_FORMAT_VERSION = 3
+
+# 知识库相关的表（导出、导入和维护任务使用）
+KNOWLEDGE_BASE_TABLES = ['knowledge_documents', 'document_chunks', 'chunk_store', 'term_postings',
+                         'document_minhash', 'document_lsh_bands', 'document_terms',
+                         'document_summary', 'summary_postings']
+
+# MinHash签名长度128，分为32个band（每个4行），Jaccard约0.42以上的文档大概率成为候选
+MINHASH_NUM_PERM = 128
+LSH_BANDS = 32
+
+# 粗排：文档摘要向量保留权重最高的词数；文档数少于阈值时直接全量搜索
+SUMMARY_VECTOR_TERMS = 256
+COARSE_MIN_DOCUMENTS = 20
+COARSE_TOP_DOCUMENTS = 10
+COARSE_MIN_SCORE = 0.1  # 最相关文档的摘要相似度低于该值时认为粗排不可靠，回退全量搜索
+
+# 查询词裁剪：停用字、出现在过多片段中的高频字不参与检索，剩余的按权重最多保留若干个
+QUERY_STOP_CHARS = set('的了是在和与及或我你他她它们这那哪么怎吗呢吧啊呀请问个些也都就还把被给对从为')
+QUERY_MAX_TERMS = 32
+QUERY_MAX_DF_RATIO = 0.5
+QUERY_DF_MIN_CHUNKS = 50  # 片段太少时文档频率没有统计意义，不按其裁剪
+
+def iter_batches(items: List[Any], size: int = SQL_BATCH_SIZE):
+    """按固定大小分批迭代"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
 class SimpleRAGKnowledgeBase:
     """简化版RAG知识库管理类（不依赖重型库）"""
     
-    def __init__(self, db_path: str = "crop_health.db", similarity_method: str = "cosine"):
+    def __init__(self, db_path: str = "crop_health.db", similarity_method: str = "cosine",
+                 async_ingestion: bool = True, ingestion_workers: int = 2,
+                 near_duplicate_threshold: float = 0.9, near_duplicate_action: str = "reject",
+                 coarse_to_fine: bool = True):
         self.db_path = db_path
         self.documents = []
         self.similarity_method = similarity_method  # "keyword" 或 "cosine"
+        self.coarse_to_fine = coarse_to_fine  # 余弦搜索时先按文档摘要向量粗排，再只对候选文档的片段打分
+        self.async_ingestion = async_ingestion  # 上传后是否交给后台线程处理
+        
+        # 近似重复检测：Jaccard相似度超过阈值时拒绝("reject")、合并为新版本("merge")或照常上传("allow")
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self.near_duplicate_action = near_duplicate_action
+        self.minhasher = MinHasher(num_perm=MINHASH_NUM_PERM)
         
         # 初始化LRU缓存
         self.vector_cache = get_vector_cache()
         self.search_cache = get_search_cache()
         
+        # 文档属性位图索引（按文档属性版本懒加载重建；实例可能被多个会话线程共享）
+        self._metadata_index = None
+        self._metadata_fingerprint = None
+        self._metadata_lock = threading.Lock()
+        
+        # 问题自动补全前缀树（同一数据库共享，首次查询时加载）
+        self.autocomplete_index = get_autocomplete_index(self.db_path)
+        
         self.init_database()
+        
+        # 同一数据库共享一个后台处理队列
+        self.ingestion_queue = None
+        if self.async_ingestion:
+            self.ingestion_queue = get_ingestion_queue(
+                self.db_path, self.process_document, ingestion_workers,
+                on_complete=self._on_document_processed
+            )
+            self._resume_pending_documents()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """创建数据库连接（后台线程与前台请求并发访问，需要等待锁）"""
+        return sqlite3.connect(self.db_path, timeout=30)
+    
+    def _ensure_column(self, c, table: str, column: str, definition: str) -> None:
+        """为旧版本数据库补充新增的列"""
+        c.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in c.fetchall()]:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
     
     def init_database(self):
         """初始化知识库相关数据库表"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         c = conn.cursor()
         
+        # 新建的数据库开启增量VACUUM，维护任务可以分片回收空间（已有数据库需完整VACUUM一次才生效）
+        c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        
+        # WAL模式下后台写入不会阻塞前台搜索
+        c.execute("PRAGMA journal_mode=WAL")
+        
         # 创建知识库文档表
         c.execute('''CREATE TABLE IF NOT EXISTS knowledge_documents
                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -72,6 +169,9 @@ class SimpleRAGKnowledgeBase:
                       file_hash TEXT UNIQUE,
                       processed BOOLEAN DEFAULT FALSE)''')
         
+        # 处理失败的原因（无法分块或处理出错），失败的文档不再自动重试，重新上传或更新后清除
+        self._ensure_column(c, 'knowledge_documents', 'processing_error', 'TEXT')
+        
         # 创建文档片段表
         c.execute('''CREATE TABLE IF NOT EXISTS document_chunks
                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -81,13 +181,123 @@ class SimpleRAGKnowledgeBase:
                       keywords TEXT,
                       FOREIGN KEY (document_id) REFERENCES knowledge_documents (id))''')
         
+        # 片段内容哈希，指向内容寻址的片段存储（content/keywords列仅旧版本数据使用）
+        self._ensure_column(c, 'document_chunks', 'content_hash', 'TEXT')
+        
+        # 创建片段存储表（按内容哈希去重，ref_count为引用该片段的文档片段数）
+        c.execute('''CREATE TABLE IF NOT EXISTS chunk_store
+                     (content_hash TEXT PRIMARY KEY,
+                      content TEXT,
+                      keywords TEXT,
+                      vector_norm REAL,
+                      ref_count INTEGER DEFAULT 0)''')
+        
+        # 片段原文长度（内容压缩存储后无法直接用LENGTH排序）
+        self._ensure_column(c, 'chunk_store', 'content_length', 'INTEGER')
+        
+        # 创建倒排索引表（词 -> 唯一片段及词频权重）
+        c.execute('''CREATE TABLE IF NOT EXISTS term_postings
+                     (term TEXT,
+                      content_hash TEXT,
+                      weight REAL,
+                      FOREIGN KEY (content_hash) REFERENCES chunk_store (content_hash))''')
+        
+        # 旧版本按片段ID建立的倒排索引不再使用，相关文档会在启动时重新处理
+        c.execute("DROP TABLE IF EXISTS chunk_postings")
+        
+        # 创建文档MinHash签名表和LSH分桶索引表
+        c.execute('''CREATE TABLE IF NOT EXISTS document_minhash
+                     (document_id INTEGER PRIMARY KEY,
+                      signature TEXT,
+                      FOREIGN KEY (document_id) REFERENCES knowledge_documents (id))''')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS document_lsh_bands
+                     (band_index INTEGER,
+                      band_hash TEXT,
+                      document_id INTEGER,
+                      FOREIGN KEY (document_id) REFERENCES knowledge_documents (id))''')
+        
+        # 创建文档词汇表（自动补全的数据来源，删除文档时据此扣减词频）
+        c.execute('''CREATE TABLE IF NOT EXISTS document_terms
+                     (document_id INTEGER,
+                      term TEXT,
+                      frequency INTEGER,
+                      FOREIGN KEY (document_id) REFERENCES knowledge_documents (id))''')
+        
+        # 创建文档摘要向量表和摘要倒排索引（粗排使用）
+        c.execute("""CREATE TABLE IF NOT EXISTS document_summary
+                     (document_id INTEGER PRIMARY KEY,
+                      vector_norm REAL,
+                      FOREIGN KEY (document_id) REFERENCES knowledge_documents (id))""")
+        
+        c.execute("""CREATE TABLE IF NOT EXISTS summary_postings
+                     (term TEXT,
+                      document_id INTEGER,
+                      weight REAL,
+                      FOREIGN KEY (document_id) REFERENCES knowledge_documents (id))""")
+        
+        # 知识库元数据（索引版本等）
+        c.execute("""CREATE TABLE IF NOT EXISTS kb_meta
+                     (key TEXT PRIMARY KEY,
+                      value INTEGER)""")
+        
+        c.execute("CREATE INDEX IF NOT EXISTS idx_document_terms_document ON document_terms (document_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_summary_postings_term ON summary_postings (term)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_summary_postings_document ON summary_postings (document_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_lsh_bands_hash ON document_lsh_bands (band_index, band_hash)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_lsh_bands_document ON document_lsh_bands (document_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_term_postings_term ON term_postings (term)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_term_postings_hash ON term_postings (content_hash)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_document_chunks_document ON document_chunks (document_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_document_chunks_hash ON document_chunks (content_hash)")
+        
         conn.commit()
         conn.close()
     
+    def _resume_pending_documents(self) -> None:
+        """
+        重新入队未处理完成的文档（包括片段不在片段存储中、缺少MinHash签名或摘要向量的旧版本文档），
+        已记录处理失败的文档除外
+        """
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute('''SELECT id FROM knowledge_documents
+                     WHERE processing_error IS NULL AND id IN
+                       (SELECT id FROM knowledge_documents WHERE NOT processed
+                        UNION
+                        SELECT DISTINCT dc.document_id FROM document_chunks dc
+                        LEFT JOIN chunk_store cs ON dc.content_hash = cs.content_hash
+                        WHERE cs.content_hash IS NULL
+                        UNION
+                        SELECT kd.id FROM knowledge_documents kd
+                        LEFT JOIN document_minhash dm ON kd.id = dm.document_id
+                        WHERE dm.document_id IS NULL
+                        UNION
+                        SELECT kd.id FROM knowledge_documents kd
+                        LEFT JOIN document_summary ds ON kd.id = ds.document_id
+                        WHERE ds.document_id IS NULL)''')
+        document_ids = [row[0] for row in c.fetchall()]
+        conn.close()
+        
+        for document_id in document_ids:
+            self.ingestion_queue.submit(document_id)
+        
+        if document_ids:
+            log_info(f"{len(document_ids)} 个文档等待后台处理")
+    
+    def _on_document_processed(self, document_id: int, success: bool) -> None:
+        """文档处理完成后清理搜索缓存，避免返回过期结果"""
+        if success:
+            self.search_cache.clear()
+    
     def calculate_file_hash(self, file_content: bytes) -> str:
         """计算文件内容的哈希值"""
         return hashlib.md5(file_content).hexdigest()
     
+    def calculate_chunk_hash(self, chunk: str) -> str:
+        """计算文档片段内容的哈希值"""
+        return hashlib.md5(chunk.encode('utf-8')).hexdigest()
+    
     def extract_text_from_file(self, file_content: bytes, filename: str) -> str:
         """从文件中提取文本内容（简化版）"""
         file_ext = os.path.splitext(filename)[1].lower()
@@ -185,6 +395,16 @@ class SimpleRAGKnowledgeBase:
             return cached_vector
         
         # 计算向量
+        vector = self._compute_vector(text)
+        
+        # 缓存结果
+        self.vector_cache.put(cache_key, vector)
+        log_info(f"向量已缓存: {text[:50]}...")
+        
+        return vector
+    
+    def _compute_vector(self, text: str) -> Dict[str, float]:
+        """计算词频向量（不经过缓存，用于建立索引）"""
         words = self.preprocess_text(text)
         
         # 计算词频
@@ -199,12 +419,12 @@ class SimpleRAGKnowledgeBase:
             tf = freq / total_words if total_words > 0 else 0
             vector[word] = tf
         
-        # 缓存结果
-        self.vector_cache.put(cache_key, vector)
-        log_info(f"向量已缓存: {text[:50]}...")
-        
         return vector
     
+    def vector_norm(self, vector: Dict[str, float]) -> float:
+        """计算向量模长"""
+        return math.sqrt(sum(weight ** 2 for weight in vector.values()))
+    
     def cosine_similarity(self, vec1: Dict[str, float], vec2: Dict[str, float]) -> float:
         """计算两个向量的余弦相似度"""
         if not vec1 or not vec2:
@@ -238,100 +458,740 @@ class SimpleRAGKnowledgeBase:
         
         return self.cosine_similarity(query_vector, content_vector)
     
-    def upload_document(self, file_content: bytes, filename: str) -> bool:
-        """上传文档到知识库"""
+    def normalize_query(self, query: str) -> str:
+        """规范化查询文本：全角转半角、转小写并去掉标点和空白"""
+        query = unicodedata.normalize('NFKC', query).lower()
+        return re.sub(r'[^\u4e00-\u9fff\w]', '', query)
+    
+    def query_vector(self, query: str) -> Dict[str, float]:
+        """
+        计算裁剪后的查询向量（按规范化文本缓存）
+
+        去掉停用字和在超过一半片段中出现的高频字，再按 词频×逆文档频率 最多保留QUERY_MAX_TERMS个词；
+        缓存放在搜索缓存中，知识库变化时随搜索结果一起失效
+        """
+        normalized = self.normalize_query(query)
+        cache_key = f"query_vector_{hashlib.md5(normalized.encode('utf-8')).hexdigest()}"
+        cached_vector = self.search_cache.get(cache_key)
+        if cached_vector is not None:
+            return cached_vector
+        
+        vector = self._compute_vector(normalized)
+        vector = {term: weight for term, weight in vector.items() if term not in QUERY_STOP_CHARS} or vector
+        pruned = self._prune_query_terms(vector)
+        if len(pruned) < len(vector):
+            log_info(f"查询词裁剪: {len(vector)} -> {len(pruned)}")
+        
+        self.search_cache.put(cache_key, pruned)
+        return pruned
+    
+    def _prune_query_terms(self, vector: Dict[str, float]) -> Dict[str, float]:
+        """按文档频率去掉高频词，并按权重限制查询词数"""
+        if not vector:
+            return vector
+        
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM chunk_store")
+        total_chunks = c.fetchone()[0]
+        document_frequency = {}
+        if total_chunks >= QUERY_DF_MIN_CHUNKS:
+            for batch in iter_batches(list(vector.keys())):
+                placeholders = ','.join('?' * len(batch))
+                c.execute(f"SELECT term, COUNT(*) FROM term_postings WHERE term IN ({placeholders}) GROUP BY term",
+                          batch)
+                document_frequency.update(c.fetchall())
+        conn.close()
+        
+        if document_frequency:
+            kept = {term: weight for term, weight in vector.items()
+                    if document_frequency.get(term, 0) <= total_chunks * QUERY_MAX_DF_RATIO}
+            # 所有词都是高频词时保留原查询，避免查询为空
+            vector = kept or vector
+        
+        if len(vector) <= QUERY_MAX_TERMS:
+            return vector
+        
+        def term_weight(item):
+            term, weight = item
+            return weight * math.log((total_chunks + 1) / (document_frequency.get(term, 0) + 1) + 1)
+        
+        return dict(sorted(vector.items(), key=term_weight, reverse=True)[:QUERY_MAX_TERMS])
+    
+    def upload_document(self, file_content: bytes, filename: str, wait: bool = False) -> bool:
+        """上传文档到知识库，返回是否成功（失败原因见upload_document_detailed）"""
+        return self.upload_document_detailed(file_content, filename, wait)['success']
+    
+    def upload_document_detailed(self, file_content: bytes, filename: str, wait: bool = False) -> Dict[str, Any]:
+        """
+        上传文档到知识库
+
+        只保存原始文档并提交后台处理，分块、关键词提取和索引构建由工作线程完成；
+        wait为True或未启用异步处理时在当前线程内完成处理。
+        相同文件和近似重复的检查与插入在同一个写事务中进行，并发上传的近似副本只会保存一份
+
+        Returns:
+            包含success、document_id、reason（失败或跳过的原因）、duplicate（近似重复的文档及相似度）的字典
+        """
+        result = {'success': False, 'document_id': None, 'reason': None, 'duplicate': None}
         conn = None
         try:
             # 计算文件哈希
             file_hash = self.calculate_file_hash(file_content)
             
-            # 检查文件是否已存在
-            conn = sqlite3.connect(self.db_path)
+            # 已存在的相同文件无需解析（写事务中会再次确认）
+            conn = self._connect()
             c = conn.cursor()
-            c.execute("SELECT id FROM knowledge_documents WHERE file_hash = ?", (file_hash,))
-            if c.fetchone():
+            c.execute("SELECT processing_error FROM knowledge_documents WHERE file_hash = ?", (file_hash,))
+            existing = c.fetchone()
+            if existing and existing[0] is None:
                 log_warning(f"文件 {filename} 已存在，跳过上传")
                 conn.close()
-                return False
+                result['reason'] = "文件已存在"
+                return result
             
-            # 提取文本内容
+            # 提取文本内容（耗时部分，不持有写锁）
             text_content = self.extract_text_from_file(file_content, filename)
             if not text_content.strip():
                 log_error(f"文件 {filename} 内容为空或无法解析")
                 conn.close()
-                return False
+                result['reason'] = "文件内容为空或无法解析"
+                return result
+            signature = self.minhasher.signature(text_content)
+            
+            # 加写锁后再检查相同文件和近似重复的文档，检查通过后在同一事务中插入
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("SELECT id, processing_error FROM knowledge_documents WHERE file_hash = ?", (file_hash,))
+            existing = c.fetchone()
+            if existing and existing[1] is not None:
+                # 之前处理失败的同一文件：清除失败记录后重新处理
+                c.execute("UPDATE knowledge_documents SET processing_error = NULL, processed = ? WHERE id = ?",
+                          (False, existing[0]))
+                conn.commit()
+                conn.close()
+                log_info(f"文件 {filename} 之前处理失败，重新处理")
+                return self._finish_upload(result, existing[0], filename, wait)
+            if existing:
+                conn.rollback()
+                conn.close()
+                log_warning(f"文件 {filename} 已存在，跳过上传")
+                result['reason'] = "文件已存在"
+                return result
+            
+            # 通过LSH索引查找近似重复的文档（重新编码或轻微修改的副本）
+            if self.near_duplicate_action != "allow":
+                duplicates = self._find_near_duplicates(c, signature)
+                if duplicates:
+                    duplicate = duplicates[0]
+                    conn.rollback()
+                    conn.close()
+                    result['duplicate'] = duplicate
+                    description = (f"与文档 {duplicate['filename']} 近似重复"
+                                   f"（相似度 {duplicate['similarity']:.2f}）")
+                    if self.near_duplicate_action == "merge":
+                        log_info(f"文件 {filename} {description}，作为新版本合并")
+                        result['document_id'] = duplicate['document_id']
+                        result['success'] = self.update_document(duplicate['document_id'], file_content)['success']
+                        if not result['success']:
+                            result['reason'] = f"{description}，作为新版本合并失败"
+                        return result
+                    log_warning(f"文件 {filename} {description}，跳过上传")
+                    result['reason'] = description
+                    return result
             
             # 保存文档到数据库
             file_size = len(file_content)
             file_type = os.path.splitext(filename)[1].lower()
             
-            # 插入文档记录
+            # 插入文档记录，处理完成前processed为False
             c.execute('''INSERT INTO knowledge_documents 
                          (filename, content, file_type, file_size, upload_time, file_hash, processed)
                          VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                     (filename, text_content, file_type, file_size, datetime.now(), file_hash, True))
+                     (filename, compress_text(text_content), file_type, file_size, datetime.now(), file_hash, False))
             
             document_id = c.lastrowid
+            self._store_signature(c, document_id, signature)
+            self._bump_metadata_version(c)
+            conn.commit()
+            conn.close()
             
-            # 分割文本并保存片段
+        except Exception as e:
+            log_error(f"上传文档失败: {str(e)}")
+            import traceback
+            log_error(f"详细错误: {traceback.format_exc()}")
+            # 如果出错，尝试回滚
+            try:
+                if conn:
+                    conn.rollback()
+                    conn.close()
+            except:
+                pass
+            result['reason'] = f"上传失败: {str(e)}"
+            return result
+        
+        return self._finish_upload(result, document_id, filename, wait)
+    
+    def _finish_upload(self, result: Dict[str, Any], document_id: int, filename: str,
+                       wait: bool) -> Dict[str, Any]:
+        """提交已保存的文档处理，并填写上传结果"""
+        result['document_id'] = document_id
+        result['success'] = self._submit_or_process(document_id, filename, wait)
+        if not result['success']:
+            result['reason'] = "文档处理失败"
+        return result
+    
+    def _submit_or_process(self, document_id: int, filename: str, wait: bool) -> bool:
+        """提交后台处理，wait为True或未启用异步处理时在当前线程内处理"""
+        if self.ingestion_queue is not None and not wait:
+            self.ingestion_queue.submit(document_id)
+            log_success(f"文档 {filename} 已保存，等待后台处理")
+            return True
+        
+        return self.process_document(document_id)
+    
+    def process_document(self, document_id: int) -> bool:
+        """
+        处理文档：分块、提取关键词、计算向量并更新倒排索引（可重复执行）
+
+        无法分块或处理出错时在文档上记录失败原因（processing_error），启动时不再自动重新入队
+        """
+        conn = None
+        file_hash = None
+        try:
+            conn = self._connect()
+            c = conn.cursor()
+            c.execute("SELECT filename, content, file_hash FROM knowledge_documents WHERE id = ?",
+                      (document_id,))
+            row = c.fetchone()
+            if not row:
+                log_warning(f"文档 {document_id} 不存在，跳过处理")
+                conn.close()
+                return False
+            
+            filename, stored_content, file_hash = row
+            text_content = decompress_text(stored_content)
+            
+            # 分割文本并计算片段向量（耗时部分，不持有写锁）
             chunks = self.chunk_text(text_content)
             if not chunks:
                 log_error(f"文件 {filename} 无法分割成有效块")
-                # 删除已插入的文档记录
-                c.execute("DELETE FROM knowledge_documents WHERE id = ?", (document_id,))
-                conn.commit()
                 conn.close()
+                self._record_processing_error(document_id, file_hash, "无法分割成有效块")
                 return False
             
-            # 保存文档块
-            for i, chunk in enumerate(chunks):
-                keywords = self.extract_keywords(chunk)
-                c.execute('''INSERT INTO document_chunks 
-                             (document_id, chunk_index, content, keywords)
-                             VALUES (?, ?, ?, ?)''',
-                         (document_id, i, chunk, keywords))
+            # 片段存储中已有的内容无需重复计算向量
+            hashes = [self.calculate_chunk_hash(chunk) for chunk in chunks]
+            stored = self._stored_hashes(c, hashes)
+            prepared = [self._prepare_chunk(chunk, with_vector=content_hash not in stored)
+                        for chunk, content_hash in zip(chunks, hashes)]
             
-            conn.commit()
+            # 旧版本文档补充MinHash签名
+            c.execute("SELECT 1 FROM document_minhash WHERE document_id = ?", (document_id,))
+            signature = None if c.fetchone() else self.minhasher.signature(text_content)
+            terms = extract_terms(text_content)
+            summary_vector = self._summary_vector(text_content)
+            
+            # 写入阶段：加写锁后确认文档仍然存在且内容未被更新，再替换旧的片段和索引
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("SELECT file_hash FROM knowledge_documents WHERE id = ?", (document_id,))
+            row = c.fetchone()
+            if not row or row[0] != file_hash:
+                conn.rollback()
+                conn.close()
+                log_warning(f"文档 {document_id} 在处理过程中被删除或更新")
+                return False
+            
+            self._delete_chunks(c, document_id)
+            
+            for i, prepared_chunk in enumerate(prepared):
+                self._insert_chunk(c, document_id, i, prepared_chunk)
+            
+            if signature is not None:
+                self._store_signature(c, document_id, signature)
+            
+            term_delta = self._store_terms(c, document_id, terms)
+            self._store_summary(c, document_id, summary_vector)
+            
+            c.execute("UPDATE knowledge_documents SET processed = ?, processing_error = NULL WHERE id = ?",
+                      (True, document_id))
+            self._commit_index_change(conn, term_delta)
             conn.close()
             
-            log_success(f"文档 {filename} 上传成功，分割为 {len(chunks)} 个块")
+            log_success(f"文档 {filename} 处理完成，分割为 {len(chunks)} 个块")
             return True
             
         except Exception as e:
-            log_error(f"上传文档失败: {str(e)}")
-            import traceback
-            log_error(f"详细错误: {traceback.format_exc()}")
-            # 如果出错，尝试回滚
+            log_error(f"处理文档失败: {str(e)}")
             try:
                 if conn:
                     conn.rollback()
                     conn.close()
             except:
                 pass
+            self._record_processing_error(document_id, file_hash, f"处理失败: {str(e)}")
             return False
     
-    def search_similar_documents(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
-        """搜索相似文档（支持关键词匹配和余弦相似度，带LRU缓存）"""
-        # 生成缓存键
-        query_hash = hashlib.md5(f"{query}_{top_k}_{self.similarity_method}".encode('utf-8')).hexdigest()
+    def _record_processing_error(self, document_id: int, file_hash: Optional[str], error: str) -> None:
+        """记录文档处理失败原因（文档在处理期间被更新时不记录，新内容会重新处理）"""
+        try:
+            conn = self._connect()
+            conn.execute('''UPDATE knowledge_documents SET processing_error = ?
+                            WHERE id = ? AND NOT processed AND (? IS NULL OR file_hash = ?)''',
+                         (error, document_id, file_hash, file_hash))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            log_error(f"记录文档处理失败原因失败: {str(e)}")
+    
+    def _store_signature(self, c, document_id: int, signature: List[int]) -> None:
+        """写入文档的MinHash签名及LSH分桶（替换旧值）"""
+        self._delete_signature(c, document_id)
+        c.execute("INSERT INTO document_minhash (document_id, signature) VALUES (?, ?)",
+                  (document_id, json.dumps(signature)))
+        c.executemany("INSERT INTO document_lsh_bands (band_index, band_hash, document_id) VALUES (?, ?, ?)",
+                      [(band_index, band_hash, document_id)
+                       for band_index, band_hash in enumerate(lsh_band_hashes(signature, LSH_BANDS))])
+    
+    def _store_terms(self, c, document_id: int, terms: Dict[str, int]) -> Dict[str, int]:
+        """替换文档的补全词汇，返回词频变化量"""
+        term_delta = {term: -frequency for term, frequency in self._delete_terms(c, document_id).items()}
+        for term, frequency in terms.items():
+            term_delta[term] = term_delta.get(term, 0) + frequency
+        c.executemany("INSERT INTO document_terms (document_id, term, frequency) VALUES (?, ?, ?)",
+                      [(document_id, term, frequency) for term, frequency in terms.items()])
+        return {term: delta for term, delta in term_delta.items() if delta}
+    
+    def _delete_terms(self, c, document_id: int) -> Dict[str, int]:
+        """删除文档的补全词汇，返回被删除的词频"""
+        c.execute("SELECT term, frequency FROM document_terms WHERE document_id = ?", (document_id,))
+        old_terms = dict(c.fetchall())
+        c.execute("DELETE FROM document_terms WHERE document_id = ?", (document_id,))
+        return old_terms
+    
+    def _commit_index_change(self, conn, term_delta: Dict[str, int]) -> None:
+        """
+        提交索引变更：递增索引版本后提交事务，并同步更新补全前缀树
+        （持有前缀树锁，避免与全量加载交错导致重复计数）
+        """
+        self._bump_index_version(conn.cursor())
+        with self.autocomplete_index.lock:
+            conn.commit()
+            self.autocomplete_index.apply(term_delta)
+    
+    def _bump_index_version(self, c) -> None:
+        """递增索引版本（在写事务中调用）"""
+        c.execute('''INSERT INTO kb_meta (key, value) VALUES ('index_version', 1)
+                     ON CONFLICT(key) DO UPDATE SET value = value + 1''')
+    
+    def _bump_metadata_version(self, c) -> None:
+        """递增文档属性版本（在修改knowledge_documents的文件名、类型、上传时间或增删文档的写事务中调用）"""
+        c.execute('''INSERT INTO kb_meta (key, value) VALUES ('metadata_version', 1)
+                     ON CONFLICT(key) DO UPDATE SET value = value + 1''')
+    
+    def get_index_version(self) -> int:
+        """
+        获取索引版本，文档处理、更新、删除或导入后递增
+
+        依赖检索结果的缓存（如语义回答缓存）可以按版本区分，知识库变化后自动失效
+        """
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute("SELECT value FROM kb_meta WHERE key = 'index_version'")
+        row = c.fetchone()
+        conn.close()
+        return row[0] if row else 0
+    
+    def _load_autocomplete(self) -> None:
+        """从数据库全量加载补全前缀树（旧版本文档先补充词汇）"""
+        with self.autocomplete_index.lock:
+            if self.autocomplete_index.loaded:
+                return
+            conn = self._connect()
+            c = conn.cursor()
+            c.execute('''SELECT id, content FROM knowledge_documents kd
+                         WHERE processed AND NOT EXISTS
+                               (SELECT 1 FROM document_terms dt WHERE dt.document_id = kd.id)''')
+            backfill = c.fetchall()
+            if backfill:
+                c.execute("BEGIN IMMEDIATE")
+                for document_id, stored_content in backfill:
+                    self._store_terms(c, document_id, extract_terms(decompress_text(stored_content)))
+                conn.commit()
+            
+            c.execute("SELECT term, SUM(frequency) FROM document_terms GROUP BY term")
+            self.autocomplete_index.load(c.fetchall())
+            conn.close()
+    
+    def autocomplete(self, prefix: str, limit: int = 5) -> List[Dict[str, Any]]:
+        """按前缀返回知识库中高频的作物、病害、虫害等词汇"""
+        prefix = prefix.strip()
+        if not prefix:
+            return []
+        try:
+            if not self.autocomplete_index.loaded:
+                self._load_autocomplete()
+            return [{'term': term, 'frequency': frequency}
+                    for term, frequency in self.autocomplete_index.complete(prefix, limit)]
+        except Exception as e:
+            log_error(f"自动补全失败: {str(e)}")
+            return []
+    
+    def _summary_vector(self, text: str) -> Dict[str, float]:
+        """计算文档摘要向量（全文词频向量中权重最高的若干词）"""
+        vector = self._compute_vector(text)
+        top_terms = sorted(vector.items(), key=lambda item: item[1], reverse=True)[:SUMMARY_VECTOR_TERMS]
+        return dict(top_terms)
+    
+    def _store_summary(self, c, document_id: int, summary_vector: Dict[str, float]) -> None:
+        """写入文档摘要向量及其倒排索引（替换旧值，无词的文档也保留一行，避免反复重新处理）"""
+        self._delete_summary(c, document_id)
+        c.execute("INSERT INTO document_summary (document_id, vector_norm) VALUES (?, ?)",
+                  (document_id, self.vector_norm(summary_vector)))
+        c.executemany("INSERT INTO summary_postings (term, document_id, weight) VALUES (?, ?, ?)",
+                      [(term, document_id, weight) for term, weight in summary_vector.items()])
+    
+    def _delete_summary(self, c, document_id: int) -> None:
+        """删除文档摘要向量及其倒排索引"""
+        c.execute("DELETE FROM document_summary WHERE document_id = ?", (document_id,))
+        c.execute("DELETE FROM summary_postings WHERE document_id = ?", (document_id,))
+    
+    def _delete_signature(self, c, document_id: int) -> None:
+        """删除文档的MinHash签名及LSH分桶"""
+        c.execute("DELETE FROM document_minhash WHERE document_id = ?", (document_id,))
+        c.execute("DELETE FROM document_lsh_bands WHERE document_id = ?", (document_id,))
+    
+    def _find_near_duplicates(self, c, signature: List[int], exclude_id: Optional[int] = None,
+                              threshold: Optional[float] = None) -> List[Dict[str, Any]]:
+        """通过LSH分桶查找候选文档，再用签名估计的Jaccard相似度过滤"""
+        threshold = self.near_duplicate_threshold if threshold is None else threshold
+        
+        # 只有至少一个band完全相同的文档才会成为候选
+        candidates = set()
+        for band_index, band_hash in enumerate(lsh_band_hashes(signature, LSH_BANDS)):
+            c.execute("SELECT document_id FROM document_lsh_bands WHERE band_index = ? AND band_hash = ?",
+                      (band_index, band_hash))
+            candidates.update(row[0] for row in c.fetchall())
+        candidates.discard(exclude_id)
+        
+        duplicates = []
+        for batch in iter_batches(list(candidates)):
+            placeholders = ','.join('?' * len(batch))
+            c.execute(f'''SELECT dm.document_id, dm.signature, kd.filename
+                          FROM document_minhash dm
+                          JOIN knowledge_documents kd ON dm.document_id = kd.id
+                          WHERE dm.document_id IN ({placeholders}) AND kd.processing_error IS NULL''', batch)
+            for document_id, stored_signature, filename in c.fetchall():
+                similarity = estimate_jaccard(signature, json.loads(stored_signature))
+                if similarity >= threshold:
+                    duplicates.append({
+                        'document_id': document_id,
+                        'filename': filename,
+                        'similarity': similarity
+                    })
+        
+        duplicates.sort(key=lambda x: x['similarity'], reverse=True)
+        return duplicates
+    
+    def find_near_duplicates(self, text: str, threshold: Optional[float] = None) -> List[Dict[str, Any]]:
+        """查找与给定文本近似重复的文档"""
+        conn = self._connect()
+        c = conn.cursor()
+        duplicates = self._find_near_duplicates(c, self.minhasher.signature(text), threshold=threshold)
+        conn.close()
+        return duplicates
+    
+    def _prepare_chunk(self, chunk: str, with_vector: bool = True) -> Dict[str, Any]:
+        """计算片段的哈希，以及（需要时）关键词和向量（不访问数据库）"""
+        prepared = {
+            'content': chunk,
+            'content_hash': self.calculate_chunk_hash(chunk)
+        }
+        if with_vector:
+            vector = self._compute_vector(chunk)
+            prepared['keywords'] = self.extract_keywords(chunk)
+            prepared['vector'] = vector
+            prepared['norm'] = self.vector_norm(vector)
+        return prepared
+    
+    def _stored_hashes(self, c, hashes: List[str]) -> set:
+        """查询片段存储中已存在的内容哈希"""
+        stored = set()
+        unique_hashes = list(set(hashes))
+        for batch in iter_batches(unique_hashes):
+            placeholders = ','.join('?' * len(batch))
+            c.execute(f"SELECT content_hash FROM chunk_store WHERE content_hash IN ({placeholders})", batch)
+            stored.update(row[0] for row in c.fetchall())
+        return stored
+    
+    def _insert_chunk(self, c, document_id: int, chunk_index: int, prepared: Dict[str, Any]) -> int:
+        """写入文档片段并增加片段存储的引用计数，新内容同时写入倒排索引，返回片段ID"""
+        content_hash = prepared['content_hash']
+        c.execute("UPDATE chunk_store SET ref_count = ref_count + 1 WHERE content_hash = ?",
+                  (content_hash,))
+        if c.rowcount == 0:
+            if 'vector' not in prepared:
+                prepared = self._prepare_chunk(prepared['content'])
+            c.execute('''INSERT INTO chunk_store
+                         (content_hash, content, keywords, vector_norm, ref_count, content_length)
+                         VALUES (?, ?, ?, ?, 1, ?)''',
+                     (content_hash, compress_text(prepared['content']), prepared['keywords'],
+                      prepared['norm'], len(prepared['content'])))
+            c.executemany("INSERT INTO term_postings (term, content_hash, weight) VALUES (?, ?, ?)",
+                          [(term, content_hash, weight) for term, weight in prepared['vector'].items()])
+        
+        c.execute('''INSERT INTO document_chunks (document_id, chunk_index, content_hash)
+                     VALUES (?, ?, ?)''',
+                 (document_id, chunk_index, content_hash))
+        return c.lastrowid
+    
+    def _release_hashes(self, c, hashes: List[str]) -> None:
+        """减少片段存储的引用计数，无引用的片段连同倒排索引一起删除"""
+        for content_hash, count in Counter(h for h in hashes if h).items():
+            c.execute("UPDATE chunk_store SET ref_count = ref_count - ? WHERE content_hash = ?",
+                      (count, content_hash))
+        
+        unique_hashes = list(set(h for h in hashes if h))
+        for batch in iter_batches(unique_hashes):
+            placeholders = ','.join('?' * len(batch))
+            c.execute(f'''SELECT content_hash FROM chunk_store
+                          WHERE content_hash IN ({placeholders}) AND ref_count <= 0''', batch)
+            orphaned = [row[0] for row in c.fetchall()]
+            if orphaned:
+                orphan_placeholders = ','.join('?' * len(orphaned))
+                c.execute(f"DELETE FROM term_postings WHERE content_hash IN ({orphan_placeholders})", orphaned)
+                c.execute(f"DELETE FROM chunk_store WHERE content_hash IN ({orphan_placeholders})", orphaned)
+    
+    def _delete_chunk_ids(self, c, chunk_ids: List[int]) -> None:
+        """按片段ID删除文档片段并释放其引用的片段存储"""
+        for batch in iter_batches(chunk_ids):
+            placeholders = ','.join('?' * len(batch))
+            c.execute(f"SELECT content_hash FROM document_chunks WHERE id IN ({placeholders})", batch)
+            hashes = [row[0] for row in c.fetchall()]
+            c.execute(f"DELETE FROM document_chunks WHERE id IN ({placeholders})", batch)
+            self._release_hashes(c, hashes)
+    
+    def _delete_chunks(self, c, document_id: int) -> None:
+        """删除文档的所有片段并释放其引用的片段存储"""
+        c.execute("SELECT content_hash FROM document_chunks WHERE document_id = ?", (document_id,))
+        hashes = [row[0] for row in c.fetchall()]
+        c.execute("DELETE FROM document_chunks WHERE document_id = ?", (document_id,))
+        self._release_hashes(c, hashes)
+    
+    def update_document(self, document_id: int, file_content: bytes,
+                        filename: Optional[str] = None) -> Dict[str, Any]:
+        """
+        用新版本内容更新文档，增量更新索引
+
+        按片段内容哈希对比新旧版本，未变化的片段直接复用其向量和倒排索引，
+        只对新增片段计算向量（片段存储中已有的内容也无需计算），删除不再存在的片段
+
+        Returns:
+            包含success、reused_chunks、added_chunks、removed_chunks的字典
+        """
+        result = {'success': False, 'reused_chunks': 0, 'added_chunks': 0, 'removed_chunks': 0}
+        conn = None
+        try:
+            file_hash = self.calculate_file_hash(file_content)
+            
+            conn = self._connect()
+            c = conn.cursor()
+            c.execute("SELECT filename, file_hash, processed FROM knowledge_documents WHERE id = ?",
+                      (document_id,))
+            row = c.fetchone()
+            if not row:
+                log_error("文档不存在")
+                conn.close()
+                return result
+            
+            old_filename, old_hash, processed = row
+            filename = filename or old_filename
+            
+            if file_hash == old_hash:
+                log_info(f"文档 {filename} 内容未变化，无需更新")
+                conn.close()
+                result['success'] = True
+                return result
+            
+            c.execute("SELECT id FROM knowledge_documents WHERE file_hash = ? AND id != ?",
+                      (file_hash, document_id))
+            if c.fetchone():
+                log_warning(f"文件 {filename} 与已有文档内容相同，跳过更新")
+                conn.close()
+                return result
+            
+            text_content = self.extract_text_from_file(file_content, filename)
+            chunks = self.chunk_text(text_content)
+            if not chunks:
+                log_error(f"文件 {filename} 内容为空或无法解析")
+                conn.close()
+                return result
+            
+            file_type = os.path.splitext(filename)[1].lower()
+            signature = self.minhasher.signature(text_content)
+            terms = extract_terms(text_content)
+            summary_vector = self._summary_vector(text_content)
+            
+            # 加写锁后再读取旧片段，避免与后台处理线程交错
+            c.execute("BEGIN IMMEDIATE")
+            c.execute('''UPDATE knowledge_documents
+                         SET filename = ?, content = ?, file_type = ?, file_size = ?, file_hash = ?,
+                             processing_error = NULL
+                         WHERE id = ?''',
+                     (filename, compress_text(text_content), file_type, len(file_content), file_hash, document_id))
+            self._bump_metadata_version(c)
+            self._store_signature(c, document_id, signature)
+            
+            if not processed or (self.ingestion_queue is not None
+                                 and self.ingestion_queue.is_pending(document_id)):
+                # 文档尚未处理完成，交给后台按新内容重新处理
+                c.execute("UPDATE knowledge_documents SET processed = ? WHERE id = ?", (False, document_id))
+                conn.commit()
+                conn.close()
+                if self.ingestion_queue is not None:
+                    self.ingestion_queue.submit(document_id)
+                else:
+                    self.process_document(document_id)
+                result['success'] = True
+                result['added_chunks'] = len(chunks)
+                return result
+            
+            # 旧片段按内容哈希分组（同一文档中可能有重复片段）
+            c.execute('''SELECT dc.id, dc.chunk_index, dc.content_hash, cs.content_hash
+                         FROM document_chunks dc
+                         LEFT JOIN chunk_store cs ON dc.content_hash = cs.content_hash
+                         WHERE dc.document_id = ?
+                         ORDER BY dc.chunk_index''', (document_id,))
+            existing = {}
+            old_ids = []
+            for chunk_id, chunk_index, content_hash, stored_hash in c.fetchall():
+                old_ids.append(chunk_id)
+                if stored_hash is None:
+                    continue  # 不在片段存储中的片段不能复用
+                existing.setdefault(content_hash, []).append((chunk_id, chunk_index))
+            
+            reused_ids = set()
+            for i, chunk in enumerate(chunks):
+                content_hash = self.calculate_chunk_hash(chunk)
+                candidates = existing.get(content_hash)
+                if candidates:
+                    chunk_id, old_index = candidates.pop(0)
+                    reused_ids.add(chunk_id)
+                    if old_index != i:
+                        c.execute("UPDATE document_chunks SET chunk_index = ? WHERE id = ?",
+                                  (i, chunk_id))
+                    result['reused_chunks'] += 1
+                else:
+                    self._insert_chunk(c, document_id, i, self._prepare_chunk(chunk))
+                    result['added_chunks'] += 1
+            
+            # 删除新版本中不再存在的片段
+            stale_ids = [chunk_id for chunk_id in old_ids if chunk_id not in reused_ids]
+            self._delete_chunk_ids(c, stale_ids)
+            result['removed_chunks'] = len(stale_ids)
+            
+            term_delta = self._store_terms(c, document_id, terms)
+            self._store_summary(c, document_id, summary_vector)
+            self._commit_index_change(conn, term_delta)
+            conn.close()
+            
+            self.search_cache.clear()
+            result['success'] = True
+            log_success(f"文档 {filename} 已更新：复用 {result['reused_chunks']} 个片段，"
+                        f"新增 {result['added_chunks']} 个，删除 {result['removed_chunks']} 个")
+            return result
+            
+        except Exception as e:
+            log_error(f"更新文档失败: {str(e)}")
+            try:
+                if conn:
+                    conn.rollback()
+                    conn.close()
+            except:
+                pass
+            return result
+    
+    def rebuild_index(self) -> int:
+        """将所有文档标记为未处理并重新建立索引，返回文档数"""
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute("UPDATE knowledge_documents SET processed = ?, processing_error = NULL", (False,))
+        c.execute("SELECT id FROM knowledge_documents")
+        document_ids = [row[0] for row in c.fetchall()]
+        conn.commit()
+        conn.close()
+        
+        for document_id in document_ids:
+            if self.ingestion_queue is not None:
+                self.ingestion_queue.submit(document_id)
+            else:
+                self.process_document(document_id)
+        
+        self.search_cache.clear()
+        return len(document_ids)
+    
+    def wait_for_ingestion(self, timeout: Optional[float] = None) -> bool:
+        """等待后台处理队列清空"""
+        if self.ingestion_queue is None:
+            return True
+        return self.ingestion_queue.wait_until_idle(timeout)
+    
+    def search_similar_documents(self, query: str, top_k: int = 5,
+                                 file_types: Optional[List[str]] = None,
+                                 document_ids: Optional[List[int]] = None,
+                                 uploaded_after: Any = None,
+                                 uploaded_before: Any = None) -> List[Dict[str, Any]]:
+        """
+        搜索相似文档（支持关键词匹配和余弦相似度，带LRU缓存）
+
+        Args:
+            query: 查询文本
+            top_k: 返回结果数
+            file_types: 只搜索这些文件类型的文档，如['.txt']
+            document_ids: 只搜索这些文档
+            uploaded_after: 上传时间下界（datetime、date或字符串，包含）
+            uploaded_before: 上传时间上界（包含，只给日期时包含当天）
+        """
+        filters = {
+            'file_types': sorted(file_types) if file_types is not None else None,
+            'document_ids': sorted(document_ids) if document_ids is not None else None,
+            'uploaded_after': uploaded_after,
+            'uploaded_before': uploaded_before
+        }
+        has_filters = any(value is not None for value in filters.values())
+        
+        # 生成缓存键（余弦搜索只依赖规范化后的查询，仅标点或空白不同的问题共用缓存）
+        filter_key = f"_{filters}" if has_filters else ""
+        cache_query = self.normalize_query(query) if self.similarity_method == "cosine" else query
+        query_hash = hashlib.md5(f"{cache_query}_{top_k}_{self.similarity_method}{filter_key}".encode('utf-8')).hexdigest()
         cache_key = f"search_{query_hash}"
         
         # 检查缓存
         cached_results = self.search_cache.get(cache_key)
+        annotate(search_cache='miss' if cached_results is None else 'hit')
         if cached_results is not None:
             log_info(f"搜索缓存命中: {query[:50]}...")
             return cached_results
         
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             c = conn.cursor()
             
-            if self.similarity_method == "cosine":
-                # 使用余弦相似度算法
-                results = self._search_with_cosine_similarity(conn, query, top_k)
+            # 过滤条件先在位图上求交集，再换算为允许打分的片段
+            allowed = self._resolve_filters(c, filters) if has_filters else None
+            if allowed is not None and not allowed[0]:
+                conn.close()
+                results = []
+            elif self.similarity_method == "cosine":
+                # 使用余弦相似度算法（先按文档摘要粗排，置信度不足时回退全量搜索）
+                results = self._coarse_to_fine_search(query, top_k, allowed) if self.coarse_to_fine else None
+                annotate(search_path='full' if results is None else 'coarse_to_fine')
+                if results is None:
+                    results = self._search_with_cosine_similarity(conn, query, top_k, allowed)
+                else:
+                    conn.close()
             else:
                 # 使用传统关键词匹配算法
-                results = self._search_with_keyword_matching(conn, query, top_k)
+                results = self._search_with_keyword_matching(conn, query, top_k, allowed)
             
             # 缓存结果
             self.search_cache.put(cache_key, results)
@@ -343,45 +1203,204 @@ class SimpleRAGKnowledgeBase:
             log_error(f"搜索失败: {str(e)}")
             return []
     
-    def _search_with_cosine_similarity(self, conn, query: str, top_k: int) -> List[Dict[str, Any]]:
-        """使用余弦相似度进行搜索"""
+    def _get_metadata_index(self, c) -> DocumentBitmapIndex:
+        """
+        获取文档属性位图索引，文档属性版本变化（含其他会话的修改）时重建
+
+        所有修改文档属性的写事务都递增metadata_version；文档数和最大ID一并比较，
+        兼容未递增版本的旧版本程序写入的文档
+        """
+        c.execute('''SELECT (SELECT value FROM kb_meta WHERE key = 'metadata_version'),
+                            COUNT(*), COALESCE(MAX(id), 0)
+                     FROM knowledge_documents''')
+        fingerprint = c.fetchone()
+        with self._metadata_lock:
+            if self._metadata_index is None or fingerprint != self._metadata_fingerprint:
+                c.execute("SELECT id, file_type, upload_time FROM knowledge_documents")
+                self._metadata_index = DocumentBitmapIndex(c.fetchall())
+                self._metadata_fingerprint = fingerprint
+            return self._metadata_index
+
+    def _resolve_filters(self, c, filters: Dict[str, Any]) -> tuple:
+        """
+        将过滤条件换算为允许的文档和片段
+
+        Returns:
+            (允许的文档ID集合, 允许的片段哈希集合, 是否为高选择性过滤)
+        """
+        metadata_index = self._get_metadata_index(c)
+        allowed_documents = bitmap_to_ids(metadata_index.select(**filters))
+        allowed_hashes = self._document_chunk_hashes(c, allowed_documents)
+
+        # 只剩少量文档时，按片段读取倒排索引比按查询词扫描全部片段更快
+        selective = len(allowed_documents) * 10 <= metadata_index.document_count()
+        return set(allowed_documents), allowed_hashes, selective
+
+    def _document_chunk_hashes(self, c, document_ids: List[int]) -> set:
+        """获取文档引用的全部片段哈希"""
+        hashes = set()
+        for batch in iter_batches(list(document_ids)):
+            placeholders = ','.join('?' * len(batch))
+            c.execute(f'''SELECT DISTINCT content_hash FROM document_chunks
+                          WHERE document_id IN ({placeholders}) AND content_hash IS NOT NULL''', batch)
+            hashes.update(row[0] for row in c.fetchall())
+        return hashes
+
+    def _coarse_to_fine_search(self, query: str, top_k: int,
+                               allowed: Optional[tuple] = None) -> Optional[List[Dict[str, Any]]]:
+        """
+        粗排到精排的两阶段搜索：先用文档摘要向量选出候选文档，再只对候选文档的片段打分
+
+        Returns:
+            搜索结果；文档数太少、粗排置信度不足或候选结果不够时返回None，由调用方回退全量搜索
+        """
+        query_vector = self.query_vector(query)
+        query_norm = self.vector_norm(query_vector)
+        if query_norm == 0:
+            return None
+
+        conn = self._connect()
+        c = conn.cursor()
+        allowed_documents = allowed[0] if allowed is not None else None
+        if allowed_documents is not None:
+            document_count = len(allowed_documents)
+        else:
+            c.execute("SELECT COUNT(*) FROM document_summary")
+            document_count = c.fetchone()[0]
+        if document_count < COARSE_MIN_DOCUMENTS:
+            conn.close()
+            return None
+
+        # 通过摘要倒排索引累加文档级点积
+        dot_products = {}
+        summary_norms = {}
+        for batch in iter_batches(list(query_vector.keys())):
+            placeholders = ','.join('?' * len(batch))
+            c.execute(f'''SELECT sp.document_id, sp.term, sp.weight, ds.vector_norm
+                          FROM summary_postings sp
+                          JOIN document_summary ds ON sp.document_id = ds.document_id
+                          WHERE sp.term IN ({placeholders})''', batch)
+            for document_id, term, weight, norm in c.fetchall():
+                if allowed_documents is not None and document_id not in allowed_documents:
+                    continue
+                dot_products[document_id] = dot_products.get(document_id, 0.0) + weight * query_vector[term]
+                summary_norms[document_id] = norm
+
+        ranked = sorted(((dot_product / (query_norm * summary_norms[document_id]), document_id)
+                         for document_id, dot_product in dot_products.items() if summary_norms[document_id]),
+                        reverse=True)
+        if not ranked or ranked[0][0] < COARSE_MIN_SCORE:
+            conn.close()
+            log_info(f"粗排置信度不足，回退全量搜索: {query[:50]}...")
+            return None
+
+        candidates = [document_id for _, document_id in ranked[:max(COARSE_TOP_DOCUMENTS, top_k)]]
+        candidate_hashes = self._document_chunk_hashes(c, candidates)
+        log_info(f"粗排选出 {len(candidates)}/{document_count} 个文档，共 {len(candidate_hashes)} 个片段")
+
+        results = self._search_with_cosine_similarity(conn, query, top_k,
+                                                      (set(candidates), candidate_hashes, True))
+        if len(results) < top_k:
+            log_info(f"候选文档结果不足 {top_k} 条，回退全量搜索: {query[:50]}...")
+            return None
+        return results
+
+    def _search_with_cosine_similarity(self, conn, query: str, top_k: int,
+                                       allowed: Optional[tuple] = None) -> List[Dict[str, Any]]:
+        """使用余弦相似度进行搜索（基于倒排索引，每个唯一片段只打分一次）"""
         c = conn.cursor()
-        
-        # 获取所有文档片段
-        c.execute('''SELECT dc.document_id, dc.chunk_index, dc.content, dc.keywords,
-                            kd.filename
-                     FROM document_chunks dc
-                     JOIN knowledge_documents kd ON dc.document_id = kd.id''')
-        
-        all_docs = c.fetchall()
-        results = []
         
         # 计算查询向量
-        query_vector = self.text_to_vector(query)
+        query_vector = self.query_vector(query)
+        query_norm = self.vector_norm(query_vector)
+        if query_norm == 0:
+            conn.close()
+            return []
+        
+        # 通过倒排索引累加点积
+        dot_products = {}
+        chunk_norms = {}
+        allowed_documents, allowed_hashes, selective = allowed if allowed is not None else (None, None, False)
+        if selective:
+            # 高选择性过滤：只读取允许片段的倒排记录，再与查询词求交
+            key_column, keys = 'p.content_hash', list(allowed_hashes)
+        else:
+            key_column, keys = 'p.term', list(query_vector.keys())
+        for batch in iter_batches(keys):
+            placeholders = ','.join('?' * len(batch))
+            c.execute(f'''SELECT p.content_hash, p.term, p.weight, cs.vector_norm
+                          FROM term_postings p
+                          JOIN chunk_store cs ON p.content_hash = cs.content_hash
+                          WHERE {key_column} IN ({placeholders})''', batch)
+            for content_hash, term, weight, norm in c.fetchall():
+                if term not in query_vector:
+                    continue
+                if allowed_hashes is not None and content_hash not in allowed_hashes:
+                    continue
+                dot_products[content_hash] = dot_products.get(content_hash, 0.0) + weight * query_vector[term]
+                chunk_norms[content_hash] = norm
         
-        for row in all_docs:
-            document_id, chunk_index, content, keywords, filename = row
+        scored = []
+        for content_hash, dot_product in dot_products.items():
+            norm = chunk_norms[content_hash]
+            if not norm:
+                continue
             
             # 计算余弦相似度
-            cosine_sim = self.calculate_cosine_similarity(query, content)
+            cosine_sim = dot_product / (query_norm * norm)
             
             # 设置阈值过滤
             if cosine_sim > 0.05:  # 余弦相似度阈值
-                results.append({
-                    'document_id': document_id,
-                    'chunk_index': chunk_index,
-                    'content': content,
-                    'filename': filename,
-                    'similarity_score': cosine_sim,
-                    'similarity_method': 'cosine'
-                })
-        
-        # 按相似度排序并返回前top_k个结果
-        results.sort(key=lambda x: x['similarity_score'], reverse=True)
+                scored.append((cosine_sim, content_hash))
+        
+        # 按相似度排序
+        scored.sort(key=lambda x: x[0], reverse=True)
+        
+        results = self._expand_scored_chunks(c, scored, top_k, 'cosine', allowed_documents)
         conn.close()
+        return results
+    
+    def _expand_scored_chunks(self, c, scored: List[tuple], top_k: int, similarity_method: str,
+                              allowed_documents: Optional[set] = None) -> List[Dict[str, Any]]:
+        """将按唯一片段计算的分数展开到引用这些片段的文档（只展开到允许的文档），只读取返回结果的内容"""
+        results = []
+        for batch_start in range(0, len(scored), top_k or 1):
+            if len(results) >= top_k:
+                break
+            batch = scored[batch_start:batch_start + (top_k or 1)]
+            hashes = [content_hash for _, content_hash in batch]
+            placeholders = ','.join('?' * len(hashes))
+            c.execute(f'''SELECT dc.content_hash, dc.document_id, dc.chunk_index, kd.filename
+                          FROM document_chunks dc
+                          JOIN knowledge_documents kd ON dc.document_id = kd.id
+                          WHERE dc.content_hash IN ({placeholders})
+                          ORDER BY dc.document_id, dc.chunk_index''', hashes)
+            references = {}
+            for content_hash, document_id, chunk_index, filename in c.fetchall():
+                if allowed_documents is not None and document_id not in allowed_documents:
+                    continue
+                references.setdefault(content_hash, []).append((document_id, chunk_index, filename))
+            
+            # 只解压最终返回的片段
+            c.execute(f"SELECT content_hash, content FROM chunk_store WHERE content_hash IN ({placeholders})",
+                      hashes)
+            contents = {content_hash: decompress_text(content) for content_hash, content in c.fetchall()}
+            
+            for score, content_hash in batch:
+                for document_id, chunk_index, filename in references.get(content_hash, []):
+                    results.append({
+                        'document_id': document_id,
+                        'chunk_index': chunk_index,
+                        'content': contents.get(content_hash, ''),
+                        'filename': filename,
+                        'similarity_score': score,
+                        'similarity_method': similarity_method
+                    })
+        
         return results[:top_k]
     
-    def _search_with_keyword_matching(self, conn, query: str, top_k: int) -> List[Dict[str, Any]]:
+    def _search_with_keyword_matching(self, conn, query: str, top_k: int,
+                                      allowed: Optional[tuple] = None) -> List[Dict[str, Any]]:
         """使用关键词匹配进行搜索（原有算法）"""
         c = conn.cursor()
         
@@ -389,21 +1408,14 @@ class SimpleRAGKnowledgeBase:
         query_keywords = self.extract_keywords(query)
         query_lower = query.lower()
         
-        # 基于关键词匹配搜索
-        c.execute('''SELECT dc.document_id, dc.chunk_index, dc.content, dc.keywords,
-                            kd.filename
-                     FROM document_chunks dc
-                     JOIN knowledge_documents kd ON dc.document_id = kd.id
-                     WHERE dc.keywords LIKE ? OR dc.content LIKE ?
-                     ORDER BY 
-                         CASE WHEN dc.keywords LIKE ? THEN 1 ELSE 2 END,
-                         LENGTH(dc.content) DESC
-                     LIMIT ?''',
-                 (f'%{query}%', f'%{query}%', f'%{query}%', top_k * 2))  # 获取更多结果用于筛选
+        # 基于关键词匹配搜索（在去重后的片段存储上进行，每个唯一片段只打分一次）
+        allowed_documents, allowed_hashes = (allowed[0], allowed[1]) if allowed is not None else (None, None)
+        # 关键词命中的优先，其次内容较长的优先，获取更多结果用于筛选
+        matches = self._find_keyword_matches(c, query, allowed_hashes, limit=top_k * 2)
         
-        results = []
-        for row in c.fetchall():
-            document_id, chunk_index, content, keywords, filename = row
+        scored = []
+        for row in matches:
+            content_hash, content, keywords = row
             
             # 计算改进的相似度分数
             similarity_score = 0.0
@@ -438,26 +1450,80 @@ class SimpleRAGKnowledgeBase:
                 similarity_score *= 0.8
             
             if similarity_score > 0.1:  # 提高阈值，只返回真正相关的内容
-                results.append({
-                    'document_id': document_id,
-                    'chunk_index': chunk_index,
-                    'content': content,
-                    'filename': filename,
-                    'similarity_score': min(similarity_score, 1.0),
-                    'similarity_method': 'keyword'
-                })
-        
-        # 按相似度排序并返回前top_k个结果
-        results.sort(key=lambda x: x['similarity_score'], reverse=True)
+                scored.append((min(similarity_score, 1.0), content_hash))
+        
+        # 按相似度排序并展开为前top_k个结果
+        scored.sort(key=lambda x: x[0], reverse=True)
+        results = self._expand_scored_chunks(c, scored, top_k, 'keyword', allowed_documents)
         conn.close()
-        return results[:top_k]
+        return results
+    
+    def _find_keyword_matches(self, c, query: str, allowed_hashes: Optional[set] = None,
+                              limit: Optional[int] = None) -> List[tuple]:
+        """
+        查找关键词或内容包含查询串的片段，返回(content_hash, content, keywords)列表，
+        关键词命中的在前，其次按原文长度从长到短，最多limit个
+
+        内容压缩存储后不能直接用LIKE匹配：先用倒排索引筛出包含查询中所有索引词的片段
+        （内容包含查询串的必要条件），按关键词和content_length排好序后依次解压做子串判断，
+        找到limit个即停止
+        """
+        query_lower = query.lower()
+        
+        c.execute("SELECT content_hash FROM chunk_store WHERE keywords LIKE ?", (f'%{query}%',))
+        candidates = set(row[0] for row in c.fetchall())
+        
+        query_terms = list(set(self.preprocess_text(query)))
+        if query_terms and len(query_terms) <= SQL_BATCH_SIZE:
+            placeholders = ','.join('?' * len(query_terms))
+            c.execute(f'''SELECT content_hash FROM term_postings
+                          WHERE term IN ({placeholders})
+                          GROUP BY content_hash
+                          HAVING COUNT(DISTINCT term) = ?''', query_terms + [len(query_terms)])
+            candidates.update(row[0] for row in c.fetchall())
+        elif allowed_hashes is not None:
+            # 查询中没有可用的索引词，只扫描过滤后的片段
+            candidates.update(allowed_hashes)
+        else:
+            # 查询中没有可用的索引词，只能扫描全部片段
+            c.execute("SELECT content_hash FROM chunk_store")
+            candidates.update(row[0] for row in c.fetchall())
+        
+        if allowed_hashes is not None:
+            candidates &= allowed_hashes
+        
+        # 排序只需关键词和原文长度，不解压内容（旧版本未记录长度的片段为未压缩文本，直接取LENGTH）
+        ordered = []
+        for batch in iter_batches(list(candidates)):
+            placeholders = ','.join('?' * len(batch))
+            c.execute(f'''SELECT content_hash, keywords, COALESCE(content_length, LENGTH(content))
+                          FROM chunk_store WHERE content_hash IN ({placeholders})''', batch)
+            ordered.extend((content_hash, keywords or '', length or 0)
+                           for content_hash, keywords, length in c.fetchall())
+        ordered.sort(key=lambda x: (0 if query_lower in x[1].lower() else 1, -x[2]))
+        
+        matches = []
+        for batch in iter_batches(ordered):
+            placeholders = ','.join('?' * len(batch))
+            c.execute(f"SELECT content_hash, content FROM chunk_store WHERE content_hash IN ({placeholders})",
+                      [content_hash for content_hash, _, _ in batch])
+            stored_contents = dict(c.fetchall())
+            for content_hash, keywords, _ in batch:
+                if content_hash not in stored_contents:
+                    continue  # 排序后被删除
+                content = decompress_text(stored_contents[content_hash])
+                if query_lower in keywords.lower() or query_lower in content.lower():
+                    matches.append((content_hash, content, keywords))
+                    if limit is not None and len(matches) >= limit:
+                        return matches
+        return matches
     
     def get_document_list(self) -> List[Dict[str, Any]]:
         """获取知识库文档列表"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         c = conn.cursor()
         
-        c.execute('''SELECT id, filename, file_type, file_size, upload_time, processed
+        c.execute('''SELECT id, filename, file_type, file_size, upload_time, processed, processing_error
                      FROM knowledge_documents 
                      ORDER BY upload_time DESC''')
         
@@ -469,7 +1535,8 @@ class SimpleRAGKnowledgeBase:
                 'file_type': row[2],
                 'file_size': row[3],
                 'upload_time': row[4],
-                'processed': row[5]
+                'processed': row[5],
+                'processing_error': row[6]
             })
         
         conn.close()
@@ -478,7 +1545,7 @@ class SimpleRAGKnowledgeBase:
     def delete_document(self, document_id: int) -> bool:
         """删除文档"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             c = conn.cursor()
             
             # 获取文档信息
@@ -491,15 +1558,20 @@ class SimpleRAGKnowledgeBase:
             
             filename = result[0]
             
-            # 删除文档块
-            c.execute("DELETE FROM document_chunks WHERE document_id = ?", (document_id,))
+            # 删除文档块及其索引
+            self._delete_chunks(c, document_id)
+            self._delete_signature(c, document_id)
+            self._delete_summary(c, document_id)
+            term_delta = {term: -frequency for term, frequency in self._delete_terms(c, document_id).items()}
             
             # 删除文档
             c.execute("DELETE FROM knowledge_documents WHERE id = ?", (document_id,))
+            self._bump_metadata_version(c)
             
-            conn.commit()
+            self._commit_index_change(conn, term_delta)
             conn.close()
             
+            self.search_cache.clear()
             log_success(f"文档 {filename} 已删除")
             return True
             
@@ -509,7 +1581,7 @@ class SimpleRAGKnowledgeBase:
     
     def get_knowledge_base_stats(self) -> Dict[str, Any]:
         """获取知识库统计信息"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         c = conn.cursor()
         
         # 文档统计
@@ -527,6 +1599,16 @@ class SimpleRAGKnowledgeBase:
         c.execute("SELECT SUM(file_size) FROM knowledge_documents")
         total_size = c.fetchone()[0] or 0
         
+        # 去重后的唯一片段数（即索引中的向量数）和待处理文档数
+        c.execute("SELECT COUNT(*) FROM chunk_store")
+        index_vectors = c.fetchone()[0]
+        
+        c.execute("SELECT COUNT(*) FROM knowledge_documents WHERE NOT processed AND processing_error IS NULL")
+        pending_documents = c.fetchone()[0]
+        
+        c.execute("SELECT COUNT(*) FROM knowledge_documents WHERE processing_error IS NOT NULL")
+        failed_documents = c.fetchone()[0]
+        
         conn.close()
         
         return {
@@ -534,7 +1616,10 @@ class SimpleRAGKnowledgeBase:
             'total_chunks': total_chunks,
             'file_types': file_types,
             'total_size_mb': round(total_size / (1024 * 1024), 2),
-            'index_vectors': total_chunks  # 简化版使用文档块数量
+            'unique_chunks': index_vectors,
+            'index_vectors': index_vectors,
+            'pending_documents': pending_documents,
+            'failed_documents': failed_documents
         }
     
     def get_cache_stats(self) -> Dict[str, Any]:
@@ -1,23 +1,47 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 from rag_knowledge_base_simple import SimpleRAGKnowledgeBase
-from silican_api import SilicanAPI
+from context_packer import ContextPacker
+from conversation_memory import ConversationMemory, is_follow_up_question
+from faq_store import FAQStore
+from semantic_cache import get_semantic_answer_cache
+from tracing import Trace, trace, span, annotate, get_latency_histograms
+from silican_api import SilicanAPI, API_ERROR_PREFIXES
 from lru_cache import get_api_cache, cache_manager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import json
 import hashlib
+import os
+import re
+import threading
+import time
 
 # 简单的日志函数，避免直接依赖streamlit
 def log_error(message):
     print(f"ERROR: {message}")
 
 class SimpleRAGQASystem:
-    """简化版RAG问答系统"""
+    """
+    简化版RAG问答系统
+
+    实例是线程安全的，可由多个会话共享（见get_rag_service）；共享时不绑定API密钥，
+    由每次问答调用传入api_key
+    """
     
-    def __init__(self, api_key: str, similarity_method: str = "cosine"):
-        self.knowledge_base = SimpleRAGKnowledgeBase(similarity_method=similarity_method)
-        self.api = SilicanAPI(api_key)
+    def __init__(self, api_key: Optional[str] = None, similarity_method: str = "cosine",
+                 context_token_budget: int = 1500, db_path: str = "crop_health.db"):
+        self.knowledge_base = SimpleRAGKnowledgeBase(db_path=db_path, similarity_method=similarity_method)
+        self.api = SilicanAPI(api_key) if api_key else None  # 调用时未传入api_key时使用的默认客户端
+        
+        # RAG上下文打包器（去重叠、挑选相关句子并限制token数）
+        self.context_packer = ContextPacker(token_budget=context_token_budget)
+        
+        # 常见问题库（预生成的回答，匹配时不检索也不调用API）
+        self.faq_store = FAQStore(self.knowledge_base)
         
-        # 初始化API缓存
+        # 初始化API缓存（按提示词精确匹配）和语义回答缓存（按近似问题匹配）
         self.api_cache = get_api_cache()
+        self.semantic_cache = get_semantic_answer_cache()
         
         # 根据相似度方法调整阈值
         if similarity_method == "cosine":
@@ -25,81 +49,343 @@ class SimpleRAGQASystem:
         else:
             self.similarity_threshold = 0.3  # 关键词匹配阈值
     
-    def answer_question(self, question: str, use_rag: bool = True) -> Dict[str, Any]:
-        """回答用户问题"""
+    def answer_question(self, question: str, use_rag: bool = True, api_key: Optional[str] = None,
+                        conversation: Optional[ConversationMemory] = None) -> Dict[str, Any]:
+        """
+        回答用户问题（result['trace']中记录各阶段耗时）
+
+        先匹配常见问题库，命中时直接返回预生成的回答；
+        传入conversation时，对话摘要和最近几轮作为背景放入提示词，回答完成后记入该对话；
+        多轮对话中能独立理解的问题照常查常见问题库和语义缓存，只有依赖前文的追问才跳过
+        """
+        api = self._get_api(api_key)
+        with trace('answer_question') as current_trace:
+            conversation_context = conversation.build_context() if conversation is not None else ""
+            standalone = self._is_standalone(question, conversation_context)
+            result = self._match_faq(question) if standalone else None
+            if result is None:
+                result = self._generate_answer(question, use_rag, api, conversation_context, standalone)
+        
+        result['trace'] = current_trace.to_dict()
+        if conversation is not None:
+            conversation.add_turn(self._history_entry(result))
+        return result
+    
+    def _is_standalone(self, question: str, conversation_context: str) -> bool:
+        """问题能否脱离对话背景理解（没有对话背景，或不是指代前文的追问）"""
+        return not conversation_context or not is_follow_up_question(question)
+    
+    def _generate_answer(self, question: str, use_rag: bool, api: SilicanAPI,
+                         conversation_context: str, standalone: bool = True) -> Dict[str, Any]:
+        """检索知识库并生成回答（依次尝试语义缓存、API缓存和API调用）"""
+        result, prompt = self._prepare_answer(question, use_rag, conversation_context=conversation_context)
+        scope = self._answer_scope(result)
+        
+        # 近似问题命中语义缓存时直接返回（追问依赖前文，既不查也不写语义缓存）
+        cached = None
+        if standalone:
+            with span('semantic_cache'):
+                cached = self._get_semantic_answer(question, scope)
+        
+        if cached is not None:
+            result['answer'] = cached
+        else:
+            # 使用通用问题或RAG提示词生成回答（带缓存）
+            with span('llm'):
+                result['answer'] = self._get_cached_api_answer(prompt, api)
+            if standalone:
+                self._remember_answer(question, scope, result['answer'])
+        return result
+    
+    def answer_question_stream(self, question: str, use_rag: bool = True, api_key: Optional[str] = None,
+                               conversation: Optional[ConversationMemory] = None
+                               ) -> Tuple[Dict[str, Any], Iterator[str]]:
+        """
+        流式回答用户问题
+
+        Returns:
+            (结果字典, 回答文本片段生成器)；结果字典中的来源、相关文档等信息立即可用，
+            生成器迭代结束后result['answer']为完整回答，完整回答同样写入API缓存；
+            result['trace']在生成器结束后补全大模型阶段的耗时，传入conversation时回答记入该对话
+        """
+        api = self._get_api(api_key)
+        with trace('answer_question_stream', record=False) as current_trace:
+            conversation_context = conversation.build_context() if conversation is not None else ""
+            standalone = self._is_standalone(question, conversation_context)
+            faq_result = self._match_faq(question) if standalone else None
+            if faq_result is None:
+                result, prompt = self._prepare_answer(question, use_rag,
+                                                      conversation_context=conversation_context)
+        
+        if faq_result is not None:
+            # 常见问题命中：回答已就绪，一次返回
+            get_latency_histograms().record_trace(current_trace)
+            faq_result['trace'] = current_trace.to_dict()
+            return faq_result, self._replay_answer(faq_result, conversation)
+        
+        result['trace'] = current_trace.to_dict()
+        return result, self._stream_answer(question, prompt, result, current_trace, api,
+                                           conversation, standalone)
+    
+    def _replay_answer(self, result: Dict[str, Any],
+                       conversation: Optional[ConversationMemory] = None) -> Iterator[str]:
+        """以生成器形式返回已有回答"""
+        yield result['answer']
+        if conversation is not None:
+            conversation.add_turn(self._history_entry(result))
+    
+    def _stream_answer(self, question: str, prompt: str, result: Dict[str, Any], current_trace: Trace,
+                       api: SilicanAPI, conversation: Optional[ConversationMemory] = None,
+                       standalone: bool = True) -> Iterator[str]:
+        """流式回答：先查语义缓存，未命中时流式调用API，完整回答写入语义缓存"""
+        scope = self._answer_scope(result)
+        cached = None
+        if standalone:
+            with current_trace.span('semantic_cache'):
+                cached = self.semantic_cache.get(question, scope)
+                current_trace.annotate(semantic_cache='miss' if cached is None else 'hit')
+        
+        if cached is not None:
+            result['answer'] = cached['answer']
+            yield cached['answer']
+        else:
+            # 生成器在每次yield时挂起，span只用显式的trace对象记录，不放入线程的当前trace
+            with current_trace.span('llm'):
+                completed = yield from self._stream_cached_api_answer(prompt, result, api)
+                current_trace.annotate(streamed=True, completed=completed)
+            if completed and standalone:
+                self._remember_answer(question, scope, result['answer'])
+        
+        get_latency_histograms().record_trace(current_trace)
+        result['trace'] = current_trace.to_dict()
+        if conversation is not None:
+            conversation.add_turn(self._history_entry(result))
+    
+    def _match_faq(self, question: str) -> Optional[Dict[str, Any]]:
+        """匹配常见问题库，命中时返回结果字典（result['faq']为命中的常见问题）"""
+        with span('faq'):
+            faq = self.faq_store.match(question)
+            annotate(faq='miss' if faq is None else 'hit')
+        if faq is None:
+            return None
+        print(f"INFO: 常见问题命中 ({faq['similarity']:.2f}): {question[:50]} ≈ {faq['question'][:50]}")
+        return {
+            'question': question,
+            'answer': faq['answer'],
+            'source': faq['source'] or 'general',
+            'relevant_docs': [],
+            'confidence': faq['similarity'],
+            'faq': {'id': faq['id'], 'question': faq['question']}
+        }
+    
+    def _history_entry(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        """对话历史中保存的一轮问答"""
+        return {
+            'question': result['question'],
+            'answer': result['answer'],
+            'source': result['source'],
+            'confidence': result['confidence'],
+            'relevant_docs': result['relevant_docs'],
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M")
+        }
+    
+    def _get_api(self, api_key: Optional[str] = None) -> SilicanAPI:
+        """
+        获取API客户端：传入api_key时为本次调用创建客户端，否则使用构造时的默认客户端
+
+        客户端共用进程内的连接池，创建开销很小；不按密钥缓存，共享服务不长期持有各用户的密钥
+        """
+        if not api_key:
+            if self.api is None:
+                raise ValueError("未提供API密钥")
+            return self.api
+        return SilicanAPI(api_key)
+    
+    def _answer_scope(self, result: Dict[str, Any]) -> str:
+        """语义缓存作用域：通用回答不依赖知识库；知识库回答按索引版本区分，知识库变化后失效"""
+        if result['source'] != 'knowledge_base':
+            return 'general'
+        return f"kb:{self.knowledge_base.get_index_version()}"
+    
+    def _get_semantic_answer(self, question: str, scope: str) -> Optional[str]:
+        """查找近似问题的缓存回答"""
+        cached = self.semantic_cache.get(question, scope)
+        annotate(semantic_cache='miss' if cached is None else 'hit')
+        if cached is None:
+            return None
+        print(f"INFO: 语义缓存命中 ({cached['similarity']:.2f}): {question[:50]} ≈ {cached['question'][:50]}")
+        return cached['answer']
+    
+    def _remember_answer(self, question: str, scope: str, answer: str) -> None:
+        """将回答写入语义缓存（API错误信息不缓存）"""
+        if answer and not answer.startswith(API_ERROR_PREFIXES):
+            self.semantic_cache.put(question, scope, answer)
+    
+    def answer_many(self, questions: List[str], concurrency: int = 4, use_rag: bool = True,
+                    api_key: Optional[str] = None) -> Dict[str, Any]:
+        """
+        批量回答问题（用于预先回答常见问题、离线评估等）
+
+        先对全部问题完成知识库检索和语义缓存查找，再以最多concurrency个并发调用大模型，
+        提示词相同的问题只调用一次。单个问题失败不影响其他问题。
+
+        Args:
+            questions: 问题列表
+            concurrency: 同时进行的大模型调用数上限
+            use_rag: 是否使用知识库
+            api_key: API密钥，不传时使用构造时的密钥
+
+        Returns:
+            {'results': 与questions顺序一致的结果字典列表（失败项带error字段）, 'stats': 汇总耗时统计}
+        """
+        api = self._get_api(api_key)
+        start_time = time.time()
+        results: List[Dict[str, Any]] = []
+        pending: Dict[str, List[int]] = {}  # 提示词 -> 需要该回答的问题序号
+        scopes: List[Optional[str]] = []
+        semantic_hits = 0
+        
+        # 1. 检索阶段：知识库状态只查询一次
+        kb_status = self.get_knowledge_base_status()
+        has_knowledge_base = kb_status['has_index'] and kb_status['stats']['total_documents'] > 0
+        for index, question in enumerate(questions):
+            try:
+                result, prompt = self._prepare_answer(question, use_rag, has_knowledge_base)
+                scope = self._answer_scope(result)
+                cached = self._get_semantic_answer(question, scope)
+                if cached is not None:
+                    result['answer'] = cached
+                    semantic_hits += 1
+                else:
+                    pending.setdefault(prompt, []).append(index)
+            except Exception as e:
+                log_error(f"批量问答检索失败: {str(e)}")
+                result = {'question': question, 'answer': '', 'source': 'general',
+                          'relevant_docs': [], 'confidence': 0.0, 'error': str(e)}
+                scope = None
+            results.append(result)
+            scopes.append(scope)
+        retrieval_time = time.time() - start_time
+        
+        # 2. 生成阶段：有限并发调用大模型
+        def generate(prompt: str) -> Tuple[str, Optional[str], float]:
+            call_start = time.time()
+            try:
+                return self._get_cached_api_answer(prompt, api), None, time.time() - call_start
+            except Exception as e:
+                return '', str(e), time.time() - call_start
+        
+        generation_start = time.time()
+        call_latencies = []
+        errors = sum(1 for result in results if 'error' in result)
+        if pending:
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+                outcomes = executor.map(generate, list(pending))
+                for (prompt, indexes), (answer, error, latency) in zip(pending.items(), outcomes):
+                    call_latencies.append(latency)
+                    if error is None and answer.startswith(API_ERROR_PREFIXES):
+                        error = answer
+                    for index in indexes:
+                        results[index]['answer'] = answer
+                        if error is not None:
+                            results[index]['error'] = error
+                            errors += 1
+                        else:
+                            self._remember_answer(questions[index], scopes[index], answer)
+        generation_time = time.time() - generation_start
+        
+        total_time = time.time() - start_time
+        return {
+            'results': results,
+            'stats': {
+                'total_questions': len(questions),
+                'unique_prompts': len(pending),
+                'semantic_cache_hits': semantic_hits,
+                'errors': errors,
+                'concurrency': max(1, concurrency),
+                'retrieval_time': retrieval_time,
+                'generation_time': generation_time,
+                'total_time': total_time,
+                'avg_call_latency': sum(call_latencies) / len(call_latencies) if call_latencies else 0.0,
+                'max_call_latency': max(call_latencies, default=0.0),
+                'questions_per_second': len(questions) / total_time if total_time > 0 else 0.0
+            }
+        }
+    
+    def _prepare_answer(self, question: str, use_rag: bool, has_knowledge_base: Optional[bool] = None,
+                        conversation_context: str = "") -> Tuple[Dict[str, Any], str]:
+        """
+        检索知识库并确定回答来源，返回(结果字典, 发送给大模型的问题或RAG提示词)
+
+        has_knowledge_base为None时查询知识库状态（批量问答时由调用方统一查询一次）；
+        conversation_context非空时作为对话背景放在提示词前（检索仍只使用当前问题）
+        """
+        result, prompt = self._select_prompt(question, use_rag, has_knowledge_base)
+        if conversation_context:
+            prompt = f"""以下是与用户之前的对话，供理解当前问题参考：
+{conversation_context}
+
+{prompt}"""
+        return result, prompt
+    
+    def _select_prompt(self, question: str, use_rag: bool,
+                       has_knowledge_base: Optional[bool]) -> Tuple[Dict[str, Any], str]:
+        """检索知识库，返回(结果字典, 通用问题或RAG提示词)"""
         result = {
             'question': question,
             'answer': '',
             'source': 'general',  # 'knowledge_base' 或 'general'
             'relevant_docs': [],
-            'confidence': 0.0
+            'confidence': 0.8
         }
         
         # 检查知识库是否有内容
-        kb_status = self.get_knowledge_base_status()
-        has_knowledge_base = kb_status['has_index'] and kb_status['stats']['total_documents'] > 0
+        if has_knowledge_base is None:
+            with span('kb_stats'):
+                kb_status = self.get_knowledge_base_status()
+            has_knowledge_base = kb_status['has_index'] and kb_status['stats']['total_documents'] > 0
         
         if not use_rag or not has_knowledge_base:
-            # 直接使用通用AI回答（带缓存）
-            answer = self._get_cached_api_answer(question)
-            result['answer'] = answer
-            result['source'] = 'general'
-            result['confidence'] = 0.8
-            return result
+            # 直接使用通用AI回答
+            return result, question
         
         try:
             # 1. 从知识库搜索相关文档
-            relevant_docs = self.knowledge_base.search_similar_documents(question, top_k=3)
+            with span('retrieval'):
+                relevant_docs = self.knowledge_base.search_similar_documents(question, top_k=3)
             
             if not relevant_docs or relevant_docs[0]['similarity_score'] < self.similarity_threshold:
-                # 知识库中没有相关内容或相似度太低，使用通用AI（带缓存）
-                answer = self._get_cached_api_answer(question)
-                result['answer'] = answer
-                result['source'] = 'general'
-                result['confidence'] = 0.8
-                return result
+                # 知识库中没有相关内容或相似度太低，使用通用AI
+                return result, question
             
             # 2. 检查知识库内容是否与问题相关
             # 提取问题中的关键词
-            question_keywords = self.knowledge_base.extract_keywords(question)
+            with span('keyword_extraction'):
+                question_keywords = self.knowledge_base.extract_keywords(question)
             if not question_keywords:
-                # 问题中没有农业相关关键词，直接使用通用AI（带缓存）
-                answer = self._get_cached_api_answer(question)
-                result['answer'] = answer
-                result['source'] = 'general'
-                result['confidence'] = 0.8
-                return result
+                # 问题中没有农业相关关键词，直接使用通用AI
+                return result, question
             
             # 3. 构建RAG提示词
-            context_text = self._build_context_from_docs(relevant_docs)
-            rag_prompt = self._build_rag_prompt(question, context_text)
-            
-            # 4. 使用RAG提示词生成回答（带缓存）
-            answer = self._get_cached_api_answer(rag_prompt)
+            with span('prompt_build'):
+                context_text = self._build_context_from_docs(relevant_docs, question)
+                rag_prompt = self._build_rag_prompt(question, context_text)
             
-            # 5. 更新结果
-            result['answer'] = answer
+            # 4. 更新结果
             result['source'] = 'knowledge_base'
             result['relevant_docs'] = relevant_docs
             result['confidence'] = relevant_docs[0]['similarity_score']
             
-            return result
+            return result, rag_prompt
             
         except Exception as e:
             log_error(f"RAG问答失败: {str(e)}")
-            # 回退到通用AI（带缓存）
-            answer = self._get_cached_api_answer(question)
-            result['answer'] = answer
-            result['source'] = 'general'
-            result['confidence'] = 0.8
-            return result
-    
-    def _build_context_from_docs(self, docs: List[Dict[str, Any]]) -> str:
-        """从相关文档构建上下文"""
-        context_parts = []
-        for i, doc in enumerate(docs, 1):
-            context_parts.append(f"文档片段 {i} (相似度: {doc['similarity_score']:.2f}):\n{doc['content']}\n")
-        return "\n".join(context_parts)
+            # 回退到通用AI
+            return result, question
+    
+    def _build_context_from_docs(self, docs: List[Dict[str, Any]], question: str) -> str:
+        """从相关文档构建上下文（在token预算内保留与问题最相关的句子）"""
+        return self.context_packer.pack(docs, self.knowledge_base.query_vector(question))
     
     def _build_rag_prompt(self, question: str, context: str) -> str:
         """构建RAG提示词"""
@@ -128,9 +414,18 @@ class SimpleRAGQASystem:
             'stats': stats
         }
     
-    def upload_document(self, file_content: bytes, filename: str) -> bool:
-        """上传文档到知识库"""
-        return self.knowledge_base.upload_document(file_content, filename)
+    def upload_document(self, file_content: bytes, filename: str, wait: bool = False) -> bool:
+        """上传文档到知识库（默认由后台线程完成分块和索引）"""
+        return self.knowledge_base.upload_document(file_content, filename, wait=wait)
+    
+    def upload_document_detailed(self, file_content: bytes, filename: str, wait: bool = False) -> Dict[str, Any]:
+        """上传文档到知识库，返回包含失败原因（如近似重复的文档及相似度）的结果"""
+        return self.knowledge_base.upload_document_detailed(file_content, filename, wait=wait)
+    
+    def update_document(self, document_id: int, file_content: bytes,
+                        filename: Optional[str] = None) -> Dict[str, Any]:
+        """用新版本内容更新文档（只重新处理变化的片段）"""
+        return self.knowledge_base.update_document(document_id, file_content, filename)
     
     def get_document_list(self) -> List[Dict[str, Any]]:
         """获取文档列表"""
@@ -140,44 +435,134 @@ class SimpleRAGQASystem:
         """删除文档"""
         return self.knowledge_base.delete_document(document_id)
     
-    def search_documents(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
-        """搜索文档"""
-        return self.knowledge_base.search_similar_documents(query, top_k)
+    def search_documents(self, query: str, top_k: int = 5, **filters) -> List[Dict[str, Any]]:
+        """搜索文档（filters支持file_types、document_ids、uploaded_after、uploaded_before）"""
+        return self.knowledge_base.search_similar_documents(query, top_k, **filters)
+    
+    def suggest_completions(self, text: str, limit: int = 5) -> List[Dict[str, Any]]:
+        """
+        根据输入末尾的未完成词语给出补全建议
+
+        Returns:
+            建议列表，每项包含term（补全词）和completion（补全后的完整问题）
+        """
+        match = re.search(r'[\u4e00-\u9fff]+$', text.rstrip())
+        if not match:
+            return []
+        tail = match.group()
+        # 从较长的后缀开始尝试，优先补全用户正在输入的完整词语
+        for length in range(min(len(tail), 4), 0, -1):
+            prefix = tail[-length:]
+            suggestions = [item for item in self.knowledge_base.autocomplete(prefix, limit + 1)
+                           if item['term'] != prefix][:limit]
+            if suggestions:
+                base = text.rstrip()[:-length]
+                return [{'term': item['term'], 'completion': base + item['term']} for item in suggestions]
+        return []
+    
+    def rebuild_knowledge_base(self) -> int:
+        """重建知识库索引，返回重新入队的文档数"""
+        count = self.knowledge_base.rebuild_index()
+        print(f"INFO: {count} 个文档已提交重建索引")
+        return count
+    
+    def run_maintenance(self, check_only: bool = False) -> Dict[str, Any]:
+        """执行知识库一致性检查、修复和分片压缩"""
+        from kb_maintenance import KnowledgeBaseMaintenance
+        return KnowledgeBaseMaintenance(self.knowledge_base).run(check_only=check_only)
     
-    def rebuild_knowledge_base(self):
-        """重建知识库索引（简化版无需重建）"""
-        print("INFO: 简化版RAG系统无需重建索引")
+    def export_index(self, archive_path: str) -> Optional[Dict[str, Any]]:
+        """导出知识库索引文件，返回归档清单"""
+        from kb_archive import export_index
+        return export_index(self.knowledge_base, archive_path)
     
-    def _get_cached_api_answer(self, question: str) -> str:
-        """获取缓存的API回答"""
+    def import_index(self, archive_path: str, replace: bool = False) -> bool:
+        """导入知识库索引文件"""
+        from kb_archive import import_index
+        return import_index(self.knowledge_base, archive_path, replace=replace)
+    
+    def _get_cached_api_answer(self, question: str, api: Optional[SilicanAPI] = None) -> str:
+        """获取缓存的API回答（api为None时使用默认客户端）"""
         # 生成缓存键
-        question_hash = hashlib.md5(question.encode('utf-8')).hexdigest()
-        cache_key = f"api_{question_hash}"
+        cache_key = self._api_cache_key(question)
         
         # 检查缓存
         cached_answer = self.api_cache.get(cache_key)
+        annotate(api_cache='miss' if cached_answer is None else 'hit')
         if cached_answer is not None:
             print(f"INFO: API缓存命中: {question[:50]}...")
             return cached_answer
         
         # 调用API
-        answer = self.api.agricultural_qa(question)
+        answer = (api or self._get_api()).agricultural_qa(question)
         
-        # 缓存结果
-        self.api_cache.put(cache_key, answer)
-        print(f"INFO: API回答已缓存: {question[:50]}...")
+        # 缓存结果（错误提示不缓存，否则服务恢复后仍会返回错误）
+        if answer and not answer.startswith(API_ERROR_PREFIXES):
+            self.api_cache.put(cache_key, answer)
+            print(f"INFO: API回答已缓存: {question[:50]}...")
         
         return answer
     
+    def _api_cache_key(self, question: str) -> str:
+        """生成API回答缓存键"""
+        question_hash = hashlib.md5(question.encode('utf-8')).hexdigest()
+        return f"api_{question_hash}"
+    
+    def _stream_cached_api_answer(self, question: str, result: Dict[str, Any],
+                                  api: SilicanAPI) -> Iterator[str]:
+        """
+        流式获取API回答：缓存命中时一次返回，否则边接收边返回，完整接收后写入缓存
+
+        生成器的返回值表示是否得到了完整回答（中途断开时为False）
+        """
+        cache_key = self._api_cache_key(question)
+        cached_answer = self.api_cache.get(cache_key)
+        if cached_answer is not None:
+            print(f"INFO: API缓存命中: {question[:50]}...")
+            result['answer'] = cached_answer
+            yield cached_answer
+            return True
+        
+        parts = []
+        try:
+            for delta in api.agricultural_qa_stream(question):
+                parts.append(delta)
+                yield delta
+        except Exception as e:
+            if not parts:
+                # 尚未收到任何内容，回退到非流式调用（带重试和缓存）
+                log_error(f"流式回答失败，回退普通请求: {str(e)}")
+                answer = self._get_cached_api_answer(question, api)
+                result['answer'] = answer
+                yield answer
+                return True
+            # 中途断开：返回已收到的部分，不写入缓存
+            log_error(f"流式回答中断: {str(e)}")
+            notice = "\n\n（回答因网络问题中断，请重试）"
+            result['answer'] = ''.join(parts) + notice
+            yield notice
+            return False
+        
+        answer = ''.join(parts)
+        result['answer'] = answer
+        if answer:
+            self.api_cache.put(cache_key, answer)
+            print(f"INFO: API回答已缓存: {question[:50]}...")
+        return True
+    
     def get_cache_stats(self) -> Dict[str, Any]:
         """获取所有缓存统计信息"""
         kb_cache_stats = self.knowledge_base.get_cache_stats()
         api_cache_stats = self.api_cache.get_stats()
+        semantic_cache_stats = self.semantic_cache.get_stats()
         
         return {
             'knowledge_base': kb_cache_stats,
             'api_cache': api_cache_stats,
-            'total_cached_items': kb_cache_stats['total_cached_items'] + api_cache_stats['size'],
+            'semantic_cache': semantic_cache_stats,
+            'latency': get_latency_histograms().get_stats(),
+            'total_cached_items': (kb_cache_stats['total_cached_items'] + api_cache_stats['size']
+                                   + semantic_cache_stats['size']),
             'overall_hit_rate': (kb_cache_stats['overall_hit_rate'] + api_cache_stats['hit_rate']) / 2
         }
     
@@ -185,16 +570,38 @@ class SimpleRAGQASystem:
         """清空所有缓存"""
         self.knowledge_base.clear_cache()
         self.api_cache.clear()
+        self.semantic_cache.clear()
         print("INFO: 所有缓存已清空")
     
     def cleanup_expired_cache(self) -> int:
         """清理过期缓存"""
         kb_cleaned = self.knowledge_base.cleanup_expired_cache()
         api_cleaned = self.api_cache.cleanup_expired()
-        total_cleaned = kb_cleaned + api_cleaned
+        semantic_cleaned = self.semantic_cache.cleanup_expired()
+        total_cleaned = kb_cleaned + api_cleaned + semantic_cleaned
         
         if total_cleaned > 0:
             print(f"INFO: 清理了 {total_cleaned} 个过期缓存项")
         
         return total_cleaned
 
+
+# 进程内共享的问答服务（按数据库和相似度算法区分），所有会话共用同一份索引和缓存
+_services: Dict[Tuple[str, str], SimpleRAGQASystem] = {}
+_services_lock = threading.Lock()
+
+
+def get_rag_service(similarity_method: str = "cosine", db_path: str = "crop_health.db") -> SimpleRAGQASystem:
+    """获取共享的问答服务（首次调用时创建，API密钥在每次问答时传入）"""
+    key = (os.path.abspath(db_path), similarity_method)
+    with _services_lock:
+        service = _services.get(key)
+        if service is None:
+            service = _services[key] = SimpleRAGQASystem(similarity_method=similarity_method, db_path=db_path)
+        return service
+
+
+def reset_rag_services() -> None:
+    """丢弃共享的问答服务，下次获取时重新创建（影响进程内的所有会话）"""
+    with _services_lock:
+        _services.clear()
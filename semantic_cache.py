@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+语义回答缓存
+用本地字符n-gram向量表示问题，通过MinHash/LSH分桶查找近似问题，
+相似度超过阈值时直接返回已缓存的回答（如“水稻怎么施肥”与“水稻如何施肥？”）；
+字符向量分不清只差作物、病害或序数的问题（如“早疫病”与“晚疫病”），命中前还要求两个问题的实体完全一致
+"""
+
+from typing import Any, Dict, FrozenSet, Optional
+from collections import Counter, OrderedDict
+import math
+import re
+import threading
+import time
+import unicodedata
+
+from autocomplete import extract_terms
+from minhash_lsh import MinHasher, lsh_band_hashes
+
+# 不影响问题含义的疑问词和语气词，向量化前去掉
+QUESTION_STOP_PHRASES = ['请问', '怎么样', '怎么办', '怎么', '怎样', '如何', '什么', '哪些',
+                         '一下', '吗', '呢', '吧', '啊', '呀', '的', '了']
+
+
+def normalize_question(question: str) -> str:
+    """规范化问题：全角转半角、转小写，去掉标点、空白和疑问语气词"""
+    text = unicodedata.normalize('NFKC', question).lower()
+    text = re.sub(r'[^\u4e00-\u9fff\w]', '', text)
+    for phrase in QUESTION_STOP_PHRASES:
+        text = text.replace(phrase, '')
+    return text
+
+
+# 数字和中文数词（“第二次”“3天”“两遍”），不同数值的问题不能共用回答
+NUMERAL_PATTERN = re.compile(r'\d+(?:\.\d+)?|[零〇一二两三四五六七八九十百千万]+')
+
+
+def question_entities(normalized: str) -> FrozenSet[str]:
+    """问题中的实体：知识库同款词汇提取得到的作物、病害、虫害和农事词，以及数字和数词"""
+    entities = set(extract_terms(normalized))
+    entities.update(NUMERAL_PATTERN.findall(normalized.replace('两', '二')))
+    return frozenset(entities)
+
+
+def question_vector(normalized: str) -> Counter:
+    """问题的字符一元和二元组词频向量"""
+    vector = Counter(normalized)
+    vector.update(normalized[i:i + 2] for i in range(len(normalized) - 1))
+    return vector
+
+
+def _cosine(vec1: Counter, norm1: float, vec2: Counter, norm2: float) -> float:
+    """余弦相似度"""
+    if not norm1 or not norm2:
+        return 0.0
+    if len(vec1) > len(vec2):
+        vec1, vec2 = vec2, vec1
+    return sum(weight * vec2.get(term, 0) for term, weight in vec1.items()) / (norm1 * norm2)
+
+
+class SemanticAnswerCache:
+    """线程安全的近似问题回答缓存（LRU淘汰，TTL过期，按作用域隔离）"""
+
+    def __init__(self, max_size: int = 500, ttl: Optional[float] = 3600, threshold: float = 0.85,
+                 num_perm: int = 64, bands: int = 16):
+        """
+        初始化语义回答缓存
+
+        Args:
+            max_size: 最大缓存条目数
+            ttl: 缓存过期时间（秒），None表示永不过期
+            threshold: 命中所需的最低余弦相似度
+            num_perm: MinHash签名长度
+            bands: LSH分桶数（每个band行数越少，召回越高）
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.bands = bands
+        self.minhasher = MinHasher(num_perm=num_perm, shingle_size=2)
+        self.entries: OrderedDict = OrderedDict()  # 条目ID -> 条目
+        self.buckets: Dict[tuple, set] = {}  # (作用域, band序号, band哈希) -> 条目ID集合
+        self.kb_scope: Optional[str] = None  # 当前知识库版本对应的作用域
+        self.next_id = 0
+        self.lock = threading.RLock()
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def get(self, question: str, scope: str) -> Optional[Dict[str, Any]]:
+        """
+        查找近似问题的缓存回答
+
+        Args:
+            question: 用户问题
+            scope: 作用域（如 'general' 或 'kb:<索引版本>'），只在同一作用域内查找
+
+        Returns:
+            包含answer、question（命中的原问题）和similarity的字典，未命中返回None
+        """
+        normalized = normalize_question(question)
+        if not normalized:
+            return None
+        entities = question_entities(normalized)
+        vector = question_vector(normalized)
+        norm = math.sqrt(sum(weight ** 2 for weight in vector.values()))
+        band_hashes = lsh_band_hashes(self.minhasher.signature(normalized), self.bands)
+
+        with self.lock:
+            self._evict_stale_scopes(scope)
+            candidates = set()
+            for band_index, band_hash in enumerate(band_hashes):
+                candidates |= self.buckets.get((scope, band_index, band_hash), set())
+
+            best_id, best_similarity = None, 0.0
+            now = time.time()
+            for entry_id in candidates:
+                entry = self.entries[entry_id]
+                if self.ttl is not None and now - entry['timestamp'] > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                # 作物、病害或数值不同的问题即使字面相近也不能共用回答
+                if entry['entities'] != entities:
+                    continue
+                similarity = _cosine(vector, norm, entry['vector'], entry['norm'])
+                if similarity > best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+
+            if best_id is None or best_similarity < self.threshold:
+                self.miss_count += 1
+                return None
+
+            self.entries.move_to_end(best_id)
+            self.hit_count += 1
+            entry = self.entries[best_id]
+            return {'answer': entry['answer'], 'question': entry['question'], 'similarity': best_similarity}
+
+    def put(self, question: str, scope: str, answer: str) -> None:
+        """缓存问题的回答"""
+        normalized = normalize_question(question)
+        if not normalized or not answer:
+            return
+        vector = question_vector(normalized)
+        band_hashes = lsh_band_hashes(self.minhasher.signature(normalized), self.bands)
+
+        with self.lock:
+            self._evict_stale_scopes(scope)
+            while len(self.entries) >= self.max_size:
+                self._remove(next(iter(self.entries)))
+
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = {
+                'question': question,
+                'scope': scope,
+                'vector': vector,
+                'entities': question_entities(normalized),
+                'norm': math.sqrt(sum(weight ** 2 for weight in vector.values())),
+                'answer': answer,
+                'band_hashes': band_hashes,
+                'timestamp': time.time()
+            }
+            for band_index, band_hash in enumerate(band_hashes):
+                self.buckets.setdefault((scope, band_index, band_hash), set()).add(entry_id)
+
+    def _evict_stale_scopes(self, scope: str) -> None:
+        """知识库版本变化后，淘汰旧版本作用域下的全部条目"""
+        if not scope.startswith('kb:') or scope == self.kb_scope:
+            return
+        stale_ids = [entry_id for entry_id, entry in self.entries.items()
+                     if entry['scope'].startswith('kb:') and entry['scope'] != scope]
+        for entry_id in stale_ids:
+            self._remove(entry_id)
+        self.kb_scope = scope
+
+    def _remove(self, entry_id: int) -> None:
+        """删除条目及其分桶记录"""
+        entry = self.entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for band_index, band_hash in enumerate(entry['band_hashes']):
+            key = (entry['scope'], band_index, band_hash)
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self.buckets[key]
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self.lock:
+            self.entries.clear()
+            self.buckets.clear()
+            self.kb_scope = None
+            self.hit_count = 0
+            self.miss_count = 0
+
+    def cleanup_expired(self) -> int:
+        """清理过期条目，返回清理数"""
+        if self.ttl is None:
+            return 0
+        with self.lock:
+            now = time.time()
+            expired_ids = [entry_id for entry_id, entry in self.entries.items()
+                           if now - entry['timestamp'] > self.ttl]
+            for entry_id in expired_ids:
+                self._remove(entry_id)
+            return len(expired_ids)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息"""
+        with self.lock:
+            total_requests = self.hit_count + self.miss_count
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hit_count': self.hit_count,
+                'miss_count': self.miss_count,
+                'hit_rate': self.hit_count / total_requests if total_requests > 0 else 0
+            }
+
+
+# 进程内共享的语义回答缓存
+_semantic_cache: Optional[SemanticAnswerCache] = None
+_semantic_cache_lock = threading.Lock()
+
+
+def get_semantic_answer_cache() -> SemanticAnswerCache:
+    """获取语义回答缓存"""
+    global _semantic_cache
+    with _semantic_cache_lock:
+        if _semantic_cache is None:
+            _semantic_cache = SemanticAnswerCache()
+        return _semantic_cache
@@ -1,46 +1,309 @@
 import requests
+import asyncio
 import base64
+import functools
 import json
+import random
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 
-def retry_on_failure(max_retries=3, delay=2):
-    """重试装饰器"""
+from http_transport import get_transport
+from image_preprocess import ImagePreprocessor
+from tracing import annotate
+
+# 作物健康检测的结构化评估提示词
+HEALTH_ASSESSMENT_PROMPT = """请作为农业专家分析这张农作物图片，提供以下结构化信息：
+    1. 作物类型识别
+    2. 健康状况评估（健康/不健康）
+    3. 健康评分（0-100分，100为完全健康）
+    4. 主要问题描述（如无问题则写"无"）
+    5. 可能病因分析（如无问题则写"无"）
+    
+    请严格按照以下JSON格式回复，不要添加任何额外内容：
+    {
+        "crop_type": "作物类型",
+        "health_status": "健康/不健康",
+        "health_score": 0-100的整数,
+        "main_issues": "问题描述",
+        "possible_causes": "可能病因"
+    }"""
+
+HEALTH_DESCRIPTION_PROMPT = "请详细描述这张图片中的农作物状况，包括作物类型、叶片颜色、纹理、是否有斑点、虫害或其他异常区域。"
+
+# 单次调用同时获取结构化评估、详细描述和防治建议
+HEALTH_SINGLE_CALL_PROMPT = """请作为农业专家分析这张农作物图片，提供以下信息：
+    1. 作物类型识别
+    2. 健康状况评估（健康/不健康）
+    3. 健康评分（0-100分，100为完全健康）
+    4. 主要问题描述（如无问题则写"无"）
+    5. 可能病因分析（如无问题则写"无"）
+    6. 详细描述：作物类型、叶片颜色、纹理、是否有斑点、虫害或其他异常区域
+    7. 防治建议：针对上述问题的具体、实用的防治建议和管理措施
+    
+    请严格按照以下JSON格式回复，不要添加任何额外内容：
+    {
+        "crop_type": "作物类型",
+        "health_status": "健康/不健康",
+        "health_score": 0-100的整数,
+        "main_issues": "问题描述",
+        "possible_causes": "可能病因",
+        "description": "详细描述",
+        "suggestions": "防治建议"
+    }"""
+
+# 无法解析模型回复时使用的默认评估
+DEFAULT_HEALTH_DATA = {
+    "crop_type": "未知作物",
+    "health_status": "未知",
+    "health_score": 50,
+    "main_issues": "无法解析分析结果",
+    "possible_causes": "无法解析分析结果"
+}
+
+# 以字符串形式返回的API错误信息前缀（_chat_completion等的错误返回值）
+API_ERROR_PREFIXES = ('API调用超时', 'API调用失败', '网络连接失败', '网络请求失败', '解析API响应失败',
+                      '问答失败', '调用失败', 'API错误', 'API服务暂时不可用')
+
+# 可重试的HTTP状态码：限流和服务端临时故障
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# 可重试的网络异常（异步客户端另行传入aiohttp的异常类型）
+RETRY_EXCEPTIONS = (requests.exceptions.Timeout, requests.exceptions.ConnectionError)
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开，上游服务暂时不可用"""
+
+    def __init__(self, retry_in):
+        super().__init__(f"API服务暂时不可用，请约{int(retry_in) + 1}秒后重试")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    熔断器：连续失败达到阈值后打开，冷却期内的调用立即失败，不再占用线程等待超时；
+    冷却期结束后放行一次试探调用，成功则恢复，失败则继续冷却
+    """
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """调用前检查，熔断期间抛出CircuitOpenError"""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.recovery_timeout - time.monotonic()
+            if remaining > 0 or self.probing:
+                raise CircuitOpenError(max(remaining, 0))
+            # 冷却期已过，只放行一次试探调用
+            self.probing = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.probing:
+                    print(f"WARNING: API连续失败{self.failures}次，{self.recovery_timeout}秒内暂停调用")
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    def get_state(self):
+        """当前状态：closed（正常）、open（熔断中）或half_open（等待试探调用）"""
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            if self.probing or time.monotonic() >= self.opened_at + self.recovery_timeout:
+                return 'half_open'
+            return 'open'
+
+
+# 所有客户端（包括异步客户端）共用的熔断器
+_circuit_breaker = CircuitBreaker()
+
+
+def get_circuit_breaker():
+    """获取共享的熔断器"""
+    return _circuit_breaker
+
+
+def _retry_after_seconds(headers):
+    """解析Retry-After响应头（秒数或HTTP日期），无法解析时返回None"""
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _classify_failure(error, retry_exceptions):
+    """
+    判断异常是否可重试
+
+    Returns:
+        (是否可重试, 是否计入熔断失败, 服务端要求的等待秒数)
+    """
+    response = getattr(error, 'response', None)
+    if response is not None and hasattr(response, 'status_code'):
+        status, headers = response.status_code, response.headers
+    else:
+        status, headers = getattr(error, 'status', None), getattr(error, 'headers', None)
+    if isinstance(status, int):
+        if status not in RETRY_STATUS_CODES:
+            return False, False, None
+        # 429说明服务正常但超出配额，不计入熔断
+        return True, status != 429, _retry_after_seconds(headers)
+    if isinstance(error, retry_exceptions):
+        return True, True, None
+    return False, False, None
+
+
+def _failure_handler(max_retries, delay, max_delay, retry_exceptions, breaker):
+    """返回处理一次失败的函数：给出下次重试前的等待秒数，不应重试时重新抛出异常"""
+    def on_failure(error, attempt):
+        retryable, counts_as_failure, retry_after = _classify_failure(error, retry_exceptions)
+        if counts_as_failure:
+            breaker.record_failure()
+        else:
+            # 服务端有响应（如4xx、429或响应格式错误），说明上游可达
+            breaker.record_success()
+        # 熔断器已打开时不再等待重试，立即失败
+        if not retryable or attempt == max_retries - 1 or breaker.get_state() == 'open':
+            raise error
+        if retry_after is not None:
+            # 服务端要求的等待时间过长时直接失败，不让调用线程长时间空等
+            if retry_after > max_delay:
+                raise error
+            wait = retry_after
+        else:
+            # 指数退避加全抖动，避免多个调用同时重试
+            wait = random.uniform(0, min(max_delay, delay * (2 ** attempt)))
+        print(f"第{attempt + 1}次尝试失败，{wait:.1f}秒后重试...")
+        return wait
+    return on_failure
+
+
+def retry_on_failure(max_retries=3, delay=1, max_delay=10, retry_exceptions=RETRY_EXCEPTIONS, breaker=None):
+    """
+    重试装饰器：超时、连接错误、429和5xx按带抖动的指数退避重试（遵守Retry-After），
+    经过共享熔断器，熔断期间立即抛出CircuitOpenError；最终失败时抛出最后一次的异常
+
+    同时支持普通函数和协程函数
+    """
     def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                circuit = breaker or get_circuit_breaker()
+                on_failure = _failure_handler(max_retries, delay, max_delay, retry_exceptions, circuit)
+                for attempt in range(max_retries):
+                    circuit.before_call()
+                    try:
+                        result = await func(*args, **kwargs)
+                    except Exception as e:
+                        await asyncio.sleep(on_failure(e, attempt))
+                        continue
+                    circuit.record_success()
+                    return result
+            return async_wrapper
+
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            circuit = breaker or get_circuit_breaker()
+            on_failure = _failure_handler(max_retries, delay, max_delay, retry_exceptions, circuit)
             for attempt in range(max_retries):
+                circuit.before_call()
                 try:
-                    return func(*args, **kwargs)
-                except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
-                    if attempt == max_retries - 1:
-                        return f"API调用失败，已重试{max_retries}次: {str(e)}"
-                    print(f"第{attempt + 1}次尝试失败，{delay}秒后重试...")
-                    time.sleep(delay)
+                    result = func(*args, **kwargs)
                 except Exception as e:
-                    return f"调用失败: {str(e)}"
-            return "API调用失败"
+                    time.sleep(on_failure(e, attempt))
+                    continue
+                circuit.record_success()
+                return result
         return wrapper
     return decorator
 
 class SilicanAPI:
-    def __init__(self, api_key):
+    def __init__(self, api_key, preprocessor=None):
         self.api_key = api_key
+        # 上传前的图像缩放和重新压缩设置
+        self.preprocessor = preprocessor or ImagePreprocessor()
         self.base_url = "https://api.siliconflow.cn/v1"  
+        # 所有实例共用一个带连接池的会话，复用已建立的TCP/TLS连接
+        self.transport = get_transport()
     
-    @retry_on_failure(max_retries=2, delay=3)
-    def analyze_image(self, image_path, prompt):
-        """调用硅基流动API分析图像"""
-    # 读取并编码图像
-        with open(image_path, "rb") as image_file:
-            encoded_image = base64.b64encode(image_file.read()).decode('utf-8')
-    
-    # 构建请求
+    def _headers(self, stream=False):
+        """构建请求头"""
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        if stream:
+            headers["Accept"] = "text/event-stream"
+        return headers
     
-   
-        payload = {
+    @retry_on_failure(max_retries=3, delay=1)
+    def _request_chat(self, payload, name):
+        """发送对话补全请求并返回回答文本，网络、HTTP和解析错误照常抛出"""
+        response = self.transport.post(
+            f"{self.base_url}/chat/completions",
+            name=name,
+            headers=self._headers(),
+            json=payload
+        )
+        response.raise_for_status()  # 触发HTTP错误
+        return response.json()["choices"][0]["message"]["content"]
+    
+    def _chat_completion(self, payload, name, error_label="调用失败"):
+        """发送对话补全请求，错误转换为提示文本返回"""
+        try:
+            return self._request_chat(payload, name)
+        except CircuitOpenError as e:
+            return str(e)
+        except requests.exceptions.Timeout:
+            return "API调用超时，请检查网络连接后重试"
+        except requests.exceptions.ConnectionError:
+            return "网络连接失败，请检查网络连接"
+        except requests.exceptions.HTTPError as e:
+            return f"API错误 {e.response.status_code}: {e.response.text}"
+        except (KeyError, IndexError, json.JSONDecodeError) as e:
+            return f"解析API响应失败: {str(e)}"
+        except requests.exceptions.RequestException as e:
+            return f"网络请求失败: {str(e)}"
+        except Exception as e:
+            return f"{error_label}: {str(e)}"
+    
+    def analyze_image(self, image_path, prompt, encoded_image=None, max_tokens=1000):
+        """调用硅基流动API分析图像（同一图像多次调用时可传入已编码的encoded_image）"""
+    # 读取并编码图像
+        if encoded_image is None:
+            encoded_image, _ = self._prepare_image(image_path)
+    
+        payload = self._build_image_payload(encoded_image, prompt, max_tokens)
+        return self._chat_completion(payload, "chat.vision")
+    
+    def _build_image_payload(self, encoded_image, prompt, max_tokens=1000):
+        """构建图像分析请求体"""
+        return {
             "model": "Qwen/Qwen2.5-VL-72B-Instruct",  
             "messages": [
                 {
@@ -53,92 +316,121 @@ class SilicanAPI:
                     ]
                 }
             ],
-            "max_tokens": 1000
+            "max_tokens": max_tokens
     }
     
-        try:
-            response = requests.post(
-                f"{self.base_url}/chat/completions", 
-                headers=headers, 
-                json=payload,
-                timeout=60  # 设置60秒超时
-            )
-            response.raise_for_status()  # 触发HTTP错误
-            return response.json()["choices"][0]["message"]["content"]
-        except requests.exceptions.Timeout:
-            return "API调用超时，请检查网络连接后重试"
-        except requests.exceptions.HTTPError as e:
-            # 打印详细错误信息以便调试
-            return f"API错误 {response.status_code}: {response.text}"
-        except requests.exceptions.ConnectionError:
-            return "网络连接失败，请检查网络连接"
-        except Exception as e:
-            return f"调用失败: {str(e)}"
+    def _prepare_image(self, image_path):
+        """预处理图像并进行base64编码，返回(编码结果, 预处理统计)"""
+        image_bytes, stats = self.preprocessor.process(image_path)
+        annotate(image_bytes=stats['processed_bytes'], image_bytes_saved=stats['bytes_saved'])
+        if stats['processed']:
+            print(f"INFO: 图像预处理 {stats['original_bytes'] / 1024:.1f} KB -> "
+                  f"{stats['processed_bytes'] / 1024:.1f} KB，节省 {stats['bytes_saved'] / 1024:.1f} KB")
+        return base64.b64encode(image_bytes).decode('utf-8'), stats
     
-    def detect_crop_health(self, image_path):
-        """检测农作物健康状态 """
-    # 使用更精确的提示词获取综合评估
-        comprehensive_prompt = """请作为农业专家分析这张农作物图片，提供以下结构化信息：
-    1. 作物类型识别
-    2. 健康状况评估（健康/不健康）
-    3. 健康评分（0-100分，100为完全健康）
-    4. 主要问题描述（如无问题则写"无"）
-    5. 可能病因分析（如无问题则写"无"）
+    def detect_crop_health(self, image_path, mode="single"):
+        """
+        检测农作物健康状态
+
+        Args:
+            image_path: 图像路径
+            mode: 调用方式
+                single - 一次调用同时获取结构化评估、详细描述和防治建议（默认，模型回复不完整时回退到concurrent，接口出错时直接返回错误结果）
+                concurrent - 先获取结构化评估，再并发获取详细描述和防治建议
+                sequential - 依次进行三次调用
+        """
+        # 图像只预处理和编码一次，各次调用共用；结果中的image_stats记录预处理节省的字节数
+        encoded_image, image_stats = self._prepare_image(image_path)
     
-    请严格按照以下JSON格式回复，不要添加任何额外内容：
-    {
-        "crop_type": "作物类型",
-        "health_status": "健康/不健康",
-        "health_score": 0-100的整数,
-        "main_issues": "问题描述",
-        "possible_causes": "可能病因"
-    }"""
+        if mode == "single":
+            analysis_result = self.analyze_image(image_path, HEALTH_SINGLE_CALL_PROMPT, encoded_image=encoded_image,
+                                                 max_tokens=2500)
+            if analysis_result.startswith(API_ERROR_PREFIXES):
+                # 接口本身出错（超时、限流、熔断）时直接返回，不再改为分步分析增加三次调用
+                return self._build_error_result(analysis_result, image_stats)
+            result_data = self._parse_health_json(analysis_result)
+            if result_data and result_data.get("description") and result_data.get("suggestions"):
+                result = self._build_health_result(result_data, self._as_text(result_data["description"]),
+                                                   self._as_text(result_data["suggestions"]))
+                result["image_stats"] = image_stats
+                return result
+            print("WARNING: 单次调用结果不完整，改为分步分析")
+            mode = "concurrent"
     
-    # 获取结构化分析结果
-        analysis_result = self.analyze_image(image_path, comprehensive_prompt)
+        # 获取结构化分析结果
+        analysis_result = self.analyze_image(image_path, HEALTH_ASSESSMENT_PROMPT, encoded_image=encoded_image)
+        if analysis_result.startswith(API_ERROR_PREFIXES):
+            return self._build_error_result(analysis_result, image_stats)
+        result_data = self._parse_health_json(analysis_result) or dict(DEFAULT_HEALTH_DATA)
     
-    # 尝试解析JSON响应
-        try:
-        # 提取JSON部分（模型可能会在JSON前后添加额外文本）
-            import re
-            json_match = re.search(r'\{.*\}', analysis_result, re.DOTALL)
-            if json_match:
-                result_data = json.loads(json_match.group())
-            else:
-            # 如果无法提取JSON，使用默认值
-                result_data = {
-                    "crop_type": "未知作物",
-                    "health_status": "未知",
-                    "health_score": 50,
-                    "main_issues": "无法解析分析结果",
-                    "possible_causes": "无法解析分析结果"
-            }
-        except json.JSONDecodeError:
-        # JSON解析失败时的备用方案
-            result_data = {
-                "crop_type": "未知作物",
-                "health_status": "未知",
-                "health_score": 50,
-                "main_issues": "无法解析分析结果",
-                "possible_causes": "无法解析分析结果"
-        }
+        # 获取详细描述和防治建议（防治建议依赖结构化结果，两者之间互不依赖）
+        suggestion_prompt = self._build_suggestion_prompt(result_data)
+        if mode == "concurrent":
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                description_future = executor.submit(self.analyze_image, image_path, HEALTH_DESCRIPTION_PROMPT,
+                                                     encoded_image=encoded_image)
+                suggestions_future = executor.submit(self.analyze_image, image_path, suggestion_prompt,
+                                                     encoded_image=encoded_image)
+                description = description_future.result()
+                suggestions = suggestions_future.result()
+        else:
+            description = self.analyze_image(image_path, HEALTH_DESCRIPTION_PROMPT, encoded_image=encoded_image)
+            suggestions = self.analyze_image(image_path, suggestion_prompt, encoded_image=encoded_image)
     
-        # 获取详细描述
-        description_prompt = "请详细描述这张图片中的农作物状况，包括作物类型、叶片颜色、纹理、是否有斑点、虫害或其他异常区域。"
-        description = self.analyze_image(image_path, description_prompt)
+        result = self._build_health_result(result_data, description, suggestions)
+        result["image_stats"] = image_stats
+        return result
     
-        # 获取防治建议
-        suggestion_prompt = f"""根据以下作物状况提供具体的防治建议和管理措施：
+    @staticmethod
+    def _build_suggestion_prompt(result_data):
+        """根据结构化评估构建防治建议提示词"""
+        return f"""根据以下作物状况提供具体的防治建议和管理措施：
         作物类型: {result_data["crop_type"]}
         健康状况: {result_data["health_status"]}
         主要问题: {result_data["main_issues"]}
         可能病因: {result_data["possible_causes"]}
     
         请提供详细、实用的建议："""
-        suggestions = self.analyze_image(image_path, suggestion_prompt)
     
+    @staticmethod
+    def _parse_health_json(analysis_result):
+        """从模型回复中提取结构化评估（模型可能会在JSON前后添加额外文本），失败返回None"""
+        json_match = re.search(r'\{.*\}', analysis_result, re.DOTALL)
+        if not json_match:
+            return None
+        try:
+            parsed = json.loads(json_match.group())
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(parsed, dict):
+            return None
+        result_data = dict(DEFAULT_HEALTH_DATA)
+        result_data.update(parsed)
+        return result_data
+    
+    @staticmethod
+    def _as_text(value):
+        """模型有时把描述或建议返回为列表，统一转换为文本"""
+        if isinstance(value, list):
+            return "\n".join(str(item) for item in value)
+        return str(value)
+    
+    @staticmethod
+    def _build_error_result(error, image_stats):
+        """接口出错时的检测结果：error字段为错误信息，描述和建议中也保留错误信息供调用方展示"""
+        result = SilicanAPI._build_health_result(DEFAULT_HEALTH_DATA, error, error)
+        result["error"] = error
+        result["image_stats"] = image_stats
+        return result
+    
+    @staticmethod
+    def _build_health_result(result_data, description, suggestions):
+        """根据结构化评估、详细描述和防治建议生成检测结果"""
     # 基于健康评分确定健康状态和置信度
-        health_score = result_data.get("health_score", 50)
+        try:
+            health_score = int(result_data.get("health_score", 50))
+        except (TypeError, ValueError):
+            health_score = 50
         if health_score >= 80:
             health_status = "健康"
             confidence = health_score / 100.0
@@ -162,20 +454,14 @@ class SilicanAPI:
             "main_issues": result_data["main_issues"],
             "possible_causes": result_data["possible_causes"]
     }
-    @retry_on_failure(max_retries=2, delay=3)
-    def agricultural_qa(self, question):
-        """农业知识问答"""
+    def _build_qa_payload(self, question, stream=False):
+        """构建农业问答请求体"""
         prompt = f"""你是一名农业专家，请用中文回答以下农业相关问题。回答要详细、实用，适合农民朋友理解，非农业相关的问题请拒绝回答。
 
     问题：{question}
 
     请提供专业、准确的农业知识解答："""
     
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-    
         payload = {
             "model": "Qwen/Qwen2.5-72B-Instruct", 
             "messages": [
@@ -187,31 +473,67 @@ class SilicanAPI:
             "max_tokens": 2000,
             "temperature": 0.7
         }
+        if stream:
+            payload["stream"] = True
+        return payload
     
+    def agricultural_qa(self, question):
+        """农业知识问答"""
+        payload = self._build_qa_payload(question)
+        return self._chat_completion(payload, "chat.qa", error_label="问答失败")
+    
+    def agricultural_qa_stream(self, question):
+        """
+        流式农业知识问答（服务器推送事件），逐段生成回答文本
+
+        与agricultural_qa不同，网络或HTTP错误会直接抛出requests异常（熔断期间抛出CircuitOpenError），
+        调用方可以据此判断是否已收到部分内容并决定回退方式
+        """
+        payload = self._build_qa_payload(question, stream=True)
+    
+        with self._open_stream(payload) as response:
+            # chunk_size=None：分块传输的每个数据块到达后立即处理，不等待缓冲区填满
+            for line in response.iter_lines(chunk_size=None):
+                # 按UTF-8解码：text/event-stream响应通常不声明字符集
+                line = line.decode('utf-8').strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                except (json.JSONDecodeError, KeyError, IndexError):
+                    continue
+                if delta:
+                    yield delta
+    
+    @retry_on_failure(max_retries=3, delay=1)
+    def _open_stream(self, payload):
+        """建立流式请求（只在收到响应头之前重试，已开始输出的回答不会重复）"""
+        # 连接超时10秒；读取超时为两段数据之间的最长间隔
+        response = self.transport.post(
+            f"{self.base_url}/chat/completions",
+            name="chat.qa_stream",
+            headers=self._headers(stream=True),
+            json=payload,
+            stream=True,
+            timeout=(10, 60)
+        )
         try:
-            response = requests.post(
-                f"{self.base_url}/chat/completions", 
-                headers=headers, 
-                json=payload,
-                timeout=60  # 添加超时设置
-            )
             response.raise_for_status()
-            result = response.json()
-            return result["choices"][0]["message"]["content"]
-        except requests.exceptions.Timeout:
-            return "API调用超时，请检查网络连接后重试"
-        except requests.exceptions.ConnectionError:
-            return "网络连接失败，请检查网络连接"
-        except requests.exceptions.RequestException as e:
-            return f"网络请求失败: {str(e)}"
-        except KeyError as e:
-            return f"解析API响应失败: {str(e)}，响应内容: {response.text}"
-        except Exception as e:
-            return f"问答失败: {str(e)}"
+        except requests.exceptions.HTTPError:
+            response.close()
+            raise
+        return response
     # 在SilicanAPI类中添加新方法
-    @retry_on_failure(max_retries=2, delay=3)
     def generate_planting_advice(self, crop_type, prompt=None):
         """生成作物种植建议"""
+        payload = self._build_advice_payload(crop_type, prompt)
+        return self._chat_completion(payload, "chat.advice", error_label="生成种植建议失败")
+    
+    def _build_advice_payload(self, crop_type, prompt=None):
+        """构建种植建议请求体"""
         if prompt is None:
             prompt = f"""请为{crop_type}提供详细的种植计划，包括以下内容：
         1. 播种时间和方法
@@ -221,12 +543,7 @@ class SilicanAPI:
         5. 收获时间和方法
         请按时间顺序列出关键农事活动。"""
     
-        headers = {
-        "Authorization": f"Bearer {self.api_key}",
-        "Content-Type": "application/json"
-    }
-    
-        payload = {
+        return {
         "model": "Qwen/Qwen2.5-72B-Instruct", 
         "messages": [
             {
@@ -237,26 +554,26 @@ class SilicanAPI:
         "max_tokens": 2000,
         "temperature": 0.7
     }
+
+    def extract_events_from_advice(self, advice_text):
+        """从建议文本中提取关键事件"""
+        payload = self._build_events_payload(advice_text)
     
         try:
-            response = requests.post(
-                f"{self.base_url}/chat/completions", 
-                headers=headers, 
-                json=payload,
-                timeout=60
-            )
-            response.raise_for_status()
-            result = response.json()
-            return result["choices"][0]["message"]["content"]
+            content = self._request_chat(payload, "chat.events")
+            return self._parse_events(content)
         except requests.exceptions.Timeout:
-            return "API调用超时，请检查网络连接后重试"
+            print("API调用超时，请检查网络连接后重试")
+            return []
         except requests.exceptions.ConnectionError:
-            return "网络连接失败，请检查网络连接"
+            print("网络连接失败，请检查网络连接")
+            return []
         except Exception as e:
-            return f"生成种植建议失败: {str(e)}"
-
-    def extract_events_from_advice(self, advice_text):
-        """从建议文本中提取关键事件"""
+            print(f"提取事件失败: {str(e)}")
+            return []
+    
+    def _build_events_payload(self, advice_text):
+        """构建事件提取请求体"""
         prompt = f"""请从以下农业建议中提取关键农事活动事件，并为每个事件标注时间参考和重要性(高/中/低)。
         输出格式要求为JSON列表，每个元素包含:
         - activity: 活动描述
@@ -268,12 +585,7 @@ class SilicanAPI:
     
         请只返回JSON格式的数据，不要其他内容。"""
     
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-    }
-    
-        payload = {
+        return {
             "model": "Qwen/Qwen2.5-72B-Instruct", 
             "messages": [
             {
@@ -285,33 +597,12 @@ class SilicanAPI:
             "temperature": 0.3 
     }
     
-        try:
-            response = requests.post(
-                f"{self.base_url}/chat/completions", 
-                headers=headers, 
-                json=payload,
-                timeout=60
-            )
-            response.raise_for_status()
-            result = response.json()
-        
-            # 尝试从响应中提取JSON
-            import re
-            json_match = re.search(r'\[.*\]', result["choices"][0]["message"]["content"], re.DOTALL)
-            if json_match:
-                import json
-                return json.loads(json_match.group())
-            else:
-                # 如果无法提取JSON，返回空列表
-                return []
-            
-        except requests.exceptions.Timeout:
-            print("API调用超时，请检查网络连接后重试")
-            return []
-        except requests.exceptions.ConnectionError:
-            print("网络连接失败，请检查网络连接")
-            return []
-        except Exception as e:
-            print(f"提取事件失败: {str(e)}")
-            return []
-
+    @staticmethod
+    def _parse_events(content):
+        """从模型回复中提取事件列表，无法提取时返回空列表"""
+        # 尝试从响应中提取JSON
+        json_match = re.search(r'\[.*\]', content, re.DOTALL)
+        if json_match:
+            return json.loads(json_match.group())
+        # 如果无法提取JSON，返回空列表
+        return []
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""异步客户端的并发上限：多个线程各自用asyncio.run时仍共用同一个进程级上限"""
+
+import asyncio
+import threading
+
+from async_silican_api import ProcessSemaphore
+
+
+def test_limit_holds_across_event_loops():
+    semaphore = ProcessSemaphore(3)
+    lock = threading.Lock()
+    state = {'active': 0, 'peak': 0, 'done': 0}
+
+    async def task():
+        async with semaphore:
+            with lock:
+                state['active'] += 1
+                state['peak'] = max(state['peak'], state['active'])
+            await asyncio.sleep(0.01)
+            with lock:
+                state['active'] -= 1
+                state['done'] += 1
+
+    async def session():
+        await asyncio.gather(*(task() for _ in range(5)))
+
+    threads = [threading.Thread(target=asyncio.run, args=(session(),)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert state['done'] == 20
+    assert state['peak'] <= 3
+    assert semaphore.active == 0
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    semaphore = ProcessSemaphore(1)
+
+    async def run():
+        await semaphore.acquire()
+        waiter = asyncio.ensure_future(semaphore.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        semaphore.release()
+        await asyncio.gather(waiter, return_exceptions=True)
+        await asyncio.sleep(0)
+        # 名额应已归还，可以立即再次取得
+        await asyncio.wait_for(semaphore.acquire(), timeout=1)
+        semaphore.release()
+
+    asyncio.run(run())
+    assert semaphore.active == 0
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""对话记忆：追问识别与过期转存记录清理"""
+
+import sqlite3
+
+import pytest
+
+from conversation_memory import ConversationMemory, is_follow_up_question, purge_conversation_history
+
+
+@pytest.mark.parametrize('question', ['那玉米呢？', '为什么？', '这个药用量多少', '还有别的办法吗', '它的用量是多少'])
+def test_follow_up_questions(question):
+    assert is_follow_up_question(question)
+
+
+@pytest.mark.parametrize('question', ['水稻怎么施肥？', '番茄早疫病用什么药防治效果好', '小麦什么时候浇第一次水'])
+def test_standalone_questions(question):
+    assert not is_follow_up_question(question)
+
+
+def test_purge_removes_only_expired_history(tmp_path):
+    db_path = str(tmp_path / 'history.db')
+    old_session = ConversationMemory('old', db_path=db_path, max_turns_in_memory=1)
+    new_session = ConversationMemory('new', db_path=db_path, max_turns_in_memory=1)
+    for index in range(4):
+        old_session.add_turn({'question': f'问题{index}', 'answer': '回答'})
+        new_session.add_turn({'question': f'问题{index}', 'answer': '回答'})
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE qa_conversation_history SET created_at = '2020-01-01 00:00:00' WHERE session_id = 'old'")
+    conn.commit()
+    conn.close()
+
+    assert purge_conversation_history(db_path, max_age_days=7, batch_size=2) == 3
+    assert len(old_session.load_all()) == 1
+    assert len(new_session.load_all()) == 4
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""文档处理失败：记录失败原因，启动时不再重新入队，同一文件可重新上传"""
+
+from rag_knowledge_base_simple import SimpleRAGKnowledgeBase
+
+DOCUMENT = "水稻分蘖期应及时追施氮肥，每亩施尿素5到8公斤，同时注意浅水勤灌，促进分蘖早发。".encode('utf-8')
+
+
+class RecordingQueue:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, document_id):
+        self.submitted.append(document_id)
+        return True
+
+
+def test_unchunkable_document_is_marked_failed(tmp_path):
+    kb = SimpleRAGKnowledgeBase(db_path=str(tmp_path / 'kb.db'), async_ingestion=False)
+    chunk_text = kb.chunk_text
+    kb.chunk_text = lambda text: []
+
+    assert not kb.upload_document(DOCUMENT, 'rice.txt', wait=True)
+    documents = kb.get_document_list()
+    assert len(documents) == 1
+    assert not documents[0]['processed']
+    assert documents[0]['processing_error'] == "无法分割成有效块"
+    stats = kb.get_knowledge_base_stats()
+    assert stats['pending_documents'] == 0
+    assert stats['failed_documents'] == 1
+
+    # 重启时失败的文档不再入队
+    kb.ingestion_queue = RecordingQueue()
+    kb._resume_pending_documents()
+    assert kb.ingestion_queue.submitted == []
+    kb.ingestion_queue = None
+
+    # 修正后重新上传同一文件会重新处理，而不是被当作已存在的文件跳过
+    kb.chunk_text = chunk_text
+    assert kb.upload_document(DOCUMENT, 'rice.txt', wait=True)
+    documents = kb.get_document_list()
+    assert len(documents) == 1
+    assert documents[0]['processed']
+    assert documents[0]['processing_error'] is None
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""常见问题库：只差作物、病害或序数的问题不能匹配到其他常见问题的回答；命中次数分批写入"""
+
+import pytest
+
+from faq_store import FAQStore
+from rag_knowledge_base_simple import SimpleRAGKnowledgeBase
+
+# (常见问题, 字面相近但含义不同的问题)；不检查实体时这些问题对的相似度都超过匹配阈值
+NEAR_MISS_PAIRS = [
+    ('小麦返青拔节期浇第一次水的时间和水量', '小麦返青拔节期浇第二次水的时间和水量'),
+    ('番茄早疫病用什么药防治效果好', '番茄晚疫病用什么药防治效果好'),
+]
+
+
+@pytest.fixture
+def faq_store(tmp_path):
+    knowledge_base = SimpleRAGKnowledgeBase(db_path=str(tmp_path / 'faq.db'), async_ingestion=False)
+    return FAQStore(knowledge_base)
+
+
+def _answer_all(store):
+    """直接写入回答，模拟离线刷新后的状态"""
+    conn = store.knowledge_base._connect()
+    conn.execute("UPDATE faq_entries SET answer = '常见问题回答：' || question")
+    conn.commit()
+    conn.close()
+
+
+@pytest.mark.parametrize('faq_question, question', NEAR_MISS_PAIRS)
+def test_near_miss_questions_do_not_match(faq_store, faq_question, question):
+    faq_store.add_questions([faq_question])
+    _answer_all(faq_store)
+    assert faq_store.match(question) is None
+
+
+def test_rephrased_question_matches(faq_store):
+    faq_store.add_questions(['番茄早疫病怎么防治？'])
+    _answer_all(faq_store)
+    match = faq_store.match('番茄早疫病如何防治')
+    assert match is not None
+    assert match['question'] == '番茄早疫病怎么防治？'
+
+
+def test_hit_counts_are_batched(faq_store):
+    faq_store.add_questions(['番茄早疫病怎么防治？'])
+    _answer_all(faq_store)
+    for _ in range(3):
+        assert faq_store.match('番茄早疫病如何防治') is not None
+
+    # 问答路径上只在内存中累计
+    conn = faq_store.knowledge_base._connect()
+    assert conn.execute("SELECT hit_count FROM faq_entries").fetchone()[0] == 0
+    conn.close()
+
+    assert faq_store.list_questions()[0]['hit_count'] == 3
+    assert faq_store.flush_hits() == 0
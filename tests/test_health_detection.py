@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""作物健康检测的单次调用模式：接口出错时直接返回，模型回复不完整时才改为分步分析"""
+
+from silican_api import SilicanAPI
+
+
+def make_api(replies):
+    api = SilicanAPI("test-key")
+    calls = []
+
+    def analyze_image(image_path, prompt, encoded_image=None, max_tokens=1000):
+        calls.append(prompt)
+        return replies.pop(0) if len(replies) > 1 else replies[0]
+
+    api._prepare_image = lambda image_path: ("encoded", {'bytes_saved': 0})
+    api.analyze_image = analyze_image
+    return api, calls
+
+
+def test_api_error_is_returned_without_fallback():
+    api, calls = make_api(["API调用超时，请检查网络连接后重试"])
+    result = api.detect_crop_health("leaf.jpg")
+
+    assert len(calls) == 1
+    assert result["error"] == "API调用超时，请检查网络连接后重试"
+    assert result["image_stats"] == {'bytes_saved': 0}
+
+
+def test_incomplete_reply_falls_back_to_concurrent():
+    api, calls = make_api(['{"crop_type": "水稻", "health_score": 90}', '{"crop_type": "水稻", "health_score": 90}',
+                            "叶片正常"])
+    result = api.detect_crop_health("leaf.jpg")
+
+    assert len(calls) == 4
+    assert "error" not in result
+    assert result["crop_type"] == "水稻"
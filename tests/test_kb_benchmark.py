@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""检索基准测试：评估已有知识库时的参数检查"""
+
+import pytest
+
+from kb_benchmark import run_benchmark
+
+
+def test_existing_db_requires_questions(tmp_path):
+    db_path = tmp_path / 'kb.db'
+    db_path.touch()
+    with pytest.raises(ValueError, match="questions_path"):
+        run_benchmark(db_path=str(db_path))
+
+
+def test_existing_db_must_exist(tmp_path):
+    questions_path = tmp_path / 'questions.jsonl'
+    questions_path.write_text('', encoding='utf-8')
+    with pytest.raises(ValueError, match="不存在"):
+        run_benchmark(db_path=str(tmp_path / 'missing.db'), questions_path=str(questions_path))
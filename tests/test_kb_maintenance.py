@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""知识库维护：检查结果过时（检查后同一内容又被上传）时，修复不能删除仍在使用的数据"""
+
+import pytest
+
+from kb_maintenance import KnowledgeBaseMaintenance
+from rag_knowledge_base_simple import SimpleRAGKnowledgeBase
+
+DOCUMENT = "水稻分蘖期应及时追施氮肥，每亩施尿素5到8公斤，同时注意浅水勤灌，促进分蘖早发。".encode('utf-8')
+
+
+@pytest.fixture
+def knowledge_base(tmp_path):
+    kb = SimpleRAGKnowledgeBase(db_path=str(tmp_path / 'kb.db'), async_ingestion=False)
+    assert kb.upload_document(DOCUMENT, 'rice.txt', wait=True)
+    return kb
+
+
+def _count(kb, sql):
+    conn = kb._connect()
+    count = conn.execute(sql).fetchone()[0]
+    conn.close()
+    return count
+
+
+def test_repair_rechecks_stale_issues(knowledge_base):
+    maintenance = KnowledgeBaseMaintenance(knowledge_base, pause=0)
+    conn = knowledge_base._connect()
+    content_hash = conn.execute("SELECT content_hash FROM chunk_store").fetchone()[0]
+    document_id, chunk_id = conn.execute("SELECT document_id, id FROM document_chunks").fetchone()
+    conn.close()
+    postings_before = _count(knowledge_base, "SELECT COUNT(*) FROM term_postings")
+
+    # 模拟过时的检查结果：这些数据在检查时有问题，修复前已被重新上传的同一内容恢复
+    issues = {name: [] for name in maintenance.check()}
+    issues['orphaned_chunks'] = [chunk_id]
+    issues['ref_count_drift'] = [(content_hash, 0, 0)]
+    issues['stale_postings'] = [content_hash]
+    issues['orphaned_signatures'] = [document_id]
+    maintenance.repair(issues)
+
+    assert _count(knowledge_base, "SELECT COUNT(*) FROM document_chunks") == 1
+    assert _count(knowledge_base, "SELECT COUNT(*) FROM chunk_store") == 1
+    assert _count(knowledge_base, "SELECT COUNT(*) FROM term_postings") == postings_before
+    assert _count(knowledge_base, "SELECT COUNT(*) FROM document_minhash") == 1
+    assert knowledge_base.search_similar_documents("水稻分蘖期追施氮肥")
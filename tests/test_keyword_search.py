@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""关键词检索：按content_length排序，只解压需要打分的片段"""
+
+import rag_knowledge_base_simple
+from rag_knowledge_base_simple import SimpleRAGKnowledgeBase
+
+DOCUMENTS = [
+    "水稻分蘖期追施氮肥。",
+    "水稻分蘖期追施氮肥，每亩施尿素5到8公斤。",
+    "水稻分蘖期追施氮肥，每亩施尿素5到8公斤，同时注意浅水勤灌，促进分蘖早发。",
+]
+
+
+def test_longest_matches_first_without_decompressing_the_rest(tmp_path, monkeypatch):
+    kb = SimpleRAGKnowledgeBase(db_path=str(tmp_path / 'kb.db'), similarity_method="keyword",
+                                async_ingestion=False, near_duplicate_action="allow")
+    for index, text in enumerate(DOCUMENTS):
+        assert kb.upload_document(text.encode('utf-8'), f'rice{index}.txt', wait=True)
+
+    decompressed = []
+    decompress_text = rag_knowledge_base_simple.decompress_text
+
+    def counting_decompress(value):
+        decompressed.append(value)
+        return decompress_text(value)
+
+    monkeypatch.setattr(rag_knowledge_base_simple, 'decompress_text', counting_decompress)
+    conn = kb._connect()
+    matches = kb._find_keyword_matches(conn.cursor(), "追施氮肥", limit=2)
+    conn.close()
+
+    assert [content for _, content, _ in matches] == [DOCUMENTS[2], DOCUMENTS[1]]
+    assert len(decompressed) == 2
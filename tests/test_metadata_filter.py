@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""文档属性位图索引：非正整数和超出范围的文档ID，文档属性变化后重建"""
+
+from metadata_filter import DocumentBitmapIndex, bitmap_from_ids, bitmap_to_ids
+from rag_knowledge_base_simple import SimpleRAGKnowledgeBase
+
+
+def test_non_positive_ids_are_skipped():
+    assert bitmap_to_ids(bitmap_from_ids([-3, 0, 2, 5])) == [2, 5]
+
+
+def test_index_ignores_invalid_and_out_of_range_ids():
+    index = DocumentBitmapIndex([(0, '.txt', '2024-01-01'), (1, '.txt', '2024-01-02'), (3, '.pdf', '2024-01-03')])
+
+    assert bitmap_to_ids(index.select()) == [1, 3]
+    assert bitmap_to_ids(index.select(document_ids=[-1, 3, 10 ** 12])) == [3]
+    assert index.select(document_ids=[10 ** 12]).bit_length() == 0
+
+
+def test_index_rebuilt_when_file_type_changes(tmp_path):
+    kb = SimpleRAGKnowledgeBase(db_path=str(tmp_path / 'kb.db'), async_ingestion=False)
+    assert kb.upload_document("水稻分蘖期应及时追施氮肥，注意浅水勤灌。".encode('utf-8'), 'a.txt', wait=True)
+
+    def selected(file_types):
+        conn = kb._connect()
+        bitmap = kb._get_metadata_index(conn.cursor()).select(file_types=file_types)
+        conn.close()
+        return bitmap_to_ids(bitmap)
+
+    assert selected(['.txt']) == [1]
+    # 扩展名长度相同，文档数和ID也不变
+    assert kb.update_document(1, "水稻分蘖期应及时追施氮肥，注意浅水勤灌，防止脱肥。".encode('utf-8'), 'a.pdf')['success']
+
+    assert selected(['.txt']) == []
+    assert selected(['.pdf']) == [1]
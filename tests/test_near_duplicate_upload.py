@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""近似重复检测：并发上传的近似副本只保存一份，拒绝时返回重复的文档和相似度"""
+
+import threading
+
+from rag_knowledge_base_simple import SimpleRAGKnowledgeBase
+
+BASE_TEXT = ("水稻分蘖期应及时追施氮肥，每亩施尿素5到8公斤，同时注意浅水勤灌，促进分蘖早发。"
+             "拔节期控制无效分蘖，适当晒田，增强根系活力。抽穗期保持浅水层，预防稻瘟病和纹枯病，"
+             "发现病斑及时用药。灌浆期干湿交替，防止早衰，收获前一周断水。")
+ORIGINAL = (BASE_TEXT + "注意天气变化。").encode('utf-8')
+NEAR_COPY = (BASE_TEXT + "注意天气变化！").encode('utf-8')
+
+
+def test_rejection_reports_duplicate(tmp_path):
+    kb = SimpleRAGKnowledgeBase(db_path=str(tmp_path / 'kb.db'), async_ingestion=False)
+    assert kb.upload_document(ORIGINAL, 'rice.txt', wait=True)
+
+    result = kb.upload_document_detailed(NEAR_COPY, 'rice_copy.txt', wait=True)
+    assert not result['success']
+    assert result['duplicate']['filename'] == 'rice.txt'
+    assert result['duplicate']['similarity'] >= kb.near_duplicate_threshold
+    assert 'rice.txt' in result['reason']
+
+
+def test_concurrent_near_duplicates_store_one_copy(tmp_path):
+    kb = SimpleRAGKnowledgeBase(db_path=str(tmp_path / 'kb.db'), async_ingestion=False)
+    # 两个上传都完成解析后才继续，模拟同时通过解析阶段
+    barrier = threading.Barrier(2)
+    extract_text_from_file = kb.extract_text_from_file
+
+    def extract(file_content, filename):
+        text = extract_text_from_file(file_content, filename)
+        barrier.wait(timeout=5)
+        return text
+
+    kb.extract_text_from_file = extract
+    results = {}
+    threads = [threading.Thread(target=lambda name=name, content=content:
+                                results.__setitem__(name, kb.upload_document_detailed(content, name)))
+               for name, content in (('rice.txt', ORIGINAL), ('rice_copy.txt', NEAR_COPY))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(result['success'] for result in results.values()) == [False, True]
+    assert len(kb.get_document_list()) == 1
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""重试与熔断：连续失败后熔断、冷却后只放行一次试探、Retry-After过长时不重试、4xx不计入失败"""
+
+import asyncio
+import time
+
+import pytest
+import requests
+
+import silican_api
+from silican_api import CircuitBreaker, CircuitOpenError, retry_on_failure
+
+
+def http_error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.exceptions.HTTPError(response=response)
+
+
+def failing(error, breaker, max_retries=3, max_delay=10):
+    """返回每次都抛出error的被装饰函数及其调用计数"""
+    calls = []
+
+    @retry_on_failure(max_retries=max_retries, delay=0, max_delay=max_delay, breaker=breaker)
+    def call():
+        calls.append(1)
+        raise error
+
+    return call, calls
+
+
+def test_opens_after_threshold_then_fails_fast():
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=60)
+    call, calls = failing(requests.exceptions.ConnectionError(), breaker)
+
+    # 第二次失败时熔断器打开，不再进行第三次尝试
+    with pytest.raises(requests.exceptions.ConnectionError):
+        call()
+    assert len(calls) == 2
+    assert breaker.get_state() == 'open'
+
+    with pytest.raises(CircuitOpenError):
+        call()
+    assert len(calls) == 2
+
+
+def test_single_probe_after_cooldown():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=60)
+    breaker.record_failure()
+    breaker.opened_at = time.monotonic() - 61
+
+    breaker.before_call()
+    assert breaker.get_state() == 'half_open'
+    # 试探调用进行期间，其他调用仍然立即失败
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record_success()
+    assert breaker.get_state() == 'closed'
+    breaker.before_call()
+
+
+def test_failed_probe_reopens_without_retrying():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=60)
+    breaker.record_failure()
+    breaker.opened_at = time.monotonic() - 61
+    call, calls = failing(requests.exceptions.Timeout(), breaker)
+
+    with pytest.raises(requests.exceptions.Timeout):
+        call()
+    assert len(calls) == 1
+    assert breaker.get_state() == 'open'
+
+
+def test_retry_after_above_max_delay_raises_immediately():
+    breaker = CircuitBreaker()
+    call, calls = failing(http_error(429, {'Retry-After': '120'}), breaker, max_delay=10)
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        call()
+    assert len(calls) == 1
+    # 429说明服务可达，不计入熔断失败
+    assert breaker.failures == 0
+
+
+def test_retry_after_is_honoured(monkeypatch):
+    waits = []
+    monkeypatch.setattr(silican_api.time, 'sleep', waits.append)
+    call, calls = failing(http_error(503, {'Retry-After': '2'}), CircuitBreaker())
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        call()
+    assert len(calls) == 3
+    assert waits == [2.0, 2.0]
+
+
+def test_non_retryable_client_error_resets_failures():
+    breaker = CircuitBreaker(failure_threshold=5)
+    for _ in range(3):
+        breaker.record_failure()
+    call, calls = failing(http_error(400), breaker)
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        call()
+    assert len(calls) == 1
+    assert breaker.failures == 0
+    assert breaker.get_state() == 'closed'
+
+
+def test_async_wrapper_opens_and_fails_fast():
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=60)
+    calls = []
+
+    @retry_on_failure(max_retries=3, delay=0, breaker=breaker)
+    async def call():
+        calls.append(1)
+        raise requests.exceptions.ConnectionError()
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        asyncio.run(call())
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(call())
+    assert len(calls) == 2
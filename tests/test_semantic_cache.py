@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""语义回答缓存：只差作物、病害或序数的问题不能命中彼此的回答"""
+
+import pytest
+
+from semantic_cache import SemanticAnswerCache
+
+# (已缓存的问题, 字面相近但含义不同的问题)；不检查实体时这些问题对的相似度都超过命中阈值
+NEAR_MISS_PAIRS = [
+    ('水稻分蘖期叶片发黄是什么原因，应该追施哪种肥料？', '玉米分蘖期叶片发黄是什么原因，应该追施哪种肥料？'),
+    ('番茄早疫病发病初期叶片出现病斑应该用什么药剂防治？', '番茄晚疫病发病初期叶片出现病斑应该用什么药剂防治？'),
+    ('小麦返青拔节期间什么时候浇第一次水比较合适？', '小麦返青拔节期间什么时候浇第二次水比较合适？'),
+]
+
+
+@pytest.mark.parametrize('cached_question, question', NEAR_MISS_PAIRS)
+def test_near_miss_questions_are_cache_misses(cached_question, question):
+    cache = SemanticAnswerCache()
+    cache.put(cached_question, 'general', '已缓存的回答')
+    assert cache.get(question, 'general') is None
+
+
+def test_rephrased_question_hits():
+    cache = SemanticAnswerCache()
+    cache.put('水稻怎么施肥', 'general', '水稻施肥方法')
+    hit = cache.get('水稻如何施肥？', 'general')
+    assert hit is not None
+    assert hit['answer'] == '水稻施肥方法'
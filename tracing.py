@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+问答各阶段耗时追踪
+每次问答记录一条trace（各阶段span的耗时和缓存命中情况），附在结果中返回，
+同时计入进程内的滚动耗时窗口，用于统计各阶段的p50/p95/p99。
+记录只有计时和列表追加，统计在查看时才排序计算，可在生产环境常开。
+"""
+
+from typing import Any, Dict, List
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+
+# 当前线程正在记录的trace
+_local = threading.local()
+
+
+class Trace:
+    """一次问答的阶段耗时记录"""
+
+    __slots__ = ('name', 'start', 'spans', 'open_spans')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.open_spans: List[Dict[str, Any]] = []  # 尚未结束的span（嵌套时最内层在末尾）
+
+    @contextmanager
+    def span(self, name: str):
+        """记录一个阶段的耗时"""
+        started = time.perf_counter()
+        record = {'name': name, 'start_ms': (started - self.start) * 1000, 'duration_ms': 0.0}
+        self.spans.append(record)
+        self.open_spans.append(record)
+        try:
+            yield record
+        finally:
+            record['duration_ms'] = (time.perf_counter() - started) * 1000
+            self.open_spans.pop()
+
+    def annotate(self, **annotations) -> None:
+        """给最内层未结束的span添加标注（如 search_cache='hit'）"""
+        if self.open_spans:
+            self.open_spans[-1].update(annotations)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为可序列化的字典"""
+        return {
+            'name': self.name,
+            'total_ms': (time.perf_counter() - self.start) * 1000,
+            'spans': [dict(span) for span in self.spans]
+        }
+
+
+@contextmanager
+def trace(name: str, record: bool = True):
+    """
+    在当前线程开始记录trace，结束时将各阶段耗时计入滚动统计
+
+    用法：
+        with trace('answer_question') as current_trace:
+            ...
+        result['trace'] = current_trace.to_dict()
+
+    record为False时不计入统计（如流式回答在生成器结束后自行记录）
+    """
+    current = Trace(name)
+    previous = getattr(_local, 'trace', None)
+    _local.trace = current
+    try:
+        yield current
+    finally:
+        _local.trace = previous
+        if record:
+            get_latency_histograms().record_trace(current)
+
+
+@contextmanager
+def span(name: str):
+    """在当前线程的trace中记录一个阶段；没有进行中的trace时不做任何事"""
+    current = getattr(_local, 'trace', None)
+    if current is None:
+        yield None
+        return
+    with current.span(name) as record:
+        yield record
+
+
+def annotate(**annotations) -> None:
+    """给当前线程trace中最内层的span添加标注；没有进行中的trace时忽略"""
+    current = getattr(_local, 'trace', None)
+    if current is not None:
+        current.annotate(**annotations)
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    """已排序列表的分位数（最近秩法）"""
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class LatencyHistograms:
+    """各阶段最近window次耗时的滚动窗口（线程安全）"""
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples: Dict[str, deque] = {}
+
+    def record(self, stage: str, duration_ms: float) -> None:
+        """记录一次耗时"""
+        with self.lock:
+            self._append(stage, duration_ms)
+
+    def record_trace(self, current: Trace) -> None:
+        """记录一条trace的总耗时和各阶段耗时"""
+        total_ms = (time.perf_counter() - current.start) * 1000
+        with self.lock:
+            self._append('total', total_ms)
+            for span_record in current.spans:
+                self._append(span_record['name'], span_record['duration_ms'])
+
+    def _append(self, stage: str, duration_ms: float) -> None:
+        """追加样本（调用方持有锁）"""
+        samples = self.samples.get(stage)
+        if samples is None:
+            samples = self.samples[stage] = deque(maxlen=self.window)
+        samples.append(duration_ms)
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        """各阶段的样本数、p50/p95/p99和最大耗时（毫秒）"""
+        with self.lock:
+            snapshot = {stage: list(samples) for stage, samples in self.samples.items() if samples}
+        stats = {}
+        for stage, values in snapshot.items():
+            values.sort()
+            stats[stage] = {
+                'count': len(values),
+                'p50': _percentile(values, 0.50),
+                'p95': _percentile(values, 0.95),
+                'p99': _percentile(values, 0.99),
+                'max': values[-1]
+            }
+        return stats
+
+    def clear(self) -> None:
+        """清空统计"""
+        with self.lock:
+            self.samples.clear()
+
+
+# 进程内共享的耗时统计
+_histograms = LatencyHistograms()
+
+
+def get_latency_histograms() -> LatencyHistograms:
+    """获取进程内共享的耗时统计"""
+    return _histograms